@@ -2,7 +2,16 @@
 local Config = {
     ServerURL = "https://cuonggdev.com", -- Đường dẫn FastAPI server
     TrackingInterval = 300,
-    StatsEndpoint = "/ac_stats"
+    -- Unchanged stats are not resent, except once per KeepaliveInterval so the server knows we're alive
+    KeepaliveInterval = 1800,
+    StatsEndpoint = "/ac_stats",
+    -- 2 = compact payload (short keys, pets as tuples, server derives Rank/Formatted*), 1 = full JSON
+    PayloadVersion = 2,
+    -- Aggregator mode: all accounts on this machine share BatchFolder and one of them
+    -- posts everyone's latest stats to BatchEndpoint in a single request
+    BatchMode = false,
+    BatchEndpoint = "/ac_stats/batch",
+    BatchFolder = "AC_Track_Batch"
 }
 
 -- Uncomment and modify this line to use local development server
@@ -21,6 +30,41 @@ local function formatNumber(num)
     return table.concat(groups, ",")
 end
 
+-- Encode stats for the server, using the compact v2 format when enabled
+-- v2: {v=2, n=name, c=cash, g=gems, p={{name, level, rankNum, folderName}, ...}, i={{name, amount}, ...}, s={passName, ...}}
+local function encodePayload(statsData)
+    if Config.PayloadVersion ~= 2 then
+        return HttpService:JSONEncode(statsData)
+    end
+    
+    local pets = {}
+    for i, pet in ipairs(statsData.PetsList) do
+        pets[i] = {pet.Name, pet.Level, pet.RankNum, pet.FolderName}
+    end
+    
+    local items = {}
+    for i, item in ipairs(statsData.ItemsList) do
+        items[i] = {item.Name, item.Amount}
+    end
+    
+    local passes = {}
+    for _, pass in ipairs(statsData.PassesList) do
+        if pass.Owned then
+            table.insert(passes, pass.Name)
+        end
+    end
+    
+    return HttpService:JSONEncode({
+        v = 2,
+        n = statsData.PlayerName,
+        c = statsData.Cash,
+        g = statsData.Gems,
+        p = pets,
+        i = items,
+        s = passes
+    })
+end
+
 -- Function to send stats to the server
 local function sendStatsToServer(statsData)
     local player = game.Players.LocalPlayer
@@ -121,6 +165,141 @@ local function sendStatsToServer(statsData)
     end
 end
 
+-- POST a JSON body to an endpoint on the configured server
+local function postToServer(endpoint, jsonData)
+    -- Ensure proper URL formatting with slash
+    local fullUrl = Config.ServerURL
+    if string.sub(fullUrl, -1) ~= "/" and string.sub(endpoint, 1, 1) ~= "/" then
+        fullUrl = fullUrl .. "/"
+    elseif string.sub(fullUrl, -1) == "/" and string.sub(endpoint, 1, 1) == "/" then
+        fullUrl = fullUrl .. string.sub(endpoint, 2)
+    else
+        fullUrl = fullUrl .. endpoint
+    end
+    
+    print("Sending stats to server: " .. fullUrl)
+    print("JSON data length: " .. string.len(jsonData))
+    
+    -- Send to server using request
+    local success, response = pcall(function()
+        return request({
+            Url = fullUrl,
+            Method = "POST",
+            Headers = {
+                ["Content-Type"] = "application/json"
+            },
+            Body = jsonData
+        })
+    end)
+    
+    if success then
+        if response then
+            print("Stats sent successfully. Status code: " .. (response.StatusCode or "N/A"))
+            if response.Body then
+                print("Response body: " .. response.Body)
+            end
+        else
+            warn("No response data received")
+        end
+    else
+        warn("Failed to send stats: " .. tostring(response))
+    end
+    
+    return success, response
+end
+
+-- Server-suggested delay before the next report (next_report_in); nil until the server answers
+local nextReportIn = nil
+local lastSignature = nil
+local lastSentAt = 0
+
+-- Read the next_report_in pacing hint from a server response, if there is one
+local function readReportHint(response)
+    if type(response) ~= "table" or not response.Body then return end
+    local ok, body = pcall(function()
+        return HttpService:JSONDecode(response.Body)
+    end)
+    if ok and type(body) == "table" and tonumber(body.next_report_in) then
+        nextReportIn = tonumber(body.next_report_in)
+        print("Server asks for next report in " .. tostring(nextReportIn) .. "s")
+    end
+end
+
+-- Deterministic summary of the stats, used to detect that nothing changed since the last send
+local function statsSignature(statsData)
+    local parts = {statsData.PlayerName, tostring(statsData.Cash), tostring(statsData.Gems), tostring(statsData.PetCount)}
+    for _, pet in ipairs(statsData.PetsList) do
+        table.insert(parts, string.format("%s:%s:%s:%s",
+            tostring(pet.Name), tostring(pet.Level), tostring(pet.RankNum), tostring(pet.FolderName)))
+    end
+    for _, item in ipairs(statsData.ItemsList) do
+        table.insert(parts, tostring(item.Name) .. "=" .. tostring(item.Amount))
+    end
+    -- Passes come from GetAttributes(), whose order is not stable
+    local passNames = {}
+    for _, pass in ipairs(statsData.PassesList) do
+        table.insert(passNames, tostring(pass.Name))
+    end
+    table.sort(passNames)
+    table.insert(parts, table.concat(passNames, ","))
+    return table.concat(parts, "|")
+end
+
+-- Aggregator mode needs the executor file API to share stats between local accounts
+local function batchingSupported()
+    return type(writefile) == "function" and type(readfile) == "function"
+        and type(listfiles) == "function" and type(isfolder) == "function"
+        and type(makefolder) == "function"
+end
+
+-- Store this account's latest payload (prefixed with the time it was written) in the shared folder
+local function queueForBatch(playerName, jsonData)
+    if not isfolder(Config.BatchFolder) then
+        makefolder(Config.BatchFolder)
+    end
+    writefile(Config.BatchFolder .. "/" .. playerName .. ".json", tostring(os.time()) .. "\n" .. jsonData)
+end
+
+-- The account holding the leader lock posts every fresh payload in the folder as one batch.
+-- A lock older than two intervals is considered abandoned and taken over.
+local function flushBatchIfLeader(playerName)
+    local lockPath = Config.BatchFolder .. "/leader.lock"
+    local now = os.time()
+    local staleAfter = Config.TrackingInterval * 2
+    
+    local okLock, lock = pcall(readfile, lockPath)
+    local leader, lockedAt = nil, 0
+    if okLock and lock then
+        leader, lockedAt = lock:match("^(.-)|(%d+)$")
+        lockedAt = tonumber(lockedAt) or 0
+    end
+    
+    if leader and leader ~= playerName and now - lockedAt < staleAfter then
+        return
+    end
+    writefile(lockPath, playerName .. "|" .. tostring(now))
+    
+    local payloads = {}
+    for _, path in ipairs(listfiles(Config.BatchFolder)) do
+        if string.sub(path, -5) == ".json" then
+            local okRead, content = pcall(readfile, path)
+            if okRead and content then
+                local writtenAt, body = content:match("^(%d+)\n(.*)$")
+                -- Skip accounts that stopped reporting
+                if body and now - (tonumber(writtenAt) or 0) < staleAfter then
+                    table.insert(payloads, body)
+                end
+            end
+        end
+    end
+    
+    if #payloads > 0 then
+        print("Sending batch of " .. #payloads .. " accounts")
+        local _, response = postToServer(Config.BatchEndpoint, "[" .. table.concat(payloads, ",") .. "]")
+        readReportHint(response)
+    end
+end
+
 -- Function to track stats from the game
 local function trackStats()
     local player = game:GetService("Players").LocalPlayer
@@ -294,44 +473,23 @@ local function trackStats()
     print("PassesList in statsData:", statsData.PassesList)
     
     -- Đơn giản hóa hàm gửi data lên server
-    local jsonData = HttpService:JSONEncode(statsData)
+    local jsonData = encodePayload(statsData)
     
-    -- Ensure proper URL formatting with slash
-    local fullUrl = Config.ServerURL
-    if string.sub(fullUrl, -1) ~= "/" and string.sub(Config.StatsEndpoint, 1, 1) ~= "/" then
-        fullUrl = fullUrl .. "/"
-    elseif string.sub(fullUrl, -1) == "/" and string.sub(Config.StatsEndpoint, 1, 1) == "/" then
-        fullUrl = fullUrl .. string.sub(Config.StatsEndpoint, 2)
+    if Config.BatchMode and batchingSupported() then
+        queueForBatch(playerName, jsonData)
+        flushBatchIfLeader(playerName)
     else
-        fullUrl = fullUrl .. Config.StatsEndpoint
-    end
-    
-    print("Sending stats to server: " .. fullUrl)
-    print("JSON data length: " .. string.len(jsonData))
-    
-    -- Send to server using request
-    local success, response = pcall(function()
-        return request({
-            Url = fullUrl,
-            Method = "POST",
-            Headers = {
-                ["Content-Type"] = "application/json"
-            },
-            Body = jsonData
-        })
-    end)
-    
-    if success then
-        if response then
-            print("Stats sent successfully. Status code: " .. (response.StatusCode or "N/A"))
-            if response.Body then
-                print("Response body: " .. response.Body)
-            end
+        local signature = statsSignature(statsData)
+        if signature == lastSignature and os.time() - lastSentAt < Config.KeepaliveInterval then
+            print("Stats unchanged since last send, skipping")
         else
-            warn("No response data received")
+            local success, response = postToServer(Config.StatsEndpoint, jsonData)
+            if success and response and response.Success then
+                lastSignature = signature
+                lastSentAt = os.time()
+            end
+            readReportHint(response)
         end
-    else
-        warn("Failed to send stats: " .. tostring(response))
     end
     
     return statsData
@@ -344,7 +502,8 @@ local function startTracking(interval)
     spawn(function()
         while true do
             local stats = trackStats()
-            wait(interval)
+            -- Follow the server's pacing hint when it sent one
+            wait(nextReportIn or interval)
         end
     end)
 end
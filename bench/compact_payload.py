@@ -0,0 +1,75 @@
+"""Heartbeat size and server-side decode time: original JSON shape against compact v2.
+
+Needs no database. Builds a heartbeat like AC_Track.lua sends for a given
+pet count, then measures body size (plain and gzip) and the time from body
+bytes to a validated stats document (decode, compact expansion, pydantic).
+
+    python bench/compact_payload.py --pets 50 200 1000
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+
+import server
+
+def payloads(pet_count):
+    pets = [(f"Pet{i}", i % 120, i % 8 + 1, f"PetFolder{i}") for i in range(pet_count)]
+    items = [(f"Item{i}", i * 3) for i in range(20)]
+    plain = {
+        "PlayerName": "BenchPlayer",
+        "Cash": 123456789012,
+        "FormattedCash": "123,456,789,012",
+        "Gems": 98765,
+        "FormattedGems": "98,765",
+        "PetCount": pet_count,
+        "PetsList": [
+            {"Name": name, "Level": level, "Rank": server.RANK_NAMES[rank], "RankNum": rank, "FolderName": folder}
+            for name, level, rank, folder in pets
+        ],
+        "ItemsList": [{"Name": name, "Amount": amount} for name, amount in items],
+        "PassesList": [{"Name": "VIP", "Owned": True}, {"Name": "2x Speed", "Owned": False}]
+    }
+    compact = {
+        "v": 2, "n": "BenchPlayer", "c": 123456789012, "g": 98765,
+        "p": [list(pet) for pet in pets],
+        "i": [list(item) for item in items],
+        "s": ["VIP"]
+    }
+    return plain, compact
+
+def decode(body, compressed):
+    if compressed:
+        body = server.decompress_limited(body, 16 + server.zlib.MAX_WBITS)
+    stats_data, error = server.prepare_stats(server.normalize_stats_payload(orjson.loads(body)))
+    assert error is None, error
+    return stats_data
+
+def time_per_call(func, *args):
+    calls = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < 0.5:
+        func(*args)
+        calls += 1
+    return (time.perf_counter() - started) / calls * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pets", type=int, nargs="+", default=[50, 200, 1000])
+    args = parser.parse_args()
+    
+    print(f"{'pets':>6} {'format':<10} {'bytes':>9} {'gzip':>9} {'decode µs':>10} {'gzip µs':>9}")
+    for pet_count in args.pets:
+        for label, payload in zip(("json", "compact"), payloads(pet_count)):
+            body = orjson.dumps(payload)
+            zipped = gzip.compress(body)
+            print(f"{pet_count:>6} {label:<10} {len(body):>9} {len(zipped):>9} "
+                  f"{time_per_call(decode, body, False):>10.0f} {time_per_call(decode, zipped, True):>9.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Batch delete of many players (delete_players) against a local mongod.
+
+Seeds --players players into player_stats and player_latest of the
+arise_crossover_bench database (dropped afterwards) and times one
+delete_players call for all of them.
+
+    MONGO_URI=mongodb://localhost:27017 python bench/delete_batch.py --players 5000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+from pymongo import MongoClient
+
+import server
+
+class BenchDatabase(server.MongoDBClient):
+    """MongoDBClient on the throwaway bench database"""
+    def __init__(self, client):
+        self.client = client
+        self.db = client["arise_crossover_bench"]
+        self.stats_collection = self.db["player_stats"]
+        self.latest_collection = self.db["player_latest"]
+        self.stats = server.AsyncCollection(self.stats_collection)
+        self.latest = server.AsyncCollection(self.latest_collection)
+        self.counters = server.AsyncCollection(self.db["counters"])
+        self.analytics = server.AsyncCollection(self.db["analytics"])
+        self.tombstones = server.AsyncCollection(self.db["player_tombstones"])
+        self.history = None
+        self._ensure_indexes()
+
+def seed(db_client, players):
+    names = [f"bench_{i:06d}" for i in range(players)]
+    db_client.stats_collection.insert_many(
+        [{"PlayerName": name, "Cash": 0, "Gems": 0, "PetCount": 0} for name in names], ordered=False
+    )
+    db_client.latest_collection.insert_many(
+        [{"PlayerName": name, "PlayerNameLower": name, "Cash": 0, "Gems": 0, "PetCount": 0, "seq": 0} for name in names],
+        ordered=False
+    )
+    return names
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--players", type=int, default=5000)
+    args = parser.parse_args()
+    
+    client = MongoClient(os.environ["MONGO_URI"])
+    try:
+        db_client = BenchDatabase(client)
+        names = seed(db_client, args.players)
+        started = time.perf_counter()
+        deleted = await server.delete_players(db_client, names)
+        elapsed = time.perf_counter() - started
+        print(f"Deleted {len(deleted)} players in {elapsed * 1000:.0f} ms")
+    finally:
+        client.drop_database("arise_crossover_bench")
+
+if __name__ == "__main__":
+    asyncio.run(main())
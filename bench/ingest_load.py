@@ -0,0 +1,114 @@
+"""Ingest latency while the dashboard is being used.
+
+Runs against a live server. Game clients POST /ac_stats at a fixed total
+rate (open loop, so a stalled server can't slow the senders down and hide
+its own latency), first on their own and then while --dashboards sessions
+keep paging /api/latest sorted by Cash with a random filter, which misses
+the cache. Prints ingest p50/p95/p99 for both phases.
+
+    uvicorn server:app --port 8080
+    python bench/ingest_load.py --url http://localhost:8080 --duration 30
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import httpx
+
+def heartbeat(player_id, pet_count):
+    return {
+        "PlayerName": f"bench_{player_id}",
+        "Cash": random.randrange(10 ** 12),
+        "Gems": random.randrange(10 ** 6),
+        "PetCount": pet_count,
+        "PetsList": [
+            {"Name": f"Pet{i}", "Level": random.randrange(1, 100), "Rank": "S", "RankNum": 6, "FolderName": f"Pet{i}"}
+            for i in range(pet_count)
+        ],
+        "ItemsList": [{"Name": "Ticket", "Amount": random.randrange(100)}],
+        "PassesList": []
+    }
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def send_heartbeats(client, args, latencies, errors, stop):
+    async def post_one():
+        started = time.perf_counter()
+        try:
+            response = await client.post("/ac_stats", json=heartbeat(random.randrange(args.players), args.pets))
+            if response.status_code >= 400 or not response.json().get("success"):
+                errors.append(response.status_code)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - started)
+    
+    tasks = set()
+    next_at = time.perf_counter()
+    while not stop.is_set():
+        task = asyncio.create_task(post_one())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        next_at += 1 / args.rate
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+    await asyncio.gather(*tasks)
+
+async def browse_dashboard(client, pages, stop):
+    while not stop.is_set():
+        params = {
+            "sort": "Cash",
+            "order": random.choice(["asc", "desc"]),
+            "page": random.randrange(1, 20),
+            "page_size": 50,
+            "cash_min": random.randrange(10 ** 11)
+        }
+        response = await client.get("/api/latest", params=params)
+        response.raise_for_status()
+        pages.append(1)
+
+async def run_phase(args, dashboards):
+    limits = httpx.Limits(max_connections=args.rate + dashboards + 10)
+    async with httpx.AsyncClient(base_url=args.url, timeout=30, limits=limits) as game, \
+               httpx.AsyncClient(base_url=args.url, timeout=60, follow_redirects=True) as dashboard:
+        if dashboards:
+            # /login redirects to /dashboard?token=..., which sets the session cookie
+            response = await dashboard.post("/login", data={"username": args.username, "password": args.password})
+            if "session" not in dashboard.cookies:
+                raise SystemExit(f"Login failed ({response.status_code})")
+        
+        latencies, errors, pages = [], [], []
+        stop = asyncio.Event()
+        workers = [asyncio.create_task(send_heartbeats(game, args, latencies, errors, stop))]
+        workers += [asyncio.create_task(browse_dashboard(dashboard, pages, stop)) for _ in range(dashboards)]
+        await asyncio.sleep(args.duration)
+        stop.set()
+        await asyncio.gather(*workers)
+    
+    label = f"with {dashboards} dashboards" if dashboards else "ingest only"
+    print(f"{label:>20}: {len(latencies)} heartbeats, {len(errors)} errors, {len(pages)} dashboard pages")
+    if latencies:
+        print(f"{'':>20}  p50 {percentile(latencies, 0.5) * 1000:.1f} ms  "
+              f"p95 {percentile(latencies, 0.95) * 1000:.1f} ms  "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms  "
+              f"mean {statistics.fmean(latencies) * 1000:.1f} ms")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--rate", type=int, default=50, help="heartbeats per second, all clients together")
+    parser.add_argument("--players", type=int, default=2000, help="distinct player names")
+    parser.add_argument("--pets", type=int, default=30, help="pets per heartbeat")
+    parser.add_argument("--dashboards", type=int, default=4, help="concurrent dashboard sessions in the second phase")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per phase")
+    parser.add_argument("--username", default="hopeo")
+    parser.add_argument("--password", default="hopeo123")
+    args = parser.parse_args()
+    
+    await run_phase(args, 0)
+    await run_phase(args, args.dashboards)
+
+if __name__ == "__main__":
+    asyncio.run(main())
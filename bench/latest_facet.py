@@ -0,0 +1,87 @@
+"""/api/latest page query: one $facet pipeline against separate count and page pipelines.
+
+Seeds a local mongod (MONGO_URI, database arise_crossover_bench, dropped
+afterwards) with 10k, 100k and 1M player_latest documents and times an
+uncached page both ways, with and without a Cash filter.
+
+    MONGO_URI=mongodb://localhost:27017 python bench/latest_facet.py --sizes 10000 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+from pymongo import DESCENDING, MongoClient
+
+import server
+
+def seed(collection, count):
+    collection.drop()
+    for start in range(0, count, 10000):
+        collection.insert_many([
+            {
+                "PlayerName": f"player_{i:07d}",
+                "PlayerNameLower": f"player_{i:07d}",
+                "Cash": random.randrange(10 ** 12),
+                "Gems": random.randrange(10 ** 6),
+                "PetCount": 30,
+                "TicketCount": random.randrange(100),
+                "SRankPets": random.randrange(10),
+                "SSRankPets": random.randrange(5),
+                "PassCount": random.randrange(8)
+            }
+            for i in range(start, min(count, start + 10000))
+        ], ordered=False)
+    collection.create_index("PlayerName", unique=True)
+    collection.create_index([("Cash", DESCENDING), ("PlayerName", DESCENDING)])
+
+def time_query(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    
+    client = MongoClient(os.environ["MONGO_URI"])
+    collection = client["arise_crossover_bench"]["player_latest"]
+    try:
+        for size in args.sizes:
+            seed(collection, size)
+            for label, match_filter in (("no filter", {}), ("Cash filter", server.build_latest_filter(cash_min=10 ** 11))):
+                skip = 20 * 50
+                
+                def facet():
+                    list(collection.aggregate(server.build_latest_pipeline(
+                        match_filter, skip, 50, "Cash", DESCENDING, server.LATEST_PROJECTION
+                    ), allowDiskUse=True))
+                
+                def separate():
+                    stages = [{"$match": match_filter}] if match_filter else []
+                    list(collection.aggregate(stages + [{"$count": "count"}]))
+                    list(collection.aggregate(stages + [
+                        {"$sort": server.latest_sort_spec("Cash", DESCENDING)},
+                        {"$skip": skip},
+                        {"$limit": 50},
+                        {"$project": server.LATEST_PROJECTION}
+                    ], allowDiskUse=True))
+                
+                print(f"{size:>8} players, {label:<11}: "
+                      f"separate {time_query(separate, args.repeat):8.1f} ms   "
+                      f"$facet {time_query(facet, args.repeat):8.1f} ms")
+    finally:
+        client.drop_database("arise_crossover_bench")
+
+if __name__ == "__main__":
+    main()
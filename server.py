@@ -1,21 +1,55 @@
 from fastapi import FastAPI, Depends, HTTPException, Request, status, Form, Response, Cookie, Query, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import pymongo
-from pymongo import MongoClient, ASCENDING, DESCENDING
-from datetime import datetime, timedelta
-from pydantic import BaseModel, validator
-from typing import List, Optional, Dict, Any, Union
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
+from datetime import datetime, timedelta, timezone
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+from typing import List, Optional, Union, Annotated
 import json
+import orjson
+import math
 import os
+import csv
+import io
+import itertools
+import re
+import array
+import bisect
+import base64
+import hashlib
+import zlib
+import random
+from collections import OrderedDict, deque
 import secrets
 import logging
+import time
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
 from dotenv import load_dotenv
+
+# Optional: Brotli for clients that accept it, gzip otherwise
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+# Optional: vectorized filtering for the columnar latest-stats engine
+try:
+    import numpy as np
+except ImportError:
+    np = None
 import uvicorn
-from functools import lru_cache
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from email.utils import formatdate, parsedate_to_datetime
 
 # Thiết lập logging
 logging.basicConfig(
@@ -40,7 +74,8 @@ os.makedirs(TEMPLATES_DIR, exist_ok=True)
 app = FastAPI(
     title="Arise Crossover Stats Tracker", 
     description="API for tracking Arise Crossover player stats",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Enable CORS
@@ -58,6 +93,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+# Streaming endpoints that compress themselves or must flush every chunk immediately
+COMPRESSION_EXCLUDED_PATHS = {"/api/latest/export", "/api/stream"}
+
+class CompressionMiddleware:
+    """Brotli/gzip response compression that leaves COMPRESSION_EXCLUDED_PATHS alone.
+
+    Starlette's GZipMiddleware buffers streamed chunks and does not check for
+    an existing Content-Encoding, so streaming endpoints bypass it here.
+    """
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE, excluded_paths=COMPRESSION_EXCLUDED_PATHS):
+        self.app = app
+        self.excluded_paths = excluded_paths
+        if BrotliMiddleware is not None:
+            self.compressed_app = BrotliMiddleware(app, minimum_size=minimum_size, gzip_fallback=True)
+        else:
+            self.compressed_app = GZipMiddleware(app, minimum_size=minimum_size)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] not in self.excluded_paths:
+            await self.compressed_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware)
+
 # Set up static files and templates
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
@@ -66,23 +128,163 @@ templates = Jinja2Templates(directory=TEMPLATES_DIR)
 DEFAULT_MONGO_URI = "mongodb+srv://localhost:27017"
 MONGO_URI = os.environ.get("MONGO_URI", DEFAULT_MONGO_URI)
 CACHE_EXPIRY = int(os.environ.get("CACHE_EXPIRY", "300"))  # 5 minutes cache by default
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "10"))
+
+# Optional time-series history of player snapshots (raw -> hourly -> daily)
+HISTORY_ENABLED = os.environ.get("HISTORY_ENABLED", "false").lower() == "true"
+HISTORY_RAW_TTL = int(os.environ.get("HISTORY_RAW_TTL", str(24 * 3600)))  # seconds of raw snapshots
+HISTORY_HOURLY_TTL = int(os.environ.get("HISTORY_HOURLY_TTL", str(30 * 24 * 3600)))  # seconds of hourly points
+HISTORY_MAX_POINTS = int(os.environ.get("HISTORY_MAX_POINTS", "2000"))
+HISTORY_CACHE_BUCKET = int(os.environ.get("HISTORY_CACHE_BUCKET", "60"))  # seconds a default 'to' is rounded to
+
+# Write-behind ingest buffer for /ac_stats
+INGEST_BUFFER_ENABLED = os.environ.get("INGEST_BUFFER_ENABLED", "true").lower() == "true"
+INGEST_FLUSH_INTERVAL = float(os.environ.get("INGEST_FLUSH_INTERVAL", "2"))  # seconds
+INGEST_FLUSH_SIZE = int(os.environ.get("INGEST_FLUSH_SIZE", "500"))  # pending players
+INGEST_BATCH_MAX = int(os.environ.get("INGEST_BATCH_MAX", "1000"))  # players per /ac_stats/batch request
+INGEST_MAX_BODY_BYTES = int(os.environ.get("INGEST_MAX_BODY_BYTES", str(16 * 1024 * 1024)))  # before and after decompression
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", "3"))  # failed flushes before an update is dropped
+INGEST_DEAD_LETTER_SIZE = int(os.environ.get("INGEST_DEAD_LETTER_SIZE", "100"))  # dropped updates kept for inspection
+
+# Adaptive client pacing: responses tell AC_Track.lua when to report next
+REPORT_INTERVAL = int(os.environ.get("REPORT_INTERVAL", "300"))  # seconds, matches Config.TrackingInterval
+REPORT_INTERVAL_MAX = int(os.environ.get("REPORT_INTERVAL_MAX", "1800"))  # seconds
+INGEST_TARGET_RATE = float(os.environ.get("INGEST_TARGET_RATE", "20"))  # heartbeats/second before slowing clients
+INGEST_MAX_PENDING = int(os.environ.get("INGEST_MAX_PENDING", "20000"))  # buffered players before shedding load
+
+# Player-name search: in-memory trigram index for substring matches, refreshed from the change feed
+NAME_INDEX_ENABLED = os.environ.get("NAME_INDEX_ENABLED", "true").lower() == "true"
+NAME_INDEX_REFRESH_INTERVAL = float(os.environ.get("NAME_INDEX_REFRESH_INTERVAL", "10"))  # seconds
+NAME_INDEX_MAX_MATCHES = int(os.environ.get("NAME_INDEX_MAX_MATCHES", "5000"))  # larger results fall back to Mongo
+
+# In-process columnar copy of player_latest answering /api/latest without Mongo
+COLUMNAR_ENABLED = os.environ.get("COLUMNAR_ENABLED", "false").lower() == "true"
+COLUMNAR_REFRESH_INTERVAL = float(os.environ.get("COLUMNAR_REFRESH_INTERVAL", "5"))  # seconds, multi-worker only
+
+# Live dashboard feed (/api/stream)
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", "1000"))  # events buffered per client
+STREAM_HEARTBEAT_INTERVAL = float(os.environ.get("STREAM_HEARTBEAT_INTERVAL", "15"))  # seconds
+STREAM_MAX_CLIENTS = int(os.environ.get("STREAM_MAX_CLIENTS", "100"))
+
+# Batch deletes remove this many players per delete_many
+DELETE_CHUNK_SIZE = int(os.environ.get("DELETE_CHUNK_SIZE", "1000"))
 
-# In-memory cache
-cache = {}
+# Running analytics totals (/api/analytics/*)
+ANALYTICS_RECONCILE_INTERVAL = float(os.environ.get("ANALYTICS_RECONCILE_INTERVAL", "3600"))  # seconds, 0 disables
+ANALYTICS_REBUILD_TIMEOUT = float(os.environ.get("ANALYTICS_REBUILD_TIMEOUT", "600"))  # seconds before a stuck rebuild stops pausing writes
+LATEST_WRITE_ATTEMPTS = int(os.environ.get("LATEST_WRITE_ATTEMPTS", "3"))  # change-feed writes retried on conflict or delay
+
+# Incremental sync (/api/latest/changes)
+CHANGES_RETENTION = int(os.environ.get("CHANGES_RETENTION", str(7 * 24 * 3600)))  # seconds tombstones are kept
+CHANGES_SETTLE_SECONDS = float(os.environ.get("CHANGES_SETTLE_SECONDS", "2"))  # grace for writes still in flight
+
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "2000"))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 64 MB
+CACHE_SWEEP_INTERVAL = int(os.environ.get("CACHE_SWEEP_INTERVAL", "60"))  # seconds
+# Ingest bumps the shared cache generations at most this often, so heartbeats don't thrash the read cache
+CACHE_INVALIDATION_INTERVAL = float(os.environ.get("CACHE_INVALIDATION_INTERVAL", "1"))  # seconds
+
+# Cache/session backend: "memory" is per process, "sqlite" is shared by every worker on the host.
+# Defaults to sqlite when uvicorn is started with more than one worker.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "sqlite" if WEB_CONCURRENCY > 1 else "memory")
+CACHE_SQLITE_PATH = os.environ.get("CACHE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "arise_crossover_cache.sqlite3"))
+
+# Dedicated thread pool for blocking pymongo calls, sized to the connection pool
+# so a slow aggregation never runs on (and stalls) the event loop
+db_executor = ThreadPoolExecutor(max_workers=MONGO_MAX_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database call on the Mongo thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+# The shared SQLite cache serializes on one connection, a couple of threads are plenty
+cache_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache")
+
+class AsyncCollection:
+    """Awaitable wrapper around a pymongo collection.
+
+    Every method is offloaded to ``db_executor``. Cursor-returning methods
+    (``find``, ``aggregate``) are materialized into lists inside the worker
+    thread so no network I/O happens on the event loop.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def find(self, filter=None, projection=None, sort=None, skip=0, limit=0):
+        def _find():
+            cursor = self.collection.find(filter or {}, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if skip:
+                cursor = cursor.skip(skip)
+            if limit:
+                cursor = cursor.limit(limit)
+            return list(cursor)
+        return await run_db(_find)
+    
+    async def aggregate(self, pipeline, **kwargs):
+        return await run_db(lambda: list(self.collection.aggregate(pipeline, **kwargs)))
+    
+    async def find_batches(self, filter=None, projection=None, sort=None, batch_size=500):
+        """Async generator over a server-side cursor, yielding lists of up to batch_size.
+
+        Only one batch is held in memory at a time; each fetch runs on the pool.
+        """
+        cursor = self.collection.find(filter or {}, projection, sort=sort, batch_size=batch_size)
+        try:
+            while True:
+                batch = await run_db(lambda: list(itertools.islice(cursor, batch_size)))
+                if not batch:
+                    break
+                yield batch
+        finally:
+            await run_db(cursor.close)
+    
+    def __getattr__(self, name):
+        # find_one, update_one, insert_one, count_documents, delete_many, bulk_write, ...
+        method = getattr(self.collection, name)
+        if not callable(method):
+            return method
+        
+        async def call(*args, **kwargs):
+            return await run_db(method, *args, **kwargs)
+        return call
 
 # Lazy singleton pattern for MongoDB connection
 class MongoDBClient:
     _instance = None
+    _lock = threading.Lock()
     client = None
     db = None
     stats_collection = None
+    latest_collection = None
+    stats = None
+    latest = None
+    accounts = None
+    counters = None
+    analytics = None
+    tombstones = None
+    history = None
     
     @classmethod
     def get_instance(cls):
-        if cls._instance is None:
-            cls._instance = cls()
-            cls._instance._connect()
-        return cls._instance
+        """The shared client, connected and migrated on first use.
+
+        The instance is only published once _connect (indexes and backfills
+        included) has finished; concurrent callers wait on the lock, and a
+        failed connect leaves nothing behind so the next call retries.
+        """
+        instance = cls._instance
+        if instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    instance = cls()
+                    instance._connect()
+                    cls._instance = instance
+                instance = cls._instance
+        return instance
     
     def _connect(self):
         try:
@@ -90,25 +292,54 @@ class MongoDBClient:
             self.client = MongoClient(
                 MONGO_URI, 
                 serverSelectionTimeoutMS=5000,
-                maxPoolSize=10,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
                 minPoolSize=1,
                 maxIdleTimeMS=45000,
                 waitQueueTimeoutMS=5000
             )
             self.db = self.client["arise_crossover"]
             self.stats_collection = self.db["player_stats"]
+            # Materialized read model: one document per player with its latest stats
+            self.latest_collection = self.db["player_latest"]
+            
+            # Async views used by the request handlers
+            self.stats = AsyncCollection(self.stats_collection)
+            self.latest = AsyncCollection(self.latest_collection)
+            self.accounts = AsyncCollection(self.db["roblox_accounts"])
+            self.counters = AsyncCollection(self.db["counters"])
+            self.analytics = AsyncCollection(self.db["analytics"])
+            # Deleted players, kept for CHANGES_RETENTION so /api/latest/changes can report them
+            self.tombstones = AsyncCollection(self.db["player_tombstones"])
             
             # Create indexes for better performance
             self._ensure_indexes()
+            if HISTORY_ENABLED:
+                self._ensure_history_collections()
+                self.history = {
+                    resolution: AsyncCollection(self.db[name])
+                    for resolution, name in HISTORY_COLLECTIONS.items()
+                }
+            self._backfill_latest()
+            self._backfill_derived_fields()
             
             # Test connection
             self.client.admin.command('ping')
             logger.info("MongoDB connection initialized and verified")
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
+            if self.client is not None:
+                self.client.close()
             self.client = None
             self.db = None
             self.stats_collection = None
+            self.latest_collection = None
+            self.stats = None
+            self.latest = None
+            self.accounts = None
+            self.counters = None
+            self.analytics = None
+            self.tombstones = None
+            self.history = None
             raise
     
     def _ensure_indexes(self):
@@ -117,10 +348,16 @@ class MongoDBClient:
             # Check existing indexes
             existing_indexes = self.stats_collection.index_information()
             
-            # Create indexes if they don't exist
-            if "PlayerName_1" not in existing_indexes:
-                logger.info("Creating index on PlayerName field")
-                self.stats_collection.create_index([("PlayerName", ASCENDING)])
+            # One document per player: ingest upserts on PlayerName, so the index must be unique.
+            # Older deployments have a non-unique index and duplicate documents; dedupe before upgrading it.
+            player_index = existing_indexes.get("PlayerName_1")
+            if player_index is None or not player_index.get("unique"):
+                self._dedupe_players()
+                if player_index is not None:
+                    logger.info("Dropping non-unique index on PlayerName field")
+                    self.stats_collection.drop_index("PlayerName_1")
+                logger.info("Creating unique index on PlayerName field")
+                self.stats_collection.create_index([("PlayerName", ASCENDING)], unique=True)
             
             if "timestamp_-1" not in existing_indexes:
                 logger.info("Creating index on timestamp field")
@@ -133,48 +370,324 @@ class MongoDBClient:
                     ("PlayerName", ASCENDING), 
                     ("timestamp", DESCENDING)
                 ])
+            
+            # player_latest is keyed, sorted and paginated by PlayerName
+            latest_indexes = self.latest_collection.index_information()
+            if "PlayerName_1" not in latest_indexes:
+                logger.info("Creating unique index on player_latest.PlayerName")
+                self.latest_collection.create_index([("PlayerName", ASCENDING)], unique=True)
+            
+            # Account listing is sorted and keyset-paginated by username
+            account_indexes = self.db["roblox_accounts"].index_information()
+            if "username_1" not in account_indexes:
+                logger.info("Creating index on roblox_accounts.username")
+                self.db["roblox_accounts"].create_index([("username", ASCENDING)])
+            
+            # Range filters and sorts on the numeric fields, ordered by PlayerName within equal values
+            for field in SORT_FIELDS[1:]:
+                if f"{field}_1_PlayerName_1" not in latest_indexes:
+                    logger.info(f"Creating index on player_latest.{field}")
+                    self.latest_collection.create_index([(field, ASCENDING), ("PlayerName", ASCENDING)])
+            
+            # Case-insensitive name search: anchored prefix regexes on the lowercased name use this index
+            if "PlayerNameLower_1" not in latest_indexes:
+                logger.info("Creating index on player_latest.PlayerNameLower")
+                self.latest_collection.create_index([("PlayerNameLower", ASCENDING)])
+            
+            # Change feed: updates and deletes are read back in sequence order
+            if "seq_1" not in latest_indexes:
+                logger.info("Creating index on player_latest.seq")
+                self.latest_collection.create_index([("seq", ASCENDING)])
+            tombstones = self.db["player_tombstones"]
+            tombstone_indexes = tombstones.index_information()
+            if "PlayerName_1" not in tombstone_indexes:
+                tombstones.create_index([("PlayerName", ASCENDING)], unique=True)
+            if "seq_1" not in tombstone_indexes:
+                tombstones.create_index([("seq", ASCENDING)])
+            if "deleted_at_1" not in tombstone_indexes:
+                logger.info(f"Creating TTL index on player_tombstones ({CHANGES_RETENTION}s)")
+                tombstones.create_index([("deleted_at", ASCENDING)], expireAfterSeconds=CHANGES_RETENTION)
                 
             logger.info("MongoDB indexes verified")
         except Exception as e:
             logger.error(f"Failed to create indexes: {e}")
             raise
 
-def get_db():
-    """Get MongoDB client instance"""
-    db_client = MongoDBClient.get_instance()
-    if db_client.stats_collection is None:
-        # Try to reconnect
-        db_client._connect()
-        if db_client.stats_collection is None:
-            raise HTTPException(
-                status_code=503,
-                detail="Database connection unavailable"
+    def _dedupe_players(self):
+        """Migration: keep only the newest document per PlayerName, delete the rest"""
+        pipeline = [
+            {"$sort": {"timestamp": -1}},
+            {"$group": {"_id": "$PlayerName", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ]
+        
+        duplicate_ids = []
+        for group in self.stats_collection.aggregate(pipeline, allowDiskUse=True):
+            # ids are ordered newest first, keep the first one
+            duplicate_ids.extend(group["ids"][1:])
+        
+        if not duplicate_ids:
+            return 0
+        
+        logger.info(f"Removing {len(duplicate_ids)} duplicate player documents")
+        deleted = 0
+        batch_size = 1000
+        for i in range(0, len(duplicate_ids), batch_size):
+            result = self.stats_collection.delete_many({"_id": {"$in": duplicate_ids[i:i + batch_size]}})
+            deleted += result.deleted_count
+        
+        logger.info(f"Removed {deleted} duplicate player documents")
+        return deleted
+
+    def _ensure_history_collections(self):
+        """Create the history collections: raw time-series plus hourly/daily rollups"""
+        existing = set(self.db.list_collection_names())
+        
+        raw = self.db[HISTORY_COLLECTIONS["raw"]]
+        if raw.name not in existing:
+            try:
+                logger.info("Creating time-series collection for player history")
+                self.db.create_collection(
+                    raw.name,
+                    timeseries={"timeField": "timestamp", "metaField": "PlayerName", "granularity": "minutes"},
+                    expireAfterSeconds=HISTORY_RAW_TTL
+                )
+            except pymongo.errors.PyMongoError as e:
+                # Time-series collections need MongoDB 5.0+, fall back to a TTL-indexed collection
+                logger.warning(f"Time-series collection unavailable ({e}), using a regular collection")
+                raw.create_index([("timestamp", ASCENDING)], expireAfterSeconds=HISTORY_RAW_TTL)
+        raw.create_index([("PlayerName", ASCENDING), ("timestamp", ASCENDING)])
+        
+        # Rollups hold one point per player and bucket; hourly points expire, daily points are kept
+        for resolution in ("hour", "day"):
+            rollup = self.db[HISTORY_COLLECTIONS[resolution]]
+            rollup.create_index([("PlayerName", ASCENDING), ("timestamp", ASCENDING)], unique=True)
+        self.db[HISTORY_COLLECTIONS["hour"]].create_index(
+            [("timestamp", ASCENDING)], expireAfterSeconds=HISTORY_HOURLY_TTL
+        )
+    
+    def _backfill_latest(self):
+        """Migration: build player_latest from player_stats the first time it is used"""
+        if self.latest_collection.estimated_document_count() > 0:
+            return
+        if self.stats_collection.estimated_document_count() == 0:
+            return
+        
+        logger.info("Backfilling player_latest from player_stats")
+        self.stats_collection.aggregate([
+            {"$sort": {"timestamp": -1}},
+            {"$group": {"_id": "$PlayerName", "doc": {"$first": "$$ROOT"}}},
+            {"$replaceRoot": {"newRoot": "$doc"}},
+            {"$project": {"_id": 0}},
+            {"$merge": {
+                "into": "player_latest",
+                "on": "PlayerName",
+                "whenMatched": "keepExisting",
+                "whenNotMatched": "insert"
+            }}
+        ], allowDiskUse=True)
+        logger.info(f"player_latest backfilled with {self.latest_collection.estimated_document_count()} players")
+
+    def _backfill_derived_fields(self):
+        """Migration: compute DERIVED_FIELDS for documents written before they existed"""
+        for collection in (self.stats_collection, self.latest_collection):
+            result = collection.update_many(
+                {"TicketCount": {"$exists": False}},
+                [DERIVED_FIELDS_STAGE]
             )
-    return db_client
+            if result.modified_count:
+                logger.info(f"Backfilled derived fields on {result.modified_count} {collection.name} documents")
+        
+        result = self.latest_collection.update_many({"RankCounts": {"$exists": False}}, [RANK_COUNTS_STAGE])
+        if result.modified_count:
+            logger.info(f"Backfilled RankCounts on {result.modified_count} player_latest documents")
+        
+        result = self.latest_collection.update_many(
+            {"PlayerNameLower": {"$exists": False}},
+            [{"$set": {"PlayerNameLower": {"$toLower": "$PlayerName"}}}]
+        )
+        if result.modified_count:
+            logger.info(f"Backfilled PlayerNameLower on {result.modified_count} player_latest documents")
+
+def get_db():
+    """Get MongoDB client instance.
+
+    Declared as a plain function so FastAPI resolves it in its thread pool;
+    the (re)connect below is blocking.
+    """
+    try:
+        return MongoDBClient.get_instance()
+    except Exception:
+        # Nothing was published, the next request tries to connect again
+        raise HTTPException(
+            status_code=503,
+            detail="Database connection unavailable"
+        )
+
+@app.on_event("startup")
+async def connect_db():
+    """Connect and run the migrations before the background tasks below start reading.
+
+    Registered ahead of every other startup hook. If MongoDB is down the app
+    still starts; requests and background tasks retry through get_db.
+    """
+    try:
+        await run_db(get_db)
+    except HTTPException:
+        logger.error("MongoDB unavailable at startup, will retry on first use")
 
 # Data models
+# Models are strict: "123" is not an int and 1 is not a string or a bool.
+# Integers MongoDB can store (BSON int64); anything larger is rejected at validation
+BsonInt = Annotated[int, Field(ge=-2**63, le=2**63 - 1)]
+
+def whole_number(value):
+    """Roblox numbers are doubles; accept 5.0 where an integer is expected, but not 5.5"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
 class ItemInfo(BaseModel):
+    model_config = ConfigDict(extra="ignore", strict=True)
+    
     Name: str
-    Amount: int
+    Amount: BsonInt = 0
+    
+    whole_numbers = field_validator("Amount", mode="before")(whole_number)
 
 class PetInfo(BaseModel):
+    model_config = ConfigDict(extra="ignore", strict=True)
+    
     Name: str
-    Level: int
+    Level: BsonInt = 0
     Rank: str
-    RankNum: int
+    RankNum: BsonInt
     FolderName: str
+    
+    whole_numbers = field_validator("Level", "RankNum", mode="before")(whole_number)
+
+class PassInfo(BaseModel):
+    model_config = ConfigDict(extra="ignore", strict=True)
+    
+    Name: str
+    Owned: bool = True
 
 class StatsData(BaseModel):
-    PlayerName: str
-    Cash: int
-    FormattedCash: str
-    Gems: int
-    FormattedGems: str
-    PetCount: int
-    PetsList: List[Dict[str, Any]]
-    ItemsList: List[Dict[str, Any]]
-    PassesList: List[Dict[str, Any]]
-    timestamp: Optional[datetime] = None
+    """Validated /ac_stats payload; unknown fields are dropped"""
+    model_config = ConfigDict(extra="ignore", strict=True)
+    
+    PlayerName: str = Field(min_length=1)
+    Cash: BsonInt
+    FormattedCash: Optional[str] = None
+    Gems: BsonInt
+    FormattedGems: Optional[str] = None
+    PetCount: BsonInt
+    PetsList: List[PetInfo]
+    ItemsList: List[ItemInfo]
+    PassesList: List[PassInfo] = []
+    # JSON has no datetime type, so ISO 8601 strings are still parsed here
+    timestamp: Optional[datetime] = Field(None, strict=False)
+    
+    whole_numbers = field_validator("PetCount", mode="before")(whole_number)
+    
+    @field_validator("Cash", "Gems", mode="before")
+    @classmethod
+    def floor_currency(cls, value):
+        # Roblox numbers are doubles; drop any fractional part like formatNumber does
+        # (inf/nan are left for the int validation to reject)
+        if isinstance(value, float) and math.isfinite(value):
+            return math.floor(value)
+        return value
+    
+    @field_validator("PetsList", "ItemsList", "PassesList", mode="before")
+    @classmethod
+    def null_list(cls, value):
+        # Đảm bảo các trường dữ liệu không bị null
+        return [] if value is None else value
+
+# Fields written to a player's document on every stats update
+STATS_FIELDS = [
+    "Cash", "FormattedCash", "Gems", "FormattedGems", "PetCount",
+    "PetsList", "ItemsList", "PassesList", "timestamp",
+    "TicketCount", "SRankPets", "SSRankPets", "PassCount", "RankCounts",
+    "PetsHash", "ItemsHash", "PassesHash"
+]
+
+# Content hash stored next to each list; an unchanged hash means the list is left out of the write
+LIST_HASH_FIELDS = {"PetsList": "PetsHash", "ItemsList": "ItemsHash", "PassesList": "PassesHash"}
+
+# How list entries are matched between snapshots, and where their deltas go in history
+LIST_DELTA_KEYS = {"PetsList": "FolderName", "ItemsList": "Name", "PassesList": "Name"}
+LIST_DELTA_FIELDS = {"PetsList": "PetsDelta", "ItemsList": "ItemsDelta", "PassesList": "PassesDelta"}
+
+# Scalar fields derived from the item/pet/pass lists at write time so filters can use indexes
+DERIVED_FIELDS = ["TicketCount", "SRankPets", "SSRankPets", "PassCount"]
+
+# Fields the /api/latest filters query; each gets a (field, PlayerName) index on player_latest
+FILTER_FIELDS = ["Cash", "Gems"] + DERIVED_FIELDS
+
+# Fields /api/latest can sort by. Ties are broken by PlayerName, so every field
+# other than PlayerName itself needs a (field, PlayerName) index as well
+SORT_FIELDS = ["PlayerName", "PetCount", "timestamp"] + FILTER_FIELDS
+
+# Same derivation as derive_stats_fields, as an update pipeline stage for backfilling
+DERIVED_FIELDS_STAGE = {"$set": {
+    "TicketCount": {"$ifNull": [
+        {"$arrayElemAt": [
+            {"$map": {
+                "input": {"$filter": {
+                    "input": {"$ifNull": ["$ItemsList", []]},
+                    "as": "item",
+                    "cond": {"$eq": ["$$item.Name", "Ticket"]}
+                }},
+                "as": "item",
+                "in": "$$item.Amount"
+            }},
+            0
+        ]},
+        0
+    ]},
+    "SRankPets": {"$size": {"$filter": {
+        "input": {"$ifNull": ["$PetsList", []]},
+        "as": "pet",
+        "cond": {"$eq": ["$$pet.Rank", "S"]}
+    }}},
+    "SSRankPets": {"$size": {"$filter": {
+        "input": {"$ifNull": ["$PetsList", []]},
+        "as": "pet",
+        "cond": {"$in": ["$$pet.Rank", ["SS", "G"]]}
+    }}},
+    "PassCount": {"$size": {"$ifNull": ["$PassesList", []]}}
+}}
+
+# Pets per rank letter ({"S": 3, "SS": 1, ...}), same as rank_counts, for backfilling
+RANK_COUNTS_STAGE = {"$set": {"RankCounts": {"$arrayToObject": {"$map": {
+    "input": {"$setUnion": [{"$filter": {
+        "input": {"$ifNull": ["$PetsList.Rank", []]},
+        "as": "rank",
+        "cond": {"$eq": [{"$type": "$$rank"}, "string"]}
+    }}]},
+    "as": "rank",
+    "in": {"k": "$$rank", "v": {"$size": {"$filter": {
+        "input": "$PetsList",
+        "as": "pet",
+        "cond": {"$eq": ["$$pet.Rank", "$$rank"]}
+    }}}}
+}}}}}
+
+# Fleet-wide running totals for /api/analytics, kept in one analytics document
+ANALYTICS_SUM_FIELDS = ["Cash", "Gems", "PetCount"] + DERIVED_FIELDS
+ANALYTICS_HISTOGRAM_FIELDS = ["Cash", "Gems", "TicketCount"]
+ANALYTICS_PROJECTION = {"_id": 0, "PlayerName": 1, "RankCounts": 1, **{field: 1 for field in ANALYTICS_SUM_FIELDS}}
+
+# Compact per-snapshot fields kept in history (no pet/item/pass lists)
+HISTORY_FIELDS = ["Cash", "Gems", "PetCount"] + DERIVED_FIELDS
+
+HISTORY_COLLECTIONS = {
+    "raw": "player_history",
+    "hour": "player_history_hourly",
+    "day": "player_history_daily"
+}
 
 # Simple in-memory user database
 USERS = {
@@ -184,42 +697,662 @@ USERS = {
     }
 }
 
-# Simple session management
-sessions = {}
+class CacheBackend(ABC):
+    """Interface shared by the response cache implementations.
+
+    Values must be JSON serializable. Entries are stored with the generations
+    of their invalidation tags, taken with ``generations`` before the data was
+    read; bumping a tag with ``bump`` makes those entries stale (see ResponseCache).
+    Backends whose methods block on I/O set ``blocking`` and are called off the
+    event loop (see run_cache).
+    """
+    blocking = False
+    
+    @abstractmethod
+    def get(self, key):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def set(self, key, data, expiry_seconds, tag_generations=None):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def delete_prefix(self, key_prefix):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def clear(self):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def sweep(self):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def generation(self, tag):
+        raise NotImplementedError
+    
+    def generations(self, tags):
+        """Current generation of each tag, to pass to ``set``"""
+        return {tag: self.generation(tag) for tag in tags}
+    
+    def versions(self, tags):
+        """(generation, modified_at) of each tag, for HTTP validators"""
+        return [(self.generation(tag), self.modified_at(tag)) for tag in tags]
+    
+    @abstractmethod
+    def bump(self, tag, min_interval=0):
+        raise NotImplementedError
+    
+    def bump_many(self, tags):
+        """Unconditionally bump several tags at once"""
+        for tag in tags:
+            self.bump(tag)
+    
+    @abstractmethod
+    def modified_at(self, tag):
+        """Unix time of the last applied bump of tag.
+
+        Tags never bumped, or forgotten by ``sweep``, report the cache
+        creation time or the newest forgotten bump, whichever is later.
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    def stats(self):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def keys(self):
+        raise NotImplementedError
+
+class ResponseCache(CacheBackend):
+    """Bounded in-memory TTL cache with LRU eviction.
+
+    Limits both the number of entries and their approximate serialized size
+    (measured once, when an entry is stored). Expired entries are dropped on
+    read and by ``sweep``, which runs periodically in the background.
+
+    Entries can be stored under tags. Each tag has a generation counter and an
+    entry remembers the generations it was built from; bumping a tag makes all
+    of its entries stale in O(1) without touching them. ``sweep`` forgets tags
+    that no entry refers to once their last bump is ``generation_ttl`` old.
+    """
+    def __init__(self, max_entries, max_bytes, generation_ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation_ttl = generation_ttl
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._generations = {}
+        self._bumped_at = {}
+        self._modified_at = {}
+        self._pending_bumps = {}
+        self._pruned_at = 0
+        # Generations restart at 0 with the process; the epoch keeps ETags from colliding
+        self.epoch = secrets.token_hex(4)
+        self.created_at = time.time()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if datetime.now() >= entry["expires"]:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        if not self._is_current(entry):
+            self._remove(key)
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry["data"]
+    
+    def set(self, key, data, expiry_seconds, tag_generations=None):
+        size = len(orjson.dumps(data, default=str))
+        if size > self.max_bytes:
+            logger.debug(f"Not caching {key}: {size} bytes exceeds the cache size limit")
+            return
+        
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = {
+            "data": data,
+            "expires": datetime.now() + timedelta(seconds=expiry_seconds),
+            "size": size,
+            "tags": dict(tag_generations or {})
+        }
+        self.total_bytes += size
+        
+        # Evict least recently used entries until both limits hold
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+    
+    def delete_prefix(self, key_prefix):
+        keys_to_remove = [k for k in self._entries if k.startswith(key_prefix)]
+        for k in keys_to_remove:
+            self._remove(k)
+        return len(keys_to_remove)
+    
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+    
+    def sweep(self):
+        """Drop every expired or invalidated entry"""
+        now = datetime.now()
+        expired = [k for k, entry in self._entries.items()
+                   if now >= entry["expires"] or not self._is_current(entry)]
+        for k in expired:
+            self._remove(k)
+        self.expirations += len(expired)
+        
+        # Per-player tags would otherwise accumulate forever
+        referenced = {tag for entry in self._entries.values() for tag in entry["tags"]}
+        cutoff = time.monotonic() - self.generation_ttl
+        forgotten = [tag for tag, bumped_at in self._bumped_at.items()
+                     if bumped_at < cutoff and tag not in referenced and tag not in self._pending_bumps]
+        for tag in forgotten:
+            self._pruned_at = max(self._pruned_at, self._modified_at.pop(tag))
+            del self._generations[tag], self._bumped_at[tag]
+        return len(expired)
+    
+    def generation(self, tag):
+        """Current generation of tag, applying a rate-limited bump once it is due"""
+        min_interval = self._pending_bumps.get(tag)
+        if min_interval is not None and time.monotonic() - self._bumped_at[tag] >= min_interval:
+            self.bump(tag)
+        return self._generations.get(tag, 0)
+    
+    def bump(self, tag, min_interval=0):
+        """Invalidate every entry stored under tag.
+
+        With min_interval, bumps closer together than that many seconds are
+        coalesced: the bump is deferred and applied by the first generation
+        lookup after the interval, so readers are never staler than that.
+        """
+        now = time.monotonic()
+        if min_interval and now - self._bumped_at.get(tag, float("-inf")) < min_interval:
+            self._pending_bumps[tag] = min_interval
+            return False
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+        self._bumped_at[tag] = now
+        self._modified_at[tag] = time.time()
+        self._pending_bumps.pop(tag, None)
+        return True
+    
+    def modified_at(self, tag):
+        self.generation(tag)
+        return self._modified_at.get(tag, max(self.created_at, self._pruned_at))
+    
+    def _is_current(self, entry):
+        return all(self.generation(tag) == gen for tag, gen in entry["tags"].items())
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "size_bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "generations": len(self._generations)
+        }
+    
+    def keys(self):
+        return list(self._entries.keys())
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry["size"]
+
+class SQLiteStore:
+    """Base for state kept in a local SQLite file so all workers on one host share it"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+    
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+    
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+class SQLiteResponseCache(SQLiteStore, CacheBackend):
+    """Cross-worker ResponseCache backed by SQLite.
+
+    Same semantics as the in-memory cache: TTL, LRU eviction by entry count
+    and bytes (via an access timestamp), tag generations with rate-limited
+    bumps and pruning, and hit/miss/eviction counters, all visible to every worker.
+
+    A hit is a single SELECT: access times and counters are kept in process
+    and written out by the next ``set`` or ``sweep``, so LRU order and stats
+    can lag by up to CACHE_SWEEP_INTERVAL.
+    """
+    blocking = True
+    
+    def __init__(self, path, max_entries, max_bytes, generation_ttl):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation_ttl = generation_ttl
+        self._accessed = {}
+        self._counters = {}
+        with self._lock:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY, data TEXT, expires REAL, size INTEGER, tags TEXT, accessed REAL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed)")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS cache_generations (
+                tag TEXT PRIMARY KEY, generation INTEGER, bumped_at REAL, pending_interval REAL)""")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache_counters (name TEXT PRIMARY KEY, value INTEGER)")
+            # Epoch and creation time live with the generations, so every worker agrees on them
+            self._conn.execute(
+                "INSERT OR IGNORE INTO cache_counters (name, value) VALUES ('epoch', ?), ('created_at', ?)",
+                (secrets.randbits(32), int(time.time()))
+            )
+        counters = dict(self._query("SELECT name, value FROM cache_counters WHERE name IN ('epoch', 'created_at')"))
+        self.epoch = format(counters["epoch"], "08x")
+        self.created_at = counters["created_at"]
+    
+    def get(self, key):
+        rows = self._query("SELECT data, expires, tags FROM cache_entries WHERE key = ?", (key,))
+        if not rows:
+            self._count("misses")
+            return None
+        
+        data, expires, tags = rows[0]
+        if time.time() >= expires:
+            self._execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            self._count("expirations")
+            self._count("misses")
+            return None
+        if not self._is_current(json.loads(tags)):
+            self._execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            self._count("invalidations")
+            self._count("misses")
+            return None
+        
+        with self._lock:
+            self._accessed[key] = time.time()
+        self._count("hits")
+        return json.loads(data)
+    
+    def set(self, key, data, expiry_seconds, tag_generations=None):
+        payload = json.dumps(data, default=str)
+        size = len(payload)
+        if size > self.max_bytes:
+            logger.debug(f"Not caching {key}: {size} bytes exceeds the cache size limit")
+            return
+        
+        tag_generations = json.dumps(tag_generations or {})
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (key, data, expires, size, tags, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, payload, now + expiry_seconds, size, tag_generations, now)
+                )
+                self._accessed.pop(key, None)
+                self._flush_local()
+                self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def _evict(self):
+        """Drop least recently used entries until both limits hold (caller holds the transaction)"""
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        
+        victims = []
+        for victim_key, victim_size in self._conn.execute("SELECT key, size FROM cache_entries ORDER BY accessed"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append((victim_key,))
+            count -= 1
+            total -= victim_size
+        self._conn.executemany("DELETE FROM cache_entries WHERE key = ?", victims)
+        self._count("evictions", len(victims))
+    
+    def delete_prefix(self, key_prefix):
+        return self._execute(
+            "DELETE FROM cache_entries WHERE substr(key, 1, ?) = ?",
+            (len(key_prefix), key_prefix)
+        )
+    
+    def clear(self):
+        self._execute("DELETE FROM cache_entries")
+    
+    def sweep(self):
+        """Drop every expired or invalidated entry, then forget tags nothing refers to"""
+        now = time.time()
+        removed = self._execute("DELETE FROM cache_entries WHERE expires <= ?", (now,))
+        stale = []
+        referenced = set()
+        for key, tags in self._query("SELECT key, tags FROM cache_entries WHERE tags != '{}'"):
+            tag_generations = json.loads(tags)
+            if self._is_current(tag_generations):
+                referenced.update(tag_generations)
+            else:
+                stale.append((key,))
+        self._count("expirations", removed + len(stale))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("DELETE FROM cache_entries WHERE key = ?", stale)
+                self._flush_local()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        
+        forgotten = [
+            (tag, bumped_at) for tag, bumped_at in self._query(
+                "SELECT tag, bumped_at FROM cache_generations WHERE bumped_at < ? AND pending_interval IS NULL",
+                (now - self.generation_ttl,)
+            )
+            if tag not in referenced
+        ]
+        if forgotten:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.executemany(
+                        "DELETE FROM cache_generations WHERE tag = ? AND bumped_at = ?", forgotten
+                    )
+                    self._conn.execute(
+                        "INSERT INTO cache_counters (name, value) VALUES ('pruned_at', ?) "
+                        "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+                        (math.ceil(max(bumped_at for _, bumped_at in forgotten)),)
+                    )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        return removed + len(stale)
+    
+    def generation(self, tag):
+        rows = self._query(
+            "SELECT generation, bumped_at, pending_interval FROM cache_generations WHERE tag = ?", (tag,)
+        )
+        if not rows:
+            return 0
+        generation, bumped_at, pending_interval = rows[0]
+        if pending_interval is not None and time.time() - bumped_at >= pending_interval:
+            self.bump(tag)
+            return self.generation(tag)
+        return generation
+    
+    def bump(self, tag, min_interval=0):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT bumped_at FROM cache_generations WHERE tag = ?", (tag,)
+                ).fetchone()
+                if min_interval and row is not None and now - row[0] < min_interval:
+                    self._conn.execute(
+                        "UPDATE cache_generations SET pending_interval = ? WHERE tag = ?", (min_interval, tag)
+                    )
+                    bumped = False
+                else:
+                    self._conn.execute(
+                        "INSERT INTO cache_generations (tag, generation, bumped_at, pending_interval) "
+                        "VALUES (?, 1, ?, NULL) ON CONFLICT(tag) DO UPDATE SET "
+                        "generation = generation + 1, bumped_at = excluded.bumped_at, pending_interval = NULL",
+                        (tag, now)
+                    )
+                    bumped = True
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return bumped
+    
+    def bump_many(self, tags):
+        """Bump every tag in a single transaction"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO cache_generations (tag, generation, bumped_at, pending_interval) "
+                    "VALUES (?, 1, ?, NULL) ON CONFLICT(tag) DO UPDATE SET "
+                    "generation = generation + 1, bumped_at = excluded.bumped_at, pending_interval = NULL",
+                    [(tag, now) for tag in tags]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def stats(self):
+        counters = dict(self._query(
+            "SELECT name, value FROM cache_counters WHERE name NOT IN ('epoch', 'created_at', 'pruned_at')"
+        ))
+        with self._lock:
+            for name, amount in self._counters.items():
+                counters[name] = counters.get(name, 0) + amount
+        count, total = self._query("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries")[0]
+        generations = self._query("SELECT COUNT(*) FROM cache_generations")[0][0]
+        hits = counters.get("hits", 0)
+        lookups = hits + counters.get("misses", 0)
+        return {
+            "backend": "sqlite",
+            "entries": count,
+            "size_bytes": total,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": counters.get("misses", 0),
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "evictions": counters.get("evictions", 0),
+            "expirations": counters.get("expirations", 0),
+            "invalidations": counters.get("invalidations", 0),
+            "generations": generations
+        }
+    
+    def modified_at(self, tag):
+        self.generation(tag)
+        rows = self._query("SELECT bumped_at FROM cache_generations WHERE tag = ?", (tag,))
+        if rows:
+            return rows[0][0]
+        pruned = self._query("SELECT value FROM cache_counters WHERE name = 'pruned_at'")
+        return max(self.created_at, pruned[0][0] if pruned else 0)
+    
+    def keys(self):
+        return [row[0] for row in self._query("SELECT key FROM cache_entries ORDER BY accessed")]
+    
+    def _is_current(self, tag_generations):
+        return all(self.generation(tag) == gen for tag, gen in tag_generations.items())
+    
+    def _count(self, name, amount=1):
+        if amount:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + amount
+    
+    def _flush_local(self):
+        """Write buffered access times and counters (caller holds the lock and a transaction)"""
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE cache_entries SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()]
+            )
+            self._accessed.clear()
+        if self._counters:
+            self._conn.executemany(
+                "INSERT INTO cache_counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                list(self._counters.items())
+            )
+            self._counters.clear()
+
+class SQLiteSessionStore(SQLiteStore):
+    """Login sessions shared by all workers; supports the dict operations the handlers use"""
+    def __init__(self, path):
+        super().__init__(path)
+        self._execute("CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, data TEXT, created REAL)")
+    
+    def __contains__(self, token):
+        return bool(self._query("SELECT 1 FROM sessions WHERE token = ?", (token,)))
+    
+    def __getitem__(self, token):
+        rows = self._query("SELECT data FROM sessions WHERE token = ?", (token,))
+        if not rows:
+            raise KeyError(token)
+        return json.loads(rows[0][0])
+    
+    def __setitem__(self, token, data):
+        self._execute(
+            "INSERT OR REPLACE INTO sessions (token, data, created) VALUES (?, ?, ?)",
+            (token, json.dumps(data), time.time())
+        )
+    
+    def __delitem__(self, token):
+        if not self._execute("DELETE FROM sessions WHERE token = ?", (token,)):
+            raise KeyError(token)
+
+# Response cache and session management
+if CACHE_BACKEND == "sqlite":
+    logger.info(f"Using shared SQLite cache and session store at {CACHE_SQLITE_PATH}")
+    cache = SQLiteResponseCache(CACHE_SQLITE_PATH, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_EXPIRY)
+    sessions = SQLiteSessionStore(CACHE_SQLITE_PATH)
+else:
+    cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_EXPIRY)
+    sessions = {}
 
 # Server-side cache functions
-def cache_get(key):
+async def run_cache(func, *args):
+    """Call a cache backend method, on the cache thread pool if the backend blocks"""
+    if not cache.blocking:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cache_executor, partial(func, *args))
+
+async def cache_get(key):
     """Get data from cache if it exists and is not expired"""
-    if key in cache:
-        entry = cache[key]
-        if datetime.now() < entry['expires']:
-            logger.debug(f"Cache hit for {key}")
-            return entry['data']
-    logger.debug(f"Cache miss for {key}")
-    return None
+    data = await run_cache(cache.get, key)
+    if data is None:
+        logger.debug(f"Cache miss for {key}")
+    else:
+        logger.debug(f"Cache hit for {key}")
+    return data
 
-def cache_set(key, data, expiry_seconds=CACHE_EXPIRY):
-    """Store data in cache with expiration time"""
-    cache[key] = {
-        'data': data,
-        'expires': datetime.now() + timedelta(seconds=expiry_seconds)
-    }
+async def cache_generations(tags):
+    """Snapshot of the tags' generations; take it before reading the data to cache"""
+    return await run_cache(cache.generations, tags)
+
+async def cache_set(key, data, expiry_seconds=CACHE_EXPIRY, tags=None):
+    """Store data in cache with expiration time.
+
+    tags is a cache_generations() snapshot taken before the data was read, so
+    an invalidation that lands during the read leaves the entry already stale.
+    """
+    await run_cache(cache.set, key, data, expiry_seconds, tags)
     logger.debug(f"Cached {key} for {expiry_seconds} seconds")
 
-def cache_invalidate(key_prefix=None):
+async def cache_invalidate_tag(tag, min_interval=0):
+    """Invalidate every entry cached under tag in constant time"""
+    if await run_cache(cache.bump, tag, min_interval):
+        logger.debug(f"Invalidated cache tag {tag}")
+
+async def cache_invalidate_tags(tags):
+    """Invalidate several tags with one backend call"""
+    tags = list(tags)
+    await run_cache(cache.bump_many, tags)
+    logger.debug(f"Invalidated {len(tags)} cache tags")
+
+async def conditional_get(request, response, tags):
+    """Validators for a response built only from data cached under tags.
+
+    The ETag comes from the tags' generations and modification times, so it
+    changes exactly when the cached responses would be invalidated. Returns
+    a 304 Response when the client's If-None-Match / If-Modified-Since is
+    still current; otherwise sets ETag and Last-Modified on response and
+    returns None.
+    """
+    # Modification times keep a pruned tag (back at generation 0) from reusing an old ETag
+    versions = await run_cache(cache.versions, tags)
+    version = f"{app.version}|{cache.epoch}|{versions}|{request.url.path}?{request.url.query}"
+    etag = f'"{hashlib.sha1(version.encode("utf-8")).hexdigest()[:24]}"'
+    modified = max(modified_at for _, modified_at in versions)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(modified, usegmt=True),
+        # Always revalidate, but let the browser keep the body for 304s
+        "Cache-Control": "private, no-cache"
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]
+    elif if_modified_since:
+        try:
+            not_modified = int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return None
+
+async def cache_invalidate(key_prefix=None):
     """Invalidate specific cache entries or all if no prefix provided"""
-    global cache
     if key_prefix:
         # Delete keys that start with the prefix
-        keys_to_remove = [k for k in cache.keys() if k.startswith(key_prefix)]
-        for k in keys_to_remove:
-            del cache[k]
-        logger.debug(f"Invalidated {len(keys_to_remove)} cache entries with prefix {key_prefix}")
+        removed = await run_cache(cache.delete_prefix, key_prefix)
+        logger.debug(f"Invalidated {removed} cache entries with prefix {key_prefix}")
     else:
         # Clear all cache
-        cache = {}
+        await run_cache(cache.clear)
         logger.debug("Cleared entire cache")
 
+async def sweep_cache_periodically():
+    """Background task: evict expired cache entries even if nobody reads them again"""
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        removed = await run_cache(cache.sweep)
+        if removed:
+            logger.debug(f"Swept {removed} expired cache entries")
+
+@app.on_event("startup")
+async def start_cache_sweeper():
+    asyncio.create_task(sweep_cache_periodically())
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Render the login page."""
@@ -285,85 +1418,1667 @@ async def logout(session: str = Cookie(None)):
     response.delete_cookie(key="session")
     return response
 
-@app.post("/ac_stats")
-async def update_stats(stats_data: dict, db_client = Depends(get_db)):
-    """Update player stats from game."""
+def prepare_stats(payload):
+    """Validate an /ac_stats payload and fill in defaults.
+
+    Returns (stats_data, None) for a valid payload and (None, error message)
+    otherwise.
+    """
     try:
-        # Validate required fields
-        required_fields = ["PlayerName", "Cash", "Gems", "PetCount", "PetsList", "ItemsList"]
-        for field in required_fields:
-            if field not in stats_data:
-                logger.warning(f"Missing required field: {field}")
-                return {"success": False, "error": f"Missing required field: {field}"}
-                
-        # Add timestamp if not provided
-        if "timestamp" not in stats_data:
-            stats_data["timestamp"] = datetime.utcnow()
+        stats = StatsData.model_validate(payload)
+    except ValidationError as e:
+        error = e.errors()[0]
+        field = ".".join(str(part) for part in error["loc"])
+        if error["type"] == "missing":
+            message = f"Missing required field: {field}"
+        else:
+            message = f"Invalid field {field}: {error['msg']}"
+        logger.warning(message)
+        return None, message
+    
+    stats_data = stats.model_dump()
+    
+    # Add timestamp if not provided
+    if stats_data["timestamp"] is None:
+        stats_data["timestamp"] = datetime.utcnow()
+    else:
+        # Stored timestamps are naive UTC; "...Z" or "+07:00" inputs are converted
+        stats_data["timestamp"] = to_naive_utc(stats_data["timestamp"])
+    
+    # Display strings are derived server-side when the client leaves them out
+    if stats_data["FormattedCash"] is None:
+        stats_data["FormattedCash"] = format_number(stats_data["Cash"])
+    if stats_data["FormattedGems"] is None:
+        stats_data["FormattedGems"] = format_number(stats_data["Gems"])
+    
+    derive_stats_fields(stats_data)
+    for list_field, hash_field in LIST_HASH_FIELDS.items():
+        stats_data[hash_field] = content_hash(stats_data[list_field])
+    return stats_data, None
+
+def content_hash(value):
+    """Stable hash of a JSON-like value, independent of dict key order"""
+    return hashlib.sha1(orjson.dumps(value, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
+
+def keyed_entries(entries, key_field):
+    """Map list entries by key_field (or their content), numbering duplicates so nothing collapses"""
+    keyed = {}
+    seen = {}
+    for entry in entries:
+        base = entry.get(key_field) if isinstance(entry, dict) else None
+        if base is None:
+            base = json.dumps(entry, sort_keys=True, default=str)
+        seen[base] = seen.get(base, 0) + 1
+        keyed[f"{base}#{seen[base]}"] = entry
+    return keyed
+
+def diff_entries(old_entries, new_entries, key_field):
+    """Delta between two lists: entries added (new or changed) and removed (gone or replaced)"""
+    old_keyed = keyed_entries(old_entries, key_field)
+    new_keyed = keyed_entries(new_entries, key_field)
+    return {
+        "added": [entry for key, entry in new_keyed.items() if old_keyed.get(key) != entry],
+        "removed": [entry for key, entry in old_keyed.items() if new_keyed.get(key) != entry]
+    }
+
+def revert_entries(entries, delta):
+    """Undo a diff_entries delta, turning the newer list back into the older one"""
+    reverted = list(entries)
+    for entry in delta["added"]:
+        if entry in reverted:
+            reverted.remove(entry)
+    reverted.extend(delta["removed"])
+    return reverted
+
+def derive_stats_fields(stats_data):
+    """Compute the scalar filter fields (DERIVED_FIELDS) from the item, pet and pass lists"""
+    stats_data["TicketCount"] = next(
+        (item.get("Amount", 0) for item in stats_data["ItemsList"] if item.get("Name") == "Ticket"),
+        0
+    )
+    stats_data["SRankPets"] = sum(1 for pet in stats_data["PetsList"] if pet.get("Rank") == "S")
+    stats_data["SSRankPets"] = sum(1 for pet in stats_data["PetsList"] if pet.get("Rank") in ("SS", "G"))
+    stats_data["PassCount"] = len(stats_data["PassesList"])
+    stats_data["RankCounts"] = rank_counts(stats_data["PetsList"])
+
+def rank_counts(pets):
+    """Number of pets per rank letter"""
+    counts = {}
+    for pet in pets:
+        rank = pet.get("Rank")
+        if isinstance(rank, str):
+            counts[rank] = counts.get(rank, 0) + 1
+    return counts
+
+def stats_changes(stats_data, stored):
+    """Fields of stats_data to $set over the stored document, and the lists left out as unchanged"""
+    unchanged = [
+        list_field for list_field, hash_field in LIST_HASH_FIELDS.items()
+        if stored.get(hash_field) == stats_data[hash_field]
+    ]
+    changes = {
+        field: stats_data[field] for field in STATS_FIELDS
+        if field in stats_data and field not in unchanged
+    }
+    return changes, unchanged
+
+async def read_latest_versions(db_client, player_names):
+    """Stored player_latest version (seq), analytics fields and list hashes of each player"""
+    projection = {**ANALYTICS_PROJECTION, "seq": 1, **{hash_field: 1 for hash_field in LIST_HASH_FIELDS.values()}}
+    return {
+        doc["PlayerName"]: doc
+        for doc in await db_client.latest.find({"PlayerName": {"$in": list(player_names)}}, projection)
+    }
+
+async def write_latest(db_client, stats_list, previous):
+    """Conditional bulk upsert of player_latest.
+
+    Each update only matches the version (seq) of the document read into
+    previous, so the analytics delta is taken against exactly the document it
+    replaces. A player rewritten in between (by another flush, the batch
+    endpoint or another worker) makes its upsert collide on the unique
+    PlayerName index, and one deleted in between matches nothing; those
+    players are re-read and retried up to LATEST_WRITE_ATTEMPTS times. Every
+    attempt is stamped with fresh change sequence numbers (see
+    stamped_bulk_write). Returns ({first seq of an attempt: analytics $inc of
+    the writes it applied}, players not written, WriteDeferred or None) so a
+    write deferred after earlier attempts succeeded still reports their deltas.
+    """
+    incs = {}
+    pending = stats_list
+    for attempt in range(LATEST_WRITE_ATTEMPTS):
+        assigned = {}
+        
+        def build_operations(first_seq, updated_at):
+            operations = []
+            for seq, stats_data in enumerate(pending, start=first_seq):
+                player_name = stats_data["PlayerName"]
+                assigned[player_name] = seq
+                stored = previous.get(player_name, {})
+                changes, _ = stats_changes(stats_data, stored)
+                operations.append(pymongo.UpdateOne(
+                    # seq None also matches documents written before seq existed
+                    {"PlayerName": player_name, "seq": stored.get("seq")},
+                    {
+                        "$set": {**changes, "seq": seq, "updated_at": updated_at},
+                        "$setOnInsert": {"PlayerNameLower": player_name.lower()}
+                    },
+                    # A player deleted since it was read must not come back from its old version
+                    upsert=player_name not in previous
+                ))
+            return operations
+        
+        conflicts = set()
+        try:
+            result = await stamped_bulk_write(db_client, db_client.latest, build_operations, len(pending), pausable=True)
+            written = result.matched_count + result.upserted_count
+        except WriteDeferred as e:
+            return incs, [stats_data["PlayerName"] for stats_data in pending], e
+        except pymongo.errors.BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            conflicts = {pending[error["index"]]["PlayerName"] for error in errors}
+            written = e.details.get("nMatched", 0) + e.details.get("nUpserted", 0)
+        if written < len(pending) - len(conflicts):
+            # Some updates matched nothing: find out which players don't carry their new seq
+            current = await read_latest_versions(db_client, [name for name in assigned if name not in conflicts])
+            conflicts.update(
+                name for name, seq in assigned.items()
+                if name not in conflicts and current.get(name, {}).get("seq") != seq
+            )
+        
+        inc = incs.setdefault(min(assigned.values()), {})
+        for stats_data in pending:
+            if stats_data["PlayerName"] in conflicts:
+                continue
+            add_analytics_delta(inc, stats_data, 1)
+            if stats_data["PlayerName"] in previous:
+                add_analytics_delta(inc, previous[stats_data["PlayerName"]], -1)
+        if not conflicts:
+            return incs, [], None
+        
+        pending = [stats_data for stats_data in pending if stats_data["PlayerName"] in conflicts]
+        current = await read_latest_versions(db_client, conflicts)
+        for player_name in conflicts:
+            previous.pop(player_name, None)
+        previous.update(current)
+    return incs, [stats_data["PlayerName"] for stats_data in pending], None
+
+async def persist_stats(db_client, stats_list):
+    """Upsert a batch of player stats into player_stats and player_latest.
+
+    Each collection gets a single bulk_write. Upserts are keyed on the unique
+    PlayerName index, so callers must pass at most one document per player.
+    Lists whose content hash matches the stored one are left out of the
+    update; with history enabled, changed lists are recorded as deltas.
+    Every player_latest write gets a fresh change sequence number (seq), and
+    the analytics totals move by exactly what the conditional player_latest
+    writes replaced (see write_latest).
+    """
+    previous = await read_latest_versions(db_client, [stats_data["PlayerName"] for stats_data in stats_list])
+    
+    operations = []
+    changed_lists = {}
+    for stats_data in stats_list:
+        stored = previous.get(stats_data["PlayerName"], {})
+        changes, unchanged = stats_changes(stats_data, stored)
+        if stored and len(unchanged) < len(LIST_HASH_FIELDS):
+            changed_lists[stats_data["PlayerName"]] = [f for f in LIST_HASH_FIELDS if f not in unchanged]
+        operations.append(pymongo.UpdateOne({"PlayerName": stats_data["PlayerName"]}, {"$set": changes}, upsert=True))
+    
+    writes = [
+        db_client.stats.bulk_write(operations, ordered=False),
+        write_latest(db_client, stats_list, dict(previous))
+    ]
+    if db_client.history is not None:
+        deltas = await list_deltas(db_client, stats_list, changed_lists)
+        writes.extend(history_writes(db_client, stats_list, deltas))
+    results = await asyncio.gather(*writes, return_exceptions=True)
+    
+    # Whatever reached player_latest is counted, even if another write failed
+    if not isinstance(results[1], BaseException):
+        await apply_analytics_incs(db_client, results[1][0])
+    for outcome in results:
+        if isinstance(outcome, BaseException):
+            raise outcome
+    result, (_, conflicting, deferred) = results[0], results[1]
+    if deferred:
+        raise deferred
+    if conflicting:
+        raise RuntimeError(f"player_latest kept changing for {', '.join(conflicting)}")
+    
+    # Invalidate cache for the updated players; list-wide tags are rate limited under steady ingest
+    await cache_invalidate_tags(f"player:{stats_data['PlayerName']}" for stats_data in stats_list)
+    await cache_invalidate_tag("latest", CACHE_INVALIDATION_INTERVAL)
+    if result.upserted_count:
+        await cache_invalidate_tag("roster", CACHE_INVALIDATION_INTERVAL)
+    publish_player_updates(stats_list)
+    if name_index.loaded:
+        for stats_data in stats_list:
+            name_index.add(stats_data["PlayerName"])
+    if COLUMNAR_ENABLED:
+        for stats_data in stats_list:
+            columnar_latest.upsert(stats_data)
+    
+    return result
+
+def magnitude_bucket(value):
+    """Histogram bucket of a value: its number of integer digits, "0" below 1"""
+    return str(len(str(int(value)))) if value >= 1 else "0"
+
+def add_analytics_delta(inc, doc, sign):
+    """Add (sign=1) or take away (sign=-1) one player's share of the analytics totals"""
+    inc["players"] = inc.get("players", 0) + sign
+    for field in ANALYTICS_SUM_FIELDS:
+        # Sums are doubles so fleet-wide Cash can't overflow a 64-bit integer
+        key = f"sums.{field}"
+        inc[key] = inc.get(key, 0.0) + sign * float(doc.get(field) or 0)
+    for rank, count in (doc.get("RankCounts") or {}).items():
+        key = f"ranks.{rank}"
+        inc[key] = inc.get(key, 0) + sign * count
+    for field in ANALYTICS_HISTOGRAM_FIELDS:
+        key = f"histograms.{field}.{magnitude_bucket(doc.get(field) or 0)}"
+        inc[key] = inc.get(key, 0) + sign
+
+def analytics_inc_update(inc):
+    """$inc update for the analytics document, or None when nothing changed"""
+    inc = {key: value for key, value in inc.items() if value}
+    return {"$inc": inc} if inc else None
+
+async def apply_analytics_incs(db_client, incs):
+    """Move the analytics totals by the deltas of player_latest writes.
+
+    incs maps the first seq reserved by a write attempt to its $inc. A delta
+    is dropped when the totals were rebuilt after its writes reserved their
+    seqs (rebuilt_seq is at least that seq): the rebuild already counted them.
+    """
+    for first_seq, inc in incs.items():
+        update = analytics_inc_update(inc)
+        if update:
+            await db_client.analytics.update_one(
+                {"_id": "latest_totals", "rebuilt_seq": {"$not": {"$gte": first_seq}}}, update
+            )
+
+def analytics_document(totals):
+    """Nest the dotted keys built by add_analytics_delta into an analytics document"""
+    analytics = {
+        "players": totals.get("players", 0),
+        "sums": {field: 0.0 for field in ANALYTICS_SUM_FIELDS},
+        "ranks": {},
+        "histograms": {field: {} for field in ANALYTICS_HISTOGRAM_FIELDS}
+    }
+    for key, value in totals.items():
+        section, _, name = key.partition(".")
+        if not name or not value:
+            continue
+        if section == "histograms":
+            field, _, bucket = name.partition(".")
+            analytics["histograms"][field][bucket] = value
+        else:
+            analytics[section][name] = value
+    return analytics
+
+async def delete_latest(db_client, player_names):
+    """Delete players from player_latest and take them out of the analytics totals.
+
+    Like write_latest, each delete only matches the version (seq) that was
+    read, so exactly the deleted documents are subtracted; players rewritten
+    in between are re-read and retried up to LATEST_WRITE_ATTEMPTS times.
+    Deletes go through stamped_bulk_write (reserving no seqs) so they pause
+    for analytics rebuilds too.
+    """
+    incs = {}
+    pending = list(player_names)
+    try:
+        for attempt in range(LATEST_WRITE_ATTEMPTS):
+            docs = await db_client.latest.find(
+                {"PlayerName": {"$in": pending}}, {**ANALYTICS_PROJECTION, "seq": 1}
+            )
+            if not docs:
+                return
+            stamp = {}
+            
+            def build_operations(first_seq, deleted_at):
+                stamp["first_seq"] = first_seq
+                return [pymongo.DeleteOne({"PlayerName": doc["PlayerName"], "seq": doc.get("seq")}) for doc in docs]
             
-        # Ensure PassesList exists and is a list
-        if "PassesList" not in stats_data or stats_data["PassesList"] is None:
-            logger.info("Initializing empty PassesList")
-            stats_data["PassesList"] = []
+            result = await stamped_bulk_write(db_client, db_client.latest, build_operations, 0, pausable=True)
+            remaining = set()
+            if result.deleted_count < len(docs):
+                remaining = {doc["PlayerName"] for doc in await db_client.latest.find(
+                    {"PlayerName": {"$in": pending}}, {"_id": 0, "PlayerName": 1}
+                )}
+            inc = incs.setdefault(stamp["first_seq"], {})
+            for doc in docs:
+                if doc["PlayerName"] not in remaining:
+                    add_analytics_delta(inc, doc, -1)
+            pending = list(remaining)
+            if not pending:
+                return
+        raise RuntimeError(f"player_latest kept changing for {', '.join(pending)}")
+    finally:
+        await apply_analytics_incs(db_client, incs)
+
+async def rebuild_analytics(db_client):
+    """Recompute the analytics document from a scan of player_latest.
+
+    The running totals move by $inc after each player_latest write, so a scan
+    racing with those writes could count one twice or not at all. The rebuild
+    therefore pauses them: it marks the latest_seq counter, after which every
+    reservation raises AnalyticsRebuilding (see stamped_bulk_write), and
+    waits CHANGES_SETTLE_SECONDS for writes reserved before the mark to land.
+    The new totals are stamped with rebuilt_seq, above every seq reserved
+    before the mark is cleared, so late deltas of writes the scan already
+    counted are dropped by apply_analytics_incs.
+
+    Returns the analytics document, or None if another rebuild holds the mark.
+    """
+    rebuild = {"id": secrets.token_hex(8), "started_at": datetime.utcnow()}
+    try:
+        await db_client.counters.find_one_and_update(
+            {"_id": "latest_seq", "$or": [
+                {"rebuild": None},
+                {"rebuild.started_at": {"$lt": rebuild["started_at"] - timedelta(seconds=ANALYTICS_REBUILD_TIMEOUT)}}
+            ]},
+            {"$set": {"rebuild": rebuild}},
+            upsert=True
+        )
+    except pymongo.errors.DuplicateKeyError:
+        # The counter exists but did not match: someone else is rebuilding
+        return None
+    
+    try:
+        await asyncio.sleep(CHANGES_SETTLE_SECONDS)
+        totals = {}
+        async for batch in db_client.latest.find_batches({}, ANALYTICS_PROJECTION):
+            for doc in batch:
+                add_analytics_delta(totals, doc, 1)
         
-        logger.info(f"Processing stats from player: {stats_data['PlayerName']}")
+        counter = await db_client.counters.find_one_and_update(
+            {"_id": "latest_seq"}, {"$inc": {"value": 1}}, return_document=ReturnDocument.AFTER
+        )
+        analytics = {
+            **analytics_document(totals),
+            "rebuilt_at": datetime.utcnow(),
+            "rebuilt_seq": counter["value"]
+        }
+        await db_client.analytics.replace_one({"_id": "latest_totals"}, analytics, upsert=True)
+    finally:
+        await db_client.counters.update_one({"_id": "latest_seq", "rebuild.id": rebuild["id"]}, {"$unset": {"rebuild": ""}})
+    logger.info(f"Analytics rebuilt for {analytics['players']} players")
+    return analytics
+
+async def maintain_analytics():
+    """Build the analytics totals once, then reconcile them from player_latest.
+
+    Ingest and deletes keep the totals current with $inc; the periodic
+    rebuild (every ANALYTICS_RECONCILE_INTERVAL seconds, across all workers)
+    corrects any drift left by writes that failed halfway. Writes pause for
+    the few seconds a rebuild takes (see rebuild_analytics).
+    """
+    while True:
+        try:
+            db_client = await run_db(get_db)
+            current = await db_client.analytics.find_one({"_id": "latest_totals"}, {"rebuilt_at": 1})
+            rebuilt_at = (current or {}).get("rebuilt_at")
+            if rebuilt_at is None:
+                await rebuild_analytics(db_client)
+            elif ANALYTICS_RECONCILE_INTERVAL <= 0:
+                return
+            elif datetime.utcnow() - rebuilt_at >= timedelta(seconds=ANALYTICS_RECONCILE_INTERVAL):
+                await rebuild_analytics(db_client)
+                await cache_invalidate_tag("latest")
+        except Exception as e:
+            logger.error(f"Failed to build analytics: {e}")
+        # Checked every minute, so a rebuild by any worker resets the clock for all of them
+        await asyncio.sleep(60)
+
+@app.on_event("startup")
+async def start_analytics():
+    asyncio.create_task(maintain_analytics())
+
+async def next_sequence(db_client, count=1):
+    """Reserve count consecutive change sequence numbers.
+
+    Returns (first seq, whether an analytics rebuild is pausing player_latest writes).
+    """
+    counter = await db_client.counters.find_one_and_update(
+        {"_id": "latest_seq"},
+        {"$inc": {"value": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    rebuild = counter.get("rebuild")
+    rebuilding = bool(rebuild) and datetime.utcnow() - rebuild["started_at"] < timedelta(seconds=ANALYTICS_REBUILD_TIMEOUT)
+    return counter["value"] - count + 1, rebuilding
+
+class WriteDeferred(Exception):
+    """A player_latest write or delete was not issued and should be retried shortly"""
+
+class AnalyticsRebuilding(WriteDeferred):
+    """player_latest writes are paused while rebuild_analytics scans the collection"""
+
+class SettleWindowMissed(WriteDeferred):
+    """A change-feed write could not be issued within CHANGES_SETTLE_SECONDS of its stamp"""
+
+async def stamped_bulk_write(db_client, collection, build_operations, count, pausable=False):
+    """bulk_write on a change-feed collection, stamped with fresh seqs and time.
+
+    Readers of the feed treat a change as final once it is CHANGES_SETTLE_SECONDS
+    old, so a write must land within that window of its stamp. Each attempt
+    reserves count new seqs and a new timestamp, build_operations(first_seq,
+    stamped_at) turns them into operations, and the write is only started in
+    the database thread if no more than half the window has passed (the pool
+    may be busy with dashboard queries). Otherwise it is re-stamped, up to
+    LATEST_WRITE_ATTEMPTS times, then SettleWindowMissed is raised.
+    Writes that move the analytics totals are pausable: they raise
+    AnalyticsRebuilding instead while a rebuild is scanning.
+    """
+    for attempt in range(LATEST_WRITE_ATTEMPTS):
+        first_seq, rebuilding = await next_sequence(db_client, count)
+        if pausable and rebuilding:
+            raise AnalyticsRebuilding("player_latest writes are paused while the analytics totals are rebuilt")
+        stamped_at = datetime.utcnow()
+        operations = build_operations(first_seq, stamped_at)
+        deadline = time.monotonic() + CHANGES_SETTLE_SECONDS / 2
         
-        # Đảm bảo các trường dữ liệu không bị null
-        for field in ["PetsList", "ItemsList", "PassesList"]:
-            if field not in stats_data or stats_data[field] is None:
-                logger.info(f"Fixing null {field}")
-                stats_data[field] = []
+        def issue():
+            if time.monotonic() > deadline:
+                return None
+            return collection.collection.bulk_write(operations, ordered=False)
+        
+        result = await run_db(issue)
+        if result is None:
+            logger.warning(f"Change-feed write of {count} documents delayed past the settle window, re-stamping")
+            continue
+        if datetime.utcnow() - stamped_at > timedelta(seconds=CHANGES_SETTLE_SECONDS):
+            logger.warning(f"Change-feed write of {count} documents landed after the settle window")
+        return result
+    raise SettleWindowMissed(f"Could not write {count} change-feed documents within {CHANGES_SETTLE_SECONDS}s")
+
+def encode_sync_token(seq, issued_at=None):
+    """Opaque /api/latest/changes token; the issue time lets stale tokens be detected"""
+    return encode_cursor({"seq": seq, "t": issued_at or int(time.time())})
+
+async def settled_sequence(db_client):
+    """Highest seq of a change older than CHANGES_SETTLE_SECONDS.
+
+    Snapshots (name index, columnar copy) and the sync tokens handed out
+    with /api/latest pages start following the feed from here rather than
+    from the last seq handed out, so a write that reserved a seq before the
+    snapshot was read but landed after it is still replayed.
+    """
+    settled = {"$not": {"$gt": datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)}}
+    updated, deleted = await asyncio.gather(
+        db_client.latest.find(
+            {"seq": {"$exists": True}, "updated_at": settled}, {"_id": 0, "seq": 1},
+            sort=[("seq", DESCENDING)], limit=1
+        ),
+        db_client.tombstones.find(
+            {"deleted_at": settled}, {"_id": 0, "seq": 1},
+            sort=[("seq", DESCENDING)], limit=1
+        )
+    )
+    return max([doc["seq"] for doc in updated + deleted], default=0)
+
+async def settled_changes(db_client, since_seq, projection):
+    """player_latest writes and tombstones after since_seq, in sequence order.
+
+    Like /api/latest/changes, stops at the first change newer than
+    CHANGES_SETTLE_SECONDS, so a write that reserved a lower seq but has not
+    landed yet is picked up by a later call instead of being skipped.
+    Returns ([(doc, is_delete), ...], last returned seq, whether changes were held back).
+    """
+    updated, deleted = await asyncio.gather(
+        db_client.latest.find({"seq": {"$gt": since_seq}}, {**projection, "seq": 1, "updated_at": 1}),
+        db_client.tombstones.find({"seq": {"$gt": since_seq}}, {"_id": 0, "PlayerName": 1, "seq": 1, "deleted_at": 1})
+    )
+    changes = sorted(
+        [(doc["seq"], doc.pop("updated_at", None), doc, False) for doc in updated] +
+        [(doc["seq"], doc.get("deleted_at"), doc, True) for doc in deleted],
+        key=lambda change: change[0]
+    )
+    settled_before = datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    
+    settled = []
+    last_seq = since_seq
+    for seq, changed_at, doc, is_delete in changes:
+        if changed_at and changed_at > settled_before:
+            return settled, last_seq, True
+        settled.append((doc, is_delete))
+        last_seq = seq
+    return settled, last_seq, False
+
+async def record_tombstones(db_client, player_names):
+    """Record deleted players so /api/latest/changes can report them"""
+    if not player_names:
+        return
+    await stamped_bulk_write(db_client, db_client.tombstones, lambda first_seq, deleted_at: [
+        pymongo.UpdateOne(
+            {"PlayerName": player_name},
+            {"$set": {"seq": seq, "deleted_at": deleted_at}},
+            upsert=True
+        )
+        for seq, player_name in enumerate(player_names, start=first_seq)
+    ], len(player_names))
+
+async def list_deltas(db_client, stats_list, changed_lists):
+    """Diff the changed lists of each player against the stored ones, fetched in one query"""
+    if not changed_lists:
+        return {}
+    
+    stored = {
+        doc["PlayerName"]: doc
+        for doc in await db_client.latest.find(
+            {"PlayerName": {"$in": list(changed_lists)}},
+            {"_id": 0, "PlayerName": 1, **{list_field: 1 for list_field in LIST_HASH_FIELDS}}
+        )
+    }
+    
+    deltas = {}
+    for stats_data in stats_list:
+        player_name = stats_data["PlayerName"]
+        if player_name not in stored:
+            continue
+        deltas[player_name] = {
+            LIST_DELTA_FIELDS[list_field]: diff_entries(
+                stored[player_name].get(list_field) or [],
+                stats_data[list_field],
+                LIST_DELTA_KEYS[list_field]
+            )
+            for list_field in changed_lists[player_name]
+        }
+    return deltas
+
+def history_writes(db_client, stats_list, deltas=None):
+    """Writes appending each snapshot to raw history and folding it into its hour/day buckets.
+
+    Raw snapshots carry the list deltas for that update, so earlier
+    inventories can be rebuilt from the current one.
+    """
+    deltas = deltas or {}
+    snapshots = []
+    for stats_data in stats_list:
+        timestamp = stats_data.get("timestamp")
+        if not isinstance(timestamp, datetime):
+            timestamp = datetime.utcnow()
+        snapshot = {field: stats_data.get(field, 0) for field in HISTORY_FIELDS}
+        snapshot["PlayerName"] = stats_data["PlayerName"]
+        snapshot["timestamp"] = timestamp
+        snapshot.update(deltas.get(stats_data["PlayerName"], {}))
+        snapshots.append(snapshot)
+    
+    writes = [db_client.history["raw"].insert_many(snapshots, ordered=False)]
+    for resolution, truncate in (("hour", {"minute": 0}), ("day", {"hour": 0, "minute": 0})):
+        # Each bucket keeps the last snapshot it received and how many it summarizes
+        operations = [
+            pymongo.UpdateOne(
+                {
+                    "PlayerName": snapshot["PlayerName"],
+                    "timestamp": snapshot["timestamp"].replace(second=0, microsecond=0, **truncate)
+                },
+                {
+                    "$set": {field: snapshot[field] for field in HISTORY_FIELDS},
+                    "$max": {"last_timestamp": snapshot["timestamp"]},
+                    "$inc": {"samples": 1}
+                },
+                upsert=True
+            )
+            for snapshot in snapshots
+        ]
+        writes.append(db_client.history[resolution].bulk_write(operations, ordered=False))
+    return writes
+
+class IngestBuffer:
+    """Write-behind buffer for game heartbeats.
+
+    /ac_stats drops each payload in here and answers immediately. Updates are
+    coalesced per PlayerName (the newest one wins) and flushed as one
+    bulk_write when ``flush_size`` players are pending or every
+    ``flush_interval`` seconds, whichever comes first.
+
+    A batch that fails on a lost connection or is deferred (WriteDeferred:
+    missed settle window, analytics rebuild) is requeued as a whole. After any other failure its
+    updates are retried one by one so a single bad document can't hold up
+    everyone else. An update that keeps failing is moved to ``dead_letters``
+    after INGEST_MAX_ATTEMPTS flushes.
+    """
+    def __init__(self, flush_interval, flush_size):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.pending = {}
+        self.attempts = {}
+        self.dead_letters = deque(maxlen=INGEST_DEAD_LETTER_SIZE)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+    
+    def add(self, stats_data):
+        """Queue a player update, replacing any older one still pending"""
+        self.pending[stats_data["PlayerName"]] = stats_data
+        if len(self.pending) >= self.flush_size:
+            self._wakeup.set()
+    
+    def discard(self, player_names):
+        """Drop pending updates superseded by a direct write"""
+        for player_name in player_names:
+            self.pending.pop(player_name, None)
+            self.attempts.pop(player_name, None)
+    
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the flush loop and drain whatever is still pending"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    def _requeue(self, batch):
+        # Never overwrite a newer update that arrived meanwhile
+        for player_name, stats_data in batch.items():
+            self.pending.setdefault(player_name, stats_data)
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        
+        batch, self.pending = self.pending, {}
+        try:
+            db_client = await run_db(get_db)
+        except Exception as e:
+            logger.error(f"Failed to flush {len(batch)} player updates: {e}", exc_info=True)
+            self._requeue(batch)
+            return
+        
+        try:
+            result = await persist_stats(db_client, list(batch.values()))
+        except (pymongo.errors.ConnectionFailure, WriteDeferred) as e:
+            # Database unreachable, saturated or paused: keep everything, INGEST_MAX_PENDING sheds load meanwhile
+            logger.error(f"Failed to flush {len(batch)} player updates: {e}")
+            self._requeue(batch)
+            return
+        except Exception as e:
+            logger.error(f"Failed to flush {len(batch)} player updates, retrying one by one: {e}", exc_info=True)
+            await self._flush_each(db_client, batch)
+            return
+        
+        for player_name in batch:
+            self.attempts.pop(player_name, None)
+        logger.info(f"Flushed {len(batch)} player updates "
+                    f"({result.upserted_count} new, {result.modified_count} modified)")
+    
+    async def _flush_each(self, db_client, batch):
+        """Write a failed batch player by player, counting failures per player"""
+        items = list(batch.items())
+        for index, (player_name, stats_data) in enumerate(items):
+            try:
+                await persist_stats(db_client, [stats_data])
+            except (pymongo.errors.ConnectionFailure, WriteDeferred) as e:
+                logger.error(f"Failed to flush player updates: {e}")
+                self._requeue(dict(items[index:]))
+                return
+            except Exception as e:
+                attempts = self.attempts.get(player_name, 0) + 1
+                if attempts < INGEST_MAX_ATTEMPTS:
+                    self.attempts[player_name] = attempts
+                    self._requeue({player_name: stats_data})
+                    continue
                 
-        # Kiểm tra xem người chơi đã tồn tại trong database chưa
-        existing_player = db_client.stats_collection.find_one({"PlayerName": stats_data["PlayerName"]})
+                self.attempts.pop(player_name, None)
+                self.dead_letters.append({
+                    "player": player_name,
+                    "error": str(e),
+                    "failed_at": datetime.utcnow(),
+                    "stats": stats_data
+                })
+                logger.error(f"Dropping update for {player_name} after {attempts} failed flushes: {e}")
+            else:
+                self.attempts.pop(player_name, None)
+
+ingest_buffer = IngestBuffer(INGEST_FLUSH_INTERVAL, INGEST_FLUSH_SIZE)
+
+class IngestLoad:
+    """Sliding-window heartbeat rate, used to pace game clients.
+
+    ``next_report_in`` stretches the reporting interval in proportion to how
+    far the recent rate exceeds INGEST_TARGET_RATE (doubled again while the
+    write buffer is backed up), with jitter so clients don't report in lockstep.
+    """
+    def __init__(self, window=60):
+        self.window = window
+        self._buckets = deque()
+    
+    def record(self, count=1):
+        now = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == now:
+            self._buckets[-1][1] += count
+        else:
+            self._buckets.append([now, count])
+        self._trim(now)
+    
+    def rate(self):
+        self._trim(int(time.monotonic()))
+        return sum(count for _, count in self._buckets) / self.window
+    
+    def overloaded(self):
+        return len(ingest_buffer.pending) >= INGEST_MAX_PENDING
+    
+    def next_report_in(self):
+        factor = max(1.0, self.rate() / INGEST_TARGET_RATE)
+        if len(ingest_buffer.pending) > ingest_buffer.flush_size:
+            factor *= 2
+        # Cap after the jitter so the hint never exceeds REPORT_INTERVAL_MAX
+        interval = REPORT_INTERVAL * factor * random.uniform(0.9, 1.1)
+        return int(min(interval, REPORT_INTERVAL_MAX))
+    
+    def _trim(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+
+ingest_load = IngestLoad()
+
+def shed_load_response():
+    """503 telling clients to back off while the write buffer is saturated"""
+    retry_after = ingest_load.next_report_in()
+    logger.warning(f"Shedding ingest load: {len(ingest_buffer.pending)} updates pending")
+    return ORJSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"success": False, "error": "Server busy, retry later", "next_report_in": retry_after},
+        headers={"Retry-After": str(retry_after)}
+    )
+
+@app.on_event("startup")
+async def start_ingest_buffer():
+    if INGEST_BUFFER_ENABLED:
+        ingest_buffer.start()
+
+@app.on_event("shutdown")
+async def drain_ingest_buffer():
+    """Flush pending heartbeats before the database connection is closed"""
+    if INGEST_BUFFER_ENABLED:
+        await ingest_buffer.stop()
+
+class EventSubscription:
+    """One /api/stream client: a bounded queue that drops its oldest events when full"""
+    def __init__(self, max_size):
+        self.queue = deque(maxlen=max_size)
+        self.dropped = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+    
+    def put(self, data):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(data)
+        self._ready.set()
+    
+    def close(self):
+        self.closed = True
+        self._ready.set()
+    
+    async def get(self, timeout):
+        """Wait up to timeout seconds and return every queued event (empty on timeout)"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._ready.clear()
+        events = list(self.queue)
+        self.queue.clear()
+        return events
+
+class EventHub:
+    """In-process pub/sub fanning player updates out to /api/stream clients.
+
+    Events are serialized once and appended to every subscriber's queue, so a
+    slow dashboard only ever loses its own oldest events and never blocks
+    ingest. Each worker has its own hub and sees its own writes.
+    """
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.published = 0
+    
+    def subscribe(self):
+        subscription = EventSubscription(self.queue_size)
+        self.subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+    
+    def publish(self, event):
+        if not self.subscribers:
+            return
+        data = orjson.dumps(event, default=str)
+        for subscription in self.subscribers:
+            subscription.put(data)
+        self.published += 1
+    
+    def close(self):
+        for subscription in list(self.subscribers):
+            subscription.close()
+
+event_hub = EventHub(STREAM_QUEUE_SIZE)
+
+# Scalar fields sent with each "update" event; the lists stay behind /api/latest/changes
+STREAM_EVENT_FIELDS = ["Cash", "FormattedCash", "Gems", "FormattedGems", "PetCount"] + DERIVED_FIELDS
+
+def publish_player_updates(stats_list):
+    for stats_data in stats_list:
+        event = {"type": "update", "PlayerName": stats_data["PlayerName"], "timestamp": stats_data["timestamp"].isoformat()}
+        event.update({field: stats_data.get(field) for field in STREAM_EVENT_FIELDS})
+        event_hub.publish(event)
+
+def publish_player_deletes(player_names):
+    for player_name in player_names:
+        event_hub.publish({"type": "delete", "PlayerName": player_name})
+
+@app.on_event("shutdown")
+async def close_event_streams():
+    """End open /api/stream responses so shutdown doesn't wait on them"""
+    event_hub.close()
+
+# Pet rank number -> letter, same table as AC_Track.lua
+RANK_NAMES = {1: "E", 2: "D", 3: "C", 4: "B", 5: "A", 6: "S", 7: "SS", 8: "G"}
+
+def format_number(value):
+    """Format a number with thousands separators, like formatNumber in AC_Track.lua"""
+    return f"{math.floor(value):,}"
+
+def decode_compact_stats(payload):
+    """Expand a version 2 compact payload into the regular stats document.
+
+    v2 shape: {"v": 2, "n": name, "c": cash, "g": gems,
+               "p": [[name, level, rank_num, folder_name], ...],
+               "i": [[name, amount], ...], "s": [owned_pass_name, ...]}
+    Rank letters, PetCount and the Formatted* strings are derived here.
+    """
+    pets = []
+    for pet in payload.get("p") or []:
+        name, level, rank_num = pet[0], pet[1], pet[2]
+        pets.append({
+            "Name": name,
+            "Level": level,
+            "Rank": RANK_NAMES.get(rank_num, f"Rank{rank_num}"),
+            "RankNum": rank_num,
+            "FolderName": pet[3] if len(pet) > 3 else name
+        })
+    
+    return {
+        "PlayerName": payload["n"],
+        "Cash": payload.get("c", 0),
+        "Gems": payload.get("g", 0),
+        "PetCount": len(pets),
+        "PetsList": pets,
+        "ItemsList": [{"Name": name, "Amount": amount} for name, amount in payload.get("i") or []],
+        "PassesList": [{"Name": name, "Owned": True} for name in payload.get("s") or []]
+    }
+
+def write_deferred(e):
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "5"})
+
+def body_too_large():
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Request body is limited to {INGEST_MAX_BODY_BYTES} bytes"
+    )
+
+async def read_limited_body(request):
+    """Read the raw request body, refusing anything over INGEST_MAX_BODY_BYTES"""
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > INGEST_MAX_BODY_BYTES:
+        raise body_too_large()
+    
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > INGEST_MAX_BODY_BYTES:
+            raise body_too_large()
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def decompress_limited(body, wbits):
+    """Inflate body without ever producing more than INGEST_MAX_BODY_BYTES"""
+    decompressor = zlib.decompressobj(wbits)
+    data = decompressor.decompress(body, INGEST_MAX_BODY_BYTES + 1)
+    if len(data) > INGEST_MAX_BODY_BYTES:
+        raise body_too_large()
+    if not decompressor.eof:
+        raise zlib.error("incomplete or truncated stream")
+    return data
+
+async def read_json_body(request):
+    """Read a JSON request body, optionally gzip/deflate encoded"""
+    body = await read_limited_body(request)
+    encoding = request.headers.get("content-encoding", "").lower()
+    try:
+        if encoding == "gzip":
+            body = decompress_limited(body, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            try:
+                body = decompress_limited(body, zlib.MAX_WBITS)
+            except zlib.error:
+                # Some clients send raw deflate without the zlib header
+                body = decompress_limited(body, -zlib.MAX_WBITS)
+        return orjson.loads(body)
+    except (zlib.error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid stats payload: {e}")
+
+def normalize_stats_payload(payload):
+    """Turn one decoded stats payload (plain or compact v2) into a stats document.
+
+    Raises ValueError for anything that is not a valid payload object.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("Stats payload must be a JSON object")
+    
+    if payload.get("v") == 2:
+        try:
+            return decode_compact_stats(payload)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid compact stats payload: {e}")
+    return payload
+
+async def read_stats_payload(request):
+    """Read an /ac_stats body: plain or compact JSON, optionally gzip/deflate encoded"""
+    try:
+        return normalize_stats_payload(await read_json_body(request))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/ac_stats")
+async def update_stats(request: Request, response: Response, db_client = Depends(get_db)):
+    """Update player stats from game.
+
+    Accepts the original JSON shape and the compact v2 format
+    (see decode_compact_stats), optionally with Content-Encoding gzip/deflate.
+    """
+    if ingest_load.overloaded():
+        return shed_load_response()
+    
+    payload = await read_stats_payload(request)
+    ingest_load.record()
+    try:
+        stats_data, error = prepare_stats(payload)
+        if error:
+            response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+            return {"success": False, "error": error}
+        
+        logger.info(f"Processing stats from player: {stats_data['PlayerName']}")
+        
+        # Write-behind: trả về ngay, dữ liệu sẽ được ghi theo batch
+        if INGEST_BUFFER_ENABLED:
+            ingest_buffer.add(stats_data)
+            response.status_code = status.HTTP_202_ACCEPTED
+            return {
+                "success": True, 
+                "message": "Player data queued",
+                "player": stats_data["PlayerName"],
+                "next_report_in": ingest_load.next_report_in()
+            }
+        
+        # Upsert theo PlayerName: một round trip, unique index chống trùng khi hai client gửi cùng lúc
+        result = await persist_stats(db_client, [stats_data])
+        
+        # Nếu người chơi không tồn tại, upsert đã thêm mới vào database
+        if result.upserted_count:
+            logger.info(f"Player {stats_data['PlayerName']} is new, added to database")
+            return {
+                "success": True, 
+                "id": str(result.upserted_ids[0]),
+                "message": "New player added",
+                "next_report_in": ingest_load.next_report_in()
+            }
         
-        # Nếu người chơi đã tồn tại, update bản ghi hiện có
-        if existing_player:
-            logger.info(f"Player {stats_data['PlayerName']} already exists, updating record")
+        return {
+            "success": True, 
+            "message": "Player data updated",
+            "player": stats_data["PlayerName"],
+            "next_report_in": ingest_load.next_report_in()
+        }
+    except Exception as e:
+        logger.error(f"Failed to process stats: {e}", exc_info=True)
+        return {"success": False, "error": str(e)}
+
+# Fields returned for each player by /api/latest
+LATEST_PROJECTION = {
+    "_id": 0,
+    "PlayerName": 1,
+    "Cash": 1,
+    "FormattedCash": 1,
+    "Gems": 1,
+    "FormattedGems": 1,
+    "PetCount": 1,
+    "PetsList": 1,
+    "ItemsList": 1,
+    "PassesList": 1,
+    "TicketCount": 1,
+    "SRankPets": 1,
+    "SSRankPets": 1,
+    "PassCount": 1,
+    "timestamp": 1
+}
+
+# Scalar columns of the CSV export; the lists are written as JSON strings
+EXPORT_CSV_COLUMNS = [
+    "PlayerName", "Cash", "FormattedCash", "Gems", "FormattedGems", "PetCount",
+    "TicketCount", "SRankPets", "SSRankPets", "PassCount", "timestamp",
+    "PetsList", "ItemsList", "PassesList"
+]
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+
+class NameIndex:
+    """In-memory trigram index over player names for substring search.
+
+    Each lowercased name is split into its 3-character substrings; a query
+    intersects the posting sets of its own trigrams (smallest first) and
+    verifies the survivors. Queries shorter than 3 characters scan the name
+    table. Every worker loads the names once and then follows the change feed
+    (player_latest.seq and tombstones), so it also sees other workers' writes;
+    its own writes are applied directly by persist_stats and delete_players.
+    """
+    def __init__(self):
+        self.loaded = False
+        self.last_seq = 0
+        self._ids = {}
+        self._names = []
+        self._lower = []
+        self._free = []
+        self._trigrams = {}
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    @staticmethod
+    def trigrams(term):
+        return {term[i:i + 3] for i in range(len(term) - 2)}
+    
+    def add(self, name):
+        if name in self._ids:
+            return
+        lower = name.lower()
+        if self._free:
+            name_id = self._free.pop()
+            self._names[name_id], self._lower[name_id] = name, lower
+        else:
+            name_id = len(self._names)
+            self._names.append(name)
+            self._lower.append(lower)
+        self._ids[name] = name_id
+        for trigram in self.trigrams(lower):
+            self._trigrams.setdefault(trigram, set()).add(name_id)
+    
+    def remove(self, name):
+        name_id = self._ids.pop(name, None)
+        if name_id is None:
+            return
+        for trigram in self.trigrams(self._lower[name_id]):
+            postings = self._trigrams.get(trigram)
+            if postings is not None:
+                postings.discard(name_id)
+                if not postings:
+                    del self._trigrams[trigram]
+        self._names[name_id] = self._lower[name_id] = None
+        self._free.append(name_id)
+    
+    def search(self, term, max_matches):
+        """Names containing term (already lowercased), or None to let Mongo answer"""
+        if not self.loaded:
+            return None
+        
+        if len(term) < 3:
+            candidates = (name_id for name_id in self._ids.values())
+        else:
+            postings = sorted((self._trigrams.get(t, set()) for t in self.trigrams(term)), key=len)
+            candidates = set.intersection(*postings) if postings[0] else set()
+        
+        matches = []
+        for name_id in candidates:
+            if term in self._lower[name_id]:
+                matches.append(self._names[name_id])
+                if len(matches) > max_matches:
+                    return None
+        return matches
+    
+    async def load(self, db_client):
+        """Build the index from player_latest; changes after the settled seq are caught up by refresh"""
+        self.last_seq = await settled_sequence(db_client)
+        async for batch in db_client.latest.find_batches({}, {"_id": 0, "PlayerName": 1}, batch_size=5000):
+            for doc in batch:
+                self.add(doc["PlayerName"])
+        self.loaded = True
+        logger.info(f"Name index loaded with {len(self)} players")
+    
+    async def refresh(self, db_client):
+        """Apply player_latest upserts and tombstones written since the last refresh"""
+        changes, self.last_seq, _ = await settled_changes(db_client, self.last_seq, {"_id": 0, "PlayerName": 1})
+        # Applied in sequence order so a delete followed by a new report leaves the name in place
+        for doc, is_delete in changes:
+            if is_delete:
+                self.remove(doc["PlayerName"])
+            else:
+                self.add(doc["PlayerName"])
+
+name_index = NameIndex()
+
+async def maintain_name_index():
+    """Load the name index, then follow the change feed every NAME_INDEX_REFRESH_INTERVAL seconds"""
+    while True:
+        try:
+            db_client = await run_db(get_db)
+            if not name_index.loaded:
+                await name_index.load(db_client)
+            else:
+                await name_index.refresh(db_client)
+        except Exception as e:
+            logger.error(f"Name index update failed: {e}")
+        await asyncio.sleep(NAME_INDEX_REFRESH_INTERVAL)
+
+@app.on_event("startup")
+async def start_name_index():
+    if NAME_INDEX_ENABLED:
+        asyncio.create_task(maintain_name_index())
+
+EPOCH = datetime(1970, 1, 1)
+
+class ColumnarLatest:
+    """Columnar in-memory snapshot of player_latest for /api/latest.
+
+    Each player is a row: the SORT_FIELDS numbers live in one float64 column
+    per field (NumPy arrays when available, ``array.array`` otherwise), names
+    in an interned table, and the projected document in a parallel list for
+    building pages. Filters become boolean masks and sorts a lexsort on
+    (value, name rank), so queries never reach Mongo once loaded.
+
+    Rows are loaded once, then updated from persist_stats and the delete
+    endpoints. With several workers each one also follows the change feed to
+    pick up the others' writes.
+    """
+    def __init__(self):
+        self.loaded = False
+        self.last_seq = 0
+        self.row_of = {}
+        self.names = []
+        self.lower_names = []
+        self.docs = []
+        self.free = []
+        self.size = 0
+        self.capacity = 0
+        self.columns = {}
+        self.alive = None
+        self._ranks = None
+        self._sorted_names = None
+        self._grow(1024)
+    
+    def __len__(self):
+        return len(self.row_of)
+    
+    def _grow(self, capacity):
+        if np is not None:
+            for field in SORT_FIELDS[1:]:
+                column = np.zeros(capacity, dtype=np.float64)
+                if field in self.columns:
+                    column[:self.capacity] = self.columns[field]
+                self.columns[field] = column
+            alive = np.zeros(capacity, dtype=bool)
+            if self.alive is not None:
+                alive[:self.capacity] = self.alive
+            self.alive = alive
+        else:
+            for field in SORT_FIELDS[1:]:
+                self.columns.setdefault(field, array.array("d")).extend([0.0] * (capacity - self.capacity))
+            if self.alive is None:
+                self.alive = bytearray()
+            self.alive.extend(bytes(capacity - self.capacity))
+        self.capacity = capacity
+    
+    @staticmethod
+    def _number(field, value):
+        if field == "timestamp":
+            return (to_naive_utc(value) - EPOCH).total_seconds() if isinstance(value, datetime) else 0.0
+        return float(value or 0)
+    
+    def upsert(self, doc):
+        name = doc["PlayerName"]
+        row = self.row_of.get(name)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                if self.size == self.capacity:
+                    self._grow(self.capacity * 2)
+                row = self.size
+                self.size += 1
+                self.names.append(None)
+                self.lower_names.append(None)
+                self.docs.append(None)
+            self.row_of[name] = row
+            self.names[row] = name
+            self.lower_names[row] = name.lower()
+            self.alive[row] = True
+            self._ranks = None
+        
+        # Partial documents (unchanged lists skipped) merge into the stored one
+        stored = self.docs[row] or {}
+        self.docs[row] = {**stored, **{k: v for k, v in doc.items() if k in LATEST_PROJECTION}}
+        for field, column in self.columns.items():
+            column[row] = self._number(field, self.docs[row].get(field))
+    
+    def remove(self, name):
+        row = self.row_of.pop(name, None)
+        if row is None:
+            return
+        self.alive[row] = False
+        self.names[row] = self.lower_names[row] = self.docs[row] = None
+        self.free.append(row)
+        self._ranks = None
+    
+    def _name_ranks(self):
+        """Position of every live row's name in sorted order (rebuilt after adds and removes)"""
+        if self._ranks is None:
+            self._sorted_names = sorted(self.row_of)
+            ranks = [0] * self.size
+            for rank, name in enumerate(self._sorted_names):
+                ranks[self.row_of[name]] = rank
+            self._ranks = np.array(ranks, dtype=np.int64) if np is not None else ranks
+        return self._ranks
+    
+    def _search_rows(self, search, search_mode):
+        term = search.lower()
+        names = name_index.search(term, len(self)) if search_mode == "contains" else None
+        if names is not None:
+            return sorted(self.row_of[name] for name in names if name in self.row_of)
+        if search_mode == "prefix":
+            return [row for row, lower in enumerate(self.lower_names) if lower is not None and lower.startswith(term)]
+        return [row for row, lower in enumerate(self.lower_names) if lower is not None and term in lower]
+    
+    def query(self, ranges, search=None, search_mode="contains", sort_field="PlayerName",
+              direction=ASCENDING, skip=0, limit=50, after=None, projection=LATEST_PROJECTION):
+        """Return (total matching, page of documents) for the /api/latest parameters.
+
+        ranges maps a column to (min, max) with None for an open bound; after
+        is a decoded (value, PlayerName) keyset cursor, excluded from total.
+        """
+        ranks = self._name_ranks()
+        rows = self._search_rows(search, search_mode) if search else None
+        descending = direction == DESCENDING
+        
+        if after is not None:
+            after_value, after_name = after
+            # Ranks strictly after / before after_name, whether or not it still exists
+            rank_after = bisect.bisect_right(self._sorted_names, after_name)
+            rank_before = bisect.bisect_left(self._sorted_names, after_name)
+            if sort_field != "PlayerName":
+                after_value = self._number(sort_field, after_value)
+        
+        if np is not None:
+            rows = np.flatnonzero(self.alive[:self.size]) if rows is None else np.array(rows, dtype=np.int64)
+            mask = np.ones(len(rows), dtype=bool)
+            for field, (min_value, max_value) in ranges.items():
+                values = self.columns[field][rows]
+                if min_value is not None:
+                    mask &= values >= min_value
+                if max_value is not None:
+                    mask &= values <= max_value
+            rows = rows[mask]
+            total = len(rows)
             
-            # Cập nhật thông tin người chơi
-            result = db_client.stats_collection.update_one(
-                {"PlayerName": stats_data["PlayerName"]},
-                {"$set": {
-                    "Cash": stats_data["Cash"],
-                    "FormattedCash": stats_data["FormattedCash"],
-                    "Gems": stats_data["Gems"],
-                    "FormattedGems": stats_data["FormattedGems"],
-                    "PetCount": stats_data["PetCount"],
-                    "PetsList": stats_data["PetsList"],
-                    "ItemsList": stats_data["ItemsList"],
-                    "PassesList": stats_data["PassesList"],
-                    "timestamp": stats_data["timestamp"]
-                }}
-            )
+            row_ranks = ranks[rows]
+            if after is not None:
+                if sort_field == "PlayerName":
+                    keep = row_ranks < rank_before if descending else row_ranks >= rank_after
+                else:
+                    values = self.columns[sort_field][rows]
+                    if descending:
+                        keep = (values < after_value) | ((values == after_value) & (row_ranks < rank_before))
+                    else:
+                        keep = (values > after_value) | ((values == after_value) & (row_ranks >= rank_after))
+                rows, row_ranks = rows[keep], row_ranks[keep]
             
-            # Invalidate cache for this player
-            cache_invalidate(f"player_{stats_data['PlayerName']}")
-            cache_invalidate("latest_stats")
+            if sort_field == "PlayerName":
+                order = np.argsort(row_ranks)
+            else:
+                order = np.lexsort((row_ranks, self.columns[sort_field][rows]))
+            if descending:
+                order = order[::-1]
+            page_rows = rows[order[skip:skip + limit]].tolist()
+        else:
+            if rows is None:
+                rows = [row for row in range(self.size) if self.alive[row]]
+            for field, (min_value, max_value) in ranges.items():
+                column = self.columns[field]
+                rows = [row for row in rows
+                        if (min_value is None or column[row] >= min_value)
+                        and (max_value is None or column[row] <= max_value)]
+            total = len(rows)
             
+            column = self.columns.get(sort_field)
+            sort_key = (lambda row: ranks[row]) if column is None else (lambda row: (column[row], ranks[row]))
+            if after is not None:
+                def is_after(row):
+                    if column is not None and column[row] != after_value:
+                        return column[row] < after_value if descending else column[row] > after_value
+                    return ranks[row] < rank_before if descending else ranks[row] >= rank_after
+                rows = [row for row in rows if is_after(row)]
+            page_rows = sorted(rows, key=sort_key, reverse=descending)[skip:skip + limit]
+        
+        fields = [field for field in projection if field != "_id"]
+        return total, [
+            {field: self.docs[row][field] for field in fields if field in self.docs[row]}
+            for row in page_rows
+        ]
+    
+    async def load(self, db_client):
+        """Cold start: read every player_latest document once"""
+        self.last_seq = await settled_sequence(db_client)
+        async for batch in db_client.latest.find_batches({}, LATEST_PROJECTION, batch_size=5000):
+            for doc in batch:
+                self.upsert(doc)
+        self.loaded = True
+        logger.info(f"Columnar latest stats loaded with {len(self)} players (numpy: {np is not None})")
+    
+    async def refresh(self, db_client):
+        """Apply settled player_latest writes and tombstones newer than the last applied seq.
+
+        Returns True while changes are still held back by the settle window.
+        """
+        changes, self.last_seq, pending = await settled_changes(db_client, self.last_seq, LATEST_PROJECTION)
+        for doc, is_delete in changes:
+            if is_delete:
+                self.remove(doc["PlayerName"])
+            else:
+                self.upsert(doc)
+        return pending
+
+columnar_latest = ColumnarLatest()
+
+async def maintain_columnar_latest():
+    """Load the columnar snapshot, catch up on writes made during the load, then follow other workers"""
+    while True:
+        try:
+            db_client = await run_db(get_db)
+            if not columnar_latest.loaded:
+                await columnar_latest.load(db_client)
+            pending = await columnar_latest.refresh(db_client)
+            if WEB_CONCURRENCY <= 1 and not pending:
+                # A single worker applies every write itself, nothing left to follow
+                return
+        except Exception as e:
+            logger.error(f"Columnar latest stats update failed: {e}")
+        await asyncio.sleep(COLUMNAR_REFRESH_INTERVAL)
+
+@app.on_event("startup")
+async def start_columnar_latest():
+    if COLUMNAR_ENABLED:
+        asyncio.create_task(maintain_columnar_latest())
+
+
+def build_name_filter(search, search_mode="contains"):
+    """player_latest filter for a case-insensitive name search.
+
+    The input is always escaped, so it is matched literally. Prefix searches
+    are an anchored regex on the PlayerNameLower index; substring searches go
+    through name_index when it is loaded, and otherwise fall back to an
+    unanchored regex over the same index's keys.
+    """
+    term = search.lower()
+    if search_mode == "prefix":
+        return {"PlayerNameLower": {"$regex": "^" + re.escape(term)}}
+    
+    names = name_index.search(term, NAME_INDEX_MAX_MATCHES)
+    if names is not None:
+        return {"PlayerName": {"$in": names}}
+    return {"PlayerNameLower": {"$regex": re.escape(term)}}
+
+def build_latest_filter(search=None, cash_min=None, cash_max=None, gems_min=None, gems_max=None,
+                        tickets_min=None, tickets_max=None, s_pets_min=None, ss_pets_min=None,
+                        gamepass_min=None, gamepass_max=None, search_mode="contains"):
+    """Build the player_latest $match filter for the /api/latest filter parameters"""
+    match_filter = {}
+    
+    # Add search filter if provided
+    if search:
+        match_filter.update(build_name_filter(search, search_mode))
+    
+    # Ticket, pet rank and gamepass counts are precomputed at ingest, so every
+    # predicate stays in one indexable $match
+    ranges = build_latest_ranges(cash_min, cash_max, gems_min, gems_max, tickets_min, tickets_max,
+                                 s_pets_min, ss_pets_min, gamepass_min, gamepass_max)
+    for field, (min_value, max_value) in ranges.items():
+        add_range_filter(match_filter, field, min_value, max_value)
+    
+    return match_filter
+
+def build_latest_ranges(cash_min=None, cash_max=None, gems_min=None, gems_max=None, tickets_min=None,
+                        tickets_max=None, s_pets_min=None, ss_pets_min=None, gamepass_min=None, gamepass_max=None):
+    """The /api/latest numeric filters as {field: (min, max)}, leaving out unbounded fields"""
+    ranges = {
+        "Cash": (cash_min, cash_max),
+        "Gems": (gems_min, gems_max),
+        "TicketCount": (tickets_min, tickets_max),
+        "SRankPets": (s_pets_min, None),
+        "SSRankPets": (ss_pets_min, None),
+        "PassCount": (gamepass_min, gamepass_max)
+    }
+    return {field: bounds for field, bounds in ranges.items() if bounds != (None, None)}
+
+# The pet/item/pass arrays are most of every document; the summary shape leaves them out
+SUMMARY_EXCLUDED_FIELDS = list(LIST_HASH_FIELDS)
+
+def build_latest_projection(fields=None, shape="full", sort_field="PlayerName"):
+    """Projection for /api/latest from the fields= list and shape.
+
+    PlayerName and the sort field are always kept because next_cursor is
+    built from them. Unknown field names are rejected with a 400.
+    """
+    if fields:
+        requested = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in requested if field not in LATEST_PROJECTION or field == "_id"]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    else:
+        requested = [field for field in LATEST_PROJECTION if field != "_id"]
+    
+    if shape == "summary":
+        requested = [field for field in requested if field not in SUMMARY_EXCLUDED_FIELDS]
+    
+    projection = {"_id": 0}
+    for field in ["PlayerName", sort_field] + requested:
+        projection[field] = 1
+    return projection
+
+def build_latest_pipeline(match_filter, skip, limit, sort_field="PlayerName", direction=ASCENDING,
+                          projection=LATEST_PROJECTION):
+    """Aggregation returning one {"total": [{"count": n}], "data": [...]} document.
+
+    Matching and sorting happen before the $facet so they can use the
+    player_latest indexes; the facet then counts and slices the same stream.
+    """
+    pipeline = []
+    if match_filter:
+        pipeline.append({"$match": match_filter})
+    
+    pipeline.extend([
+        # Sort by the requested field, PlayerName breaks ties (matches the compound indexes)
+        {"$sort": latest_sort_spec(sort_field, direction)},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "data": [
+                {"$skip": skip},
+                {"$limit": limit},
+                {"$project": projection}
+            ]
+        }}
+    ])
+    return pipeline
+
+def latest_sort_spec(sort_field, direction):
+    """Sort on sort_field then PlayerName, both in the same direction so one index serves it"""
+    if sort_field == "PlayerName":
+        return {"PlayerName": direction}
+    return {sort_field: direction, "PlayerName": direction}
+
+def encode_cursor(values):
+    """Encode keyset pagination values as an opaque URL-safe cursor"""
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor, rejecting tampered input with a 400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(values, dict):
+            raise ValueError("cursor must decode to an object")
+        return values
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def after_key(match_filter, field, value):
+    """Restrict match_filter to documents sorting strictly after value on field"""
+    if field in match_filter:
+        return {"$and": [match_filter, {field: {"$gt": value}}]}
+    return {**match_filter, field: {"$gt": value}}
+
+def after_sort_key(match_filter, sort_field, direction, value, player_name):
+    """Restrict match_filter to documents after (value, player_name) in latest_sort_spec order"""
+    if sort_field == "PlayerName" and direction == ASCENDING:
+        return after_key(match_filter, "PlayerName", player_name)
+    
+    op = "$gt" if direction == ASCENDING else "$lt"
+    if sort_field == "PlayerName":
+        seek = {"PlayerName": {op: player_name}}
+    else:
+        seek = {"$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "PlayerName": {op: player_name}}
+        ]}
+    return {"$and": [match_filter, seek]} if match_filter else seek
+
+def encode_sort_cursor(last_stat, sort_field):
+    """next_cursor for a page ending with last_stat under the given sort"""
+    values = {"PlayerName": last_stat["PlayerName"]}
+    if sort_field != "PlayerName":
+        value = last_stat.get(sort_field)
+        values["sort"] = sort_field
+        values["value"] = value.isoformat() if isinstance(value, datetime) else value
+    return encode_cursor(values)
+
+def decode_sort_cursor(cursor, sort_field):
+    """(value, PlayerName) from a cursor, which must come from the same sort"""
+    values = decode_cursor(cursor)
+    player_name = values.get("PlayerName")
+    if not isinstance(player_name, str) or values.get("sort", "PlayerName") != sort_field:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    value = values.get("value")
+    if sort_field == "timestamp":
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    elif sort_field != "PlayerName" and not isinstance(value, (int, float, type(None))):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, player_name
+
+@app.post("/ac_stats/batch")
+async def update_stats_batch(request: Request, db_client = Depends(get_db)):
+    """Update stats for many players in one request.
+
+    The body is a JSON array of /ac_stats payloads (either format). Valid
+    items are written together with one bulk upsert; the response has one
+    result per item, in request order.
+    """
+    if ingest_load.overloaded():
+        return shed_load_response()
+    
+    payloads = await read_json_body(request)
+    if not isinstance(payloads, list):
+        raise HTTPException(status_code=400, detail="Batch payload must be a JSON array")
+    if len(payloads) > INGEST_BATCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch is limited to {INGEST_BATCH_MAX} players"
+        )
+    
+    results = []
+    valid = {}
+    for index, payload in enumerate(payloads):
+        try:
+            stats_data, error = prepare_stats(normalize_stats_payload(payload))
+        except ValueError as e:
+            error = str(e)
+        if error:
+            results.append({"index": index, "success": False, "error": error})
+            continue
+        
+        # A later entry for the same player supersedes an earlier one
+        valid[stats_data["PlayerName"]] = stats_data
+        results.append({"index": index, "success": True, "player": stats_data["PlayerName"]})
+    
+    logger.info(f"Processing batch of {len(payloads)} stats ({len(valid)} players)")
+    ingest_load.record(len(payloads))
+    
+    if valid:
+        stats_list = list(valid.values())
+        try:
+            result = await persist_stats(db_client, stats_list)
+        except Exception as e:
+            logger.error(f"Failed to persist stats batch: {e}", exc_info=True)
+            for item in results:
+                if item["success"]:
+                    item.update({"success": False, "error": str(e)})
             return {
-                "success": True, 
-                "message": "Player data updated",
-                "player": stats_data["PlayerName"]
+                "success": False,
+                "error": str(e),
+                "results": results,
+                "next_report_in": ingest_load.next_report_in()
             }
         
-        # Nếu người chơi không tồn tại, thêm mới vào database
-        else:
-            logger.info(f"Player {stats_data['PlayerName']} is new, adding to database")
-            
-            # Insert into MongoDB
-            result = db_client.stats_collection.insert_one(stats_data)
-            
-            # Invalidate latest stats cache
-            cache_invalidate("latest_stats")
-            
-            return {
-                "success": True, 
-                "id": str(result.inserted_id),
-                "message": "New player added"
-            }
-    except Exception as e:
-        logger.error(f"Failed to process stats: {e}", exc_info=True)
-        return {"success": False, "error": str(e)}
+        # Older buffered heartbeats must not overwrite what was just written
+        ingest_buffer.discard(valid)
+        
+        new_players = {stats_list[i]["PlayerName"] for i in result.upserted_ids}
+        for item in results:
+            if item["success"]:
+                item["created"] = item["player"] in new_players
+    
+    succeeded = sum(1 for item in results if item["success"])
+    return {
+        "success": succeeded == len(results),
+        "total": len(results),
+        "successful": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results,
+        "next_report_in": ingest_load.next_report_in()
+    }
+
+def add_range_filter(match_filter, field, min_value, max_value):
+    """Add a $gte/$lte condition on field to a $match filter when bounds are given"""
+    if min_value is None and max_value is None:
+        return
+    match_filter[field] = {}
+    if min_value is not None:
+        match_filter[field]["$gte"] = min_value
+    if max_value is not None:
+        match_filter[field]["$lte"] = max_value
 
 # API security - require authentication for all API routes
 def get_session_user(session: str = Cookie(None)):
@@ -373,52 +3088,82 @@ def get_session_user(session: str = Cookie(None)):
     return sessions[session].get("username")
 
 @app.get("/api/players")
-async def get_players(username: str = Depends(get_session_user), db_client = Depends(get_db)):
+async def get_players(
+    request: Request,
+    response: Response,
+    username: str = Depends(get_session_user),
+    db_client = Depends(get_db)
+):
     """Get list of all players."""
     if not username:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    not_modified = await conditional_get(request, response, ("roster",))
+    if not_modified:
+        return not_modified
         
     # Check cache first
     cache_key = "player_list"
-    cached_data = cache_get(cache_key)
+    cached_data = await cache_get(cache_key)
     if cached_data:
         return cached_data
+    generations = await cache_generations(("roster",))
         
-    # Get unique player names with projection to reduce data transfer
-    pipeline = [
-        {"$group": {"_id": "$PlayerName"}},
-        {"$project": {"PlayerName": "$_id", "_id": 0}}
-    ]
-    
-    players = list(db_client.stats_collection.aggregate(pipeline))
+    # player_latest has exactly one document per player
+    players = await db_client.latest.find(
+        {},
+        {"_id": 0, "PlayerName": 1},
+        sort=[("PlayerName", ASCENDING)]
+    )
     
     # Cache the results
-    cache_set(cache_key, players)
+    await cache_set(cache_key, players, tags=generations)
     
     return players
 
 @app.get("/api/player/{player_name}")
 async def get_player_stats(
+    request: Request,
+    response: Response,
     player_name: str, 
-    limit: int = 10, 
+    limit: int = Query(None, ge=1, description="Max records (default 10, or HISTORY_MAX_POINTS for history queries)"),
+    from_time: datetime = Query(None, alias="from", description="History start (default: 24h before 'to')"),
+    to_time: datetime = Query(None, alias="to", description="History end (default: now)"),
+    resolution: str = Query(None, pattern="^(raw|hour|day|auto)$", description="History resolution"),
     username: str = Depends(get_session_user),
     db_client = Depends(get_db)
 ):
-    """Get stats for a specific player."""
+    """Get stats for a specific player.
+
+    With from/to/resolution, returns points from the history store instead
+    of the current stats document.
+    """
     if not username:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    if from_time is not None or to_time is not None or resolution is not None:
+        return await get_player_history(db_client, player_name, from_time, to_time, resolution, limit)
+    
+    limit = limit or 10
+    
+    not_modified = await conditional_get(request, response, (f"player:{player_name}",))
+    if not_modified:
+        return not_modified
         
     # Check cache first
     cache_key = f"player_{player_name}_limit_{limit}"
-    cached_data = cache_get(cache_key)
+    cached_data = await cache_get(cache_key)
     if cached_data:
         return cached_data
+    generations = await cache_generations((f"player:{player_name}",))
         
     # Get player stats sorted by timestamp (newest first)
-    stats = list(db_client.stats_collection.find(
+    stats = await db_client.stats.find(
         {"PlayerName": player_name},
-        {"_id": 0}
-    ).sort("timestamp", pymongo.DESCENDING).limit(limit))
+        {"_id": 0},
+        sort=[("timestamp", pymongo.DESCENDING)],
+        limit=limit
+    )
     
     # Convert datetime objects to strings
     for stat in stats:
@@ -426,16 +3171,126 @@ async def get_player_stats(
             stat['timestamp'] = stat['timestamp'].isoformat()
     
     # Cache the results
-    cache_set(cache_key, stats)
+    await cache_set(cache_key, stats, tags=generations)
     
     return stats
 
+def to_naive_utc(value):
+    """Normalize a query datetime to the naive UTC datetimes stored in MongoDB"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+async def get_player_history(db_client, player_name, from_time, to_time, resolution, limit):
+    """Query a player's snapshots from the raw, hourly or daily history collection"""
+    if db_client.history is None:
+        raise HTTPException(status_code=400, detail="History mode is disabled (set HISTORY_ENABLED=true)")
+    
+    now = datetime.utcnow()
+    if to_time is None:
+        # Round "now" to a bucket boundary so repeated requests share a cache key. Rounding up
+        # keeps the newest points in range; new points bump the player's tag anyway.
+        bucket_end = math.ceil((now - EPOCH).total_seconds() / HISTORY_CACHE_BUCKET) * HISTORY_CACHE_BUCKET
+        to_time = EPOCH + timedelta(seconds=bucket_end)
+    to_time = to_naive_utc(to_time)
+    from_time = to_naive_utc(from_time) or to_time - timedelta(days=1)
+    if from_time > to_time:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    limit = min(limit or HISTORY_MAX_POINTS, HISTORY_MAX_POINTS)
+    
+    # Auto: the finest resolution still retained for the start of the range
+    if resolution in (None, "auto"):
+        age = (now - from_time).total_seconds()
+        if age <= HISTORY_RAW_TTL:
+            resolution = "raw"
+        elif age <= HISTORY_HOURLY_TTL:
+            resolution = "hour"
+        else:
+            resolution = "day"
+    
+    cache_key = f"player_{player_name}_history_{resolution}_{from_time.isoformat()}_{to_time.isoformat()}_{limit}"
+    cached_data = await cache_get(cache_key)
+    if cached_data:
+        return cached_data
+    generations = await cache_generations((f"player:{player_name}",))
+    
+    projection = {"_id": 0, "timestamp": 1, **{field: 1 for field in HISTORY_FIELDS}}
+    if resolution != "raw":
+        projection["samples"] = 1
+    points = await db_client.history[resolution].find(
+        {"PlayerName": player_name, "timestamp": {"$gte": from_time, "$lte": to_time}},
+        projection,
+        sort=[("timestamp", ASCENDING)],
+        limit=limit
+    )
+    
+    for point in points:
+        point["timestamp"] = point["timestamp"].isoformat()
+    
+    response = {
+        "player": player_name,
+        "resolution": resolution,
+        "from": from_time.isoformat(),
+        "to": to_time.isoformat(),
+        "points": points
+    }
+    await cache_set(cache_key, response, tags=generations)
+    return response
+
+@app.get("/api/player/{player_name}/inventory")
+async def get_player_inventory(
+    player_name: str,
+    at: datetime = Query(..., description="Point in time to rebuild the inventory for"),
+    username: str = Depends(get_session_user),
+    db_client = Depends(get_db)
+):
+    """Rebuild a player's pets, items and passes at a past time from the stored deltas."""
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if db_client.history is None:
+        raise HTTPException(status_code=400, detail="History mode is disabled (set HISTORY_ENABLED=true)")
+    
+    at = to_naive_utc(at)
+    if at < datetime.utcnow() - timedelta(seconds=HISTORY_RAW_TTL):
+        raise HTTPException(status_code=400, detail="'at' is older than the raw history retention")
+    
+    current = await db_client.latest.find_one(
+        {"PlayerName": player_name},
+        {"_id": 0, **{list_field: 1 for list_field in LIST_HASH_FIELDS}}
+    )
+    if not current:
+        raise HTTPException(status_code=404, detail=f"Player '{player_name}' not found")
+    
+    # Walk the deltas newer than 'at' from newest to oldest, undoing each one
+    delta_fields = list(LIST_DELTA_FIELDS.values())
+    snapshots = await db_client.history["raw"].find(
+        {
+            "PlayerName": player_name,
+            "timestamp": {"$gt": at},
+            "$or": [{field: {"$exists": True}} for field in delta_fields]
+        },
+        {"_id": 0, **{field: 1 for field in delta_fields}},
+        sort=[("timestamp", DESCENDING)]
+    )
+    
+    inventory = {list_field: current.get(list_field) or [] for list_field in LIST_HASH_FIELDS}
+    for snapshot in snapshots:
+        for list_field, delta_field in LIST_DELTA_FIELDS.items():
+            if delta_field in snapshot:
+                inventory[list_field] = revert_entries(inventory[list_field], snapshot[delta_field])
+    
+    return {"player": player_name, "at": at.isoformat(), **inventory}
+
 @app.get("/api/latest")
 async def get_latest_stats(
+    request: Request,
+    response: Response,
     username: str = Depends(get_session_user),
     page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=10, le=200),
+    cursor: str = Query(None, description="Opaque next_cursor from the previous page; overrides page"),
     search: str = Query(None),
+    search_mode: str = Query("contains", pattern="^(contains|prefix)$", description="Case-insensitive name match"),
     # Thêm các tham số filter mới
     cash_min: int = Query(None, description="Min Cash value"),
     cash_max: int = Query(None, description="Max Cash value"),
@@ -447,12 +3302,24 @@ async def get_latest_stats(
     ss_pets_min: int = Query(None, description="Min SS rank pets"),
     gamepass_min: int = Query(None, description="Min gamepass count"),
     gamepass_max: int = Query(None, description="Max gamepass count"),
+    sort: str = Query("PlayerName", description=f"One of: {', '.join(SORT_FIELDS)}"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    fields: str = Query(None, description="Comma-separated fields to return (PlayerName is always included)"),
+    shape: str = Query("full", pattern="^(full|summary)$", description="summary leaves out PetsList/ItemsList/PassesList"),
     db_client = Depends(get_db)
 ):
-    """Get latest stats for all players with pagination and search."""
+    """Get latest stats for all players with pagination, search and sorting.
+
+    Responses carry an ETag tied to the "latest" cache generation; a matching
+    If-None-Match gets an empty 304 without touching the cache or database.
+    """
     if not username:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    not_modified = await conditional_get(request, response, ("latest",))
+    if not_modified:
+        return not_modified
+    
     # Log filter parameters
     logger.info(f"Get latest stats: page={page}, page_size={page_size}, search={search}, " 
                 f"cash_min={cash_min}, cash_max={cash_max}, gems_min={gems_min}, gems_max={gems_max}, "
@@ -462,328 +3329,79 @@ async def get_latest_stats(
     # Build cache key with all filter parameters
     filter_params = f"cash_{cash_min}_{cash_max}_gems_{gems_min}_{gems_max}_tickets_{tickets_min}_{tickets_max}_" \
                     f"s_pets_{s_pets_min}_ss_pets_{ss_pets_min}_gamepass_{gamepass_min}_{gamepass_max}"
-    cache_key = f"latest_stats_page_{page}_size_{page_size}_search_{search or 'none'}_filter_{filter_params}"
+    query_key = f"search_{search or 'none'}_{search_mode}_filter_{filter_params}"
+    cache_key = f"latest_stats_page_{page}_size_{page_size}_cursor_{cursor or 'none'}_{query_key}" \
+                f"_sort_{sort}_{order}_fields_{fields or 'all'}_{shape}"
     
-    cached_data = cache_get(cache_key)
+    cached_data = await cache_get(cache_key)
     if cached_data:
         return cached_data
+    generations = await cache_generations(("latest",))
+    
+    if sort not in SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Invalid sort field, expected one of: {', '.join(SORT_FIELDS)}")
+    direction = ASCENDING if order == "asc" else DESCENDING
+    projection = build_latest_projection(fields, shape, sort)
     
     try:
-        # Create base match filter
-        match_filter = {}
-        
-        # Add search filter if provided
-        if search:
-            match_filter["PlayerName"] = {"$regex": search, "$options": "i"}
-        
-        # Add filters for numerical fields
-        if cash_min is not None or cash_max is not None:
-            match_filter["Cash"] = {}
-            if cash_min is not None:
-                match_filter["Cash"]["$gte"] = cash_min
-            if cash_max is not None:
-                match_filter["Cash"]["$lte"] = cash_max
-                
-        if gems_min is not None or gems_max is not None:
-            match_filter["Gems"] = {}
-            if gems_min is not None:
-                match_filter["Gems"]["$gte"] = gems_min
-            if gems_max is not None:
-                match_filter["Gems"]["$lte"] = gems_max
-        
-        # We'll use MongoDB aggregation for more complex filters on arrays and nested fields
-        
-        # Pipeline for counting total records matching the filter
-        total_count_pipeline = []
-        if match_filter:
-            total_count_pipeline.append({"$match": match_filter})
-        
-        # Additional filter stages for complex filtering will be applied after getting initial data
-        # First get all unique players that match basic filters
-        total_count_pipeline.extend([
-            {"$sort": {"timestamp": -1}},
-            {"$group": {"_id": "$PlayerName", "doc": {"$first": "$$ROOT"}}},
-            {"$replaceRoot": {"newRoot": "$doc"}}
-        ])
-        
-        # Apply complex filters on tickets, pets, and gamepasses
-        if tickets_min is not None or tickets_max is not None:
-            ticket_match = {}
-            if tickets_min is not None:
-                ticket_match["$match"] = {
-                    "$expr": {
-                        "$gte": [
-                            {"$ifNull": [
-                                {"$arrayElemAt": [
-                                    {"$filter": {
-                                        "input": {"$ifNull": ["$ItemsList", []]},
-                                        "as": "item",
-                                        "cond": {"$eq": ["$$item.Name", "Ticket"]}
-                                    }},
-                                    0
-                                ]}, 
-                                {"Amount": 0}
-                            ]}.Amount,
-                            tickets_min
-                        ]
-                    }
-                }
-                total_count_pipeline.append(ticket_match)
-            
-            if tickets_max is not None:
-                ticket_match = {"$match": {
-                    "$expr": {
-                        "$lte": [
-                            {"$ifNull": [
-                                {"$arrayElemAt": [
-                                    {"$filter": {
-                                        "input": {"$ifNull": ["$ItemsList", []]},
-                                        "as": "item",
-                                        "cond": {"$eq": ["$$item.Name", "Ticket"]}
-                                    }},
-                                    0
-                                ]}, 
-                                {"Amount": 0}
-                            ]}.Amount,
-                            tickets_max
-                        ]
-                    }
-                }}
-                total_count_pipeline.append(ticket_match)
-        
-        # Apply S-rank pets filter
-        if s_pets_min is not None:
-            s_pet_match = {"$match": {
-                "$expr": {
-                    "$gte": [
-                        {"$size": {
-                            "$filter": {
-                                "input": {"$ifNull": ["$PetsList", []]},
-                                "as": "pet",
-                                "cond": {"$eq": ["$$pet.Rank", "S"]}
-                            }
-                        }},
-                        s_pets_min
-                    ]
-                }
-            }}
-            total_count_pipeline.append(s_pet_match)
-        
-        # Apply SS-rank pets filter
-        if ss_pets_min is not None:
-            ss_pet_match = {"$match": {
-                "$expr": {
-                    "$gte": [
-                        {"$size": {
-                            "$filter": {
-                                "input": {"$ifNull": ["$PetsList", []]},
-                                "as": "pet",
-                                "cond": {"$or": [
-                                    {"$eq": ["$$pet.Rank", "SS"]},
-                                    {"$eq": ["$$pet.Rank", "G"]}
-                                ]}
-                            }
-                        }},
-                        ss_pets_min
-                    ]
-                }
-            }}
-            total_count_pipeline.append(ss_pet_match)
-        
-        # Apply gamepass filter
-        if gamepass_min is not None or gamepass_max is not None:
-            gamepass_match = {"$match": {}}
-            expr_conditions = []
-            
-            if gamepass_min is not None:
-                expr_conditions.append({
-                    "$gte": [
-                        {"$size": {"$ifNull": ["$PassesList", []]}},
-                        gamepass_min
-                    ]
-                })
-            
-            if gamepass_max is not None:
-                expr_conditions.append({
-                    "$lte": [
-                        {"$size": {"$ifNull": ["$PassesList", []]}},
-                        gamepass_max
-                    ]
-                })
-            
-            if len(expr_conditions) == 1:
-                gamepass_match["$match"]["$expr"] = expr_conditions[0]
-            else:
-                gamepass_match["$match"]["$expr"] = {"$and": expr_conditions}
-            
-            total_count_pipeline.append(gamepass_match)
-        
-        # Count final results
-        total_count_pipeline.append({"$count": "count"})
-        
-        total_count_cursor = db_client.stats_collection.aggregate(total_count_pipeline)
-        total_count_list = list(total_count_cursor)
-        total_count = total_count_list[0]["count"] if total_count_list else 0
-        
-        # Skip for pagination
-        skip = (page - 1) * page_size
-        
-        # Pipeline for actual data retrieval
-        pipeline = []
-        
-        # Apply basic match filters first
-        if match_filter:
-            pipeline.append({"$match": match_filter})
-        
-        # Sort and group to get most recent stats for each player
-        pipeline.extend([
-            {"$sort": {"timestamp": -1}},
-            {"$group": {
-                "_id": "$PlayerName",
-                "latest": {"$first": "$$ROOT"}
-            }},
-            {"$replaceRoot": {"newRoot": "$latest"}}
-        ])
-        
-        # Apply complex filters - same as in count pipeline
-        if tickets_min is not None or tickets_max is not None:
-            if tickets_min is not None:
-                ticket_match = {"$match": {
-                    "$expr": {
-                        "$gte": [
-                            {"$ifNull": [
-                                {"$arrayElemAt": [
-                                    {"$filter": {
-                                        "input": {"$ifNull": ["$ItemsList", []]},
-                                        "as": "item",
-                                        "cond": {"$eq": ["$$item.Name", "Ticket"]}
-                                    }},
-                                    0
-                                ]}, 
-                                {"Amount": 0}
-                            ]}.Amount,
-                            tickets_min
-                        ]
-                    }
-                }}
-                pipeline.append(ticket_match)
-            
-            if tickets_max is not None:
-                ticket_match = {"$match": {
-                    "$expr": {
-                        "$lte": [
-                            {"$ifNull": [
-                                {"$arrayElemAt": [
-                                    {"$filter": {
-                                        "input": {"$ifNull": ["$ItemsList", []]},
-                                        "as": "item",
-                                        "cond": {"$eq": ["$$item.Name", "Ticket"]}
-                                    }},
-                                    0
-                                ]}, 
-                                {"Amount": 0}
-                            ]}.Amount,
-                            tickets_max
-                        ]
-                    }
-                }}
-                pipeline.append(ticket_match)
-        
-        # Apply S-rank pets filter
-        if s_pets_min is not None:
-            s_pet_match = {"$match": {
-                "$expr": {
-                    "$gte": [
-                        {"$size": {
-                            "$filter": {
-                                "input": {"$ifNull": ["$PetsList", []]},
-                                "as": "pet",
-                                "cond": {"$eq": ["$$pet.Rank", "S"]}
-                            }
-                        }},
-                        s_pets_min
-                    ]
-                }
-            }}
-            pipeline.append(s_pet_match)
-        
-        # Apply SS-rank pets filter
-        if ss_pets_min is not None:
-            ss_pet_match = {"$match": {
-                "$expr": {
-                    "$gte": [
-                        {"$size": {
-                            "$filter": {
-                                "input": {"$ifNull": ["$PetsList", []]},
-                                "as": "pet",
-                                "cond": {"$or": [
-                                    {"$eq": ["$$pet.Rank", "SS"]},
-                                    {"$eq": ["$$pet.Rank", "G"]}
-                                ]}
-                            }
-                        }},
-                        ss_pets_min
-                    ]
-                }
-            }}
-            pipeline.append(ss_pet_match)
+        # Settled seq read before the page: a write still in flight when the page is read has a
+        # higher seq than the token (see settled_sequence), so /api/latest/changes replays it
+        sync_token = encode_sync_token(await settled_sequence(db_client))
         
-        # Apply gamepass filter
-        if gamepass_min is not None or gamepass_max is not None:
-            gamepass_match = {"$match": {}}
-            expr_conditions = []
-            
-            if gamepass_min is not None:
-                expr_conditions.append({
-                    "$gte": [
-                        {"$size": {"$ifNull": ["$PassesList", []]}},
-                        gamepass_min
-                    ]
-                })
-            
-            if gamepass_max is not None:
-                expr_conditions.append({
-                    "$lte": [
-                        {"$size": {"$ifNull": ["$PassesList", []]}},
-                        gamepass_max
-                    ]
-                })
-            
-            if len(expr_conditions) == 1:
-                gamepass_match["$match"]["$expr"] = expr_conditions[0]
+        if COLUMNAR_ENABLED and columnar_latest.loaded:
+            # In-memory columnar snapshot: same filters, sort and cursor semantics, no aggregation
+            total_count, latest_stats = columnar_latest.query(
+                build_latest_ranges(cash_min, cash_max, gems_min, gems_max, tickets_min, tickets_max,
+                                    s_pets_min, ss_pets_min, gamepass_min, gamepass_max),
+                search=search,
+                search_mode=search_mode,
+                sort_field=sort,
+                direction=direction,
+                skip=0 if cursor else (page - 1) * page_size,
+                limit=page_size,
+                after=decode_sort_cursor(cursor, sort) if cursor else None,
+                projection=projection
+            )
+        else:
+            match_filter = build_latest_filter(
+                search=search,
+                cash_min=cash_min, cash_max=cash_max,
+                gems_min=gems_min, gems_max=gems_max,
+                tickets_min=tickets_min, tickets_max=tickets_max,
+                s_pets_min=s_pets_min, ss_pets_min=ss_pets_min,
+                gamepass_min=gamepass_min, gamepass_max=gamepass_max,
+                search_mode=search_mode
+            )
+            if cursor:
+                # Keyset mode: seek past the last (sort value, PlayerName) on the compound index, no skip
+                last_value, last_player = decode_sort_cursor(cursor, sort)
+                
+                latest_stats = await db_client.latest.find(
+                    after_sort_key(match_filter, sort, direction, last_value, last_player),
+                    projection,
+                    sort=list(latest_sort_spec(sort, direction).items()),
+                    limit=page_size
+                )
+                
+                # The total only depends on the filters, so it is cached apart from the pages
+                count_key = f"latest_stats_count_{query_key}"
+                total_count = await cache_get(count_key)
+                if total_count is None:
+                    total_count = await db_client.latest.count_documents(match_filter)
+                    await cache_set(count_key, total_count, tags=generations)
             else:
-                gamepass_match["$match"]["$expr"] = {"$and": expr_conditions}
-            
-            pipeline.append(gamepass_match)
-        
-        # Final sorting, pagination and projection
-        pipeline.extend([
-            # Sort results by player name
-            {"$sort": {"PlayerName": 1}},
-            
-            # Skip records for pagination
-            {"$skip": skip},
-            
-            # Limit records per page
-            {"$limit": page_size},
-            
-            # Project only needed fields
-            {"$project": {
-                "_id": 0,
-                "PlayerName": 1,
-                "Cash": 1,
-                "FormattedCash": 1,
-                "Gems": 1,
-                "FormattedGems": 1,
-                "PetCount": 1,
-                "PetsList": 1,
-                "ItemsList": 1,
-                "PassesList": 1,
-                "timestamp": 1
-            }}
-        ])
+                # One round trip returns both the filtered total and the requested page
+                skip = (page - 1) * page_size
+                result = await db_client.latest.aggregate(
+                    build_latest_pipeline(match_filter, skip, page_size, sort, direction, projection)
+                )
+                facet = result[0] if result else {"total": [], "data": []}
+                total_count = facet["total"][0]["count"] if facet["total"] else 0
+                latest_stats = facet["data"]
         
-        latest_stats = list(db_client.stats_collection.aggregate(pipeline))
+        next_cursor = None
+        if len(latest_stats) == page_size:
+            next_cursor = encode_sort_cursor(latest_stats[-1], sort)
         
         # Convert datetime objects to strings
         for stat in latest_stats:
@@ -791,14 +3409,19 @@ async def get_latest_stats(
                 stat['timestamp'] = stat['timestamp'].isoformat()
         
         # Prepare response with pagination info and filter parameters
-        response = {
+        page_data = {
             "data": latest_stats,
+            "sync_token": sync_token,
             "pagination": {
                 "page": page,
                 "page_size": page_size,
                 "total_items": total_count,
                 "total_pages": (total_count + page_size - 1) // page_size,
-                "search": search or ""
+                "search": search or "",
+                "cursor": cursor,
+                "next_cursor": next_cursor,
+                "sort": sort,
+                "order": order
             },
             "filters": {
                 "cash_min": cash_min,
@@ -815,9 +3438,11 @@ async def get_latest_stats(
         }
         
         # Cache the results
-        cache_set(cache_key, response)
+        await cache_set(cache_key, page_data, tags=generations)
         
-        return response
+        return page_data
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in get_latest_stats: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -825,6 +3450,267 @@ async def get_latest_stats(
             detail=f"Database error: {str(e)}"
         )
 
+def export_csv_value(stat, column):
+    value = stat.get(column)
+    if column in LIST_HASH_FIELDS:
+        return orjson.dumps(value or []).decode("utf-8")
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return "" if value is None else value
+
+async def export_chunks(stat_batches, export_format, compress):
+    """Encode batches of player_latest documents as NDJSON or CSV, optionally gzipped"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    
+    def encode_csv(rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+    
+    async def chunks():
+        if export_format == "csv":
+            yield encode_csv([EXPORT_CSV_COLUMNS])
+        async for batch in stat_batches:
+            if export_format == "csv":
+                yield encode_csv([[export_csv_value(stat, column) for column in EXPORT_CSV_COLUMNS] for stat in batch])
+            else:
+                yield b"".join(orjson.dumps(stat, default=str, option=orjson.OPT_APPEND_NEWLINE) for stat in batch)
+    
+    async for chunk in chunks():
+        if compressor:
+            chunk = compressor.compress(chunk)
+            if not chunk:
+                continue
+        yield chunk
+    if compressor:
+        yield compressor.flush()
+
+@app.get("/api/latest/export")
+async def export_latest_stats(
+    username: str = Depends(get_session_user),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="ndjson or csv"),
+    compress: bool = Query(False, description="Gzip the stream (Content-Encoding: gzip)"),
+    search: str = Query(None),
+    search_mode: str = Query("contains", pattern="^(contains|prefix)$", description="Case-insensitive name match"),
+    cash_min: int = Query(None, description="Min Cash value"),
+    cash_max: int = Query(None, description="Max Cash value"),
+    gems_min: int = Query(None, description="Min Gems value"),
+    gems_max: int = Query(None, description="Max Gems value"),
+    tickets_min: int = Query(None, description="Min Tickets value"),
+    tickets_max: int = Query(None, description="Max Tickets value"),
+    s_pets_min: int = Query(None, description="Min S rank pets"),
+    ss_pets_min: int = Query(None, description="Min SS rank pets"),
+    gamepass_min: int = Query(None, description="Min gamepass count"),
+    gamepass_max: int = Query(None, description="Max gamepass count"),
+    db_client = Depends(get_db)
+):
+    """Stream every matching player's latest stats in one response.
+
+    Documents are read from a server-side cursor in batches of
+    EXPORT_BATCH_SIZE, so memory use does not grow with the player count.
+    X-Total-Count carries the number of matching players for progress bars and
+    X-Sync-Token the /api/latest/changes token to continue from.
+    """
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    match_filter = build_latest_filter(
+        search=search,
+        cash_min=cash_min, cash_max=cash_max,
+        gems_min=gems_min, gems_max=gems_max,
+        tickets_min=tickets_min, tickets_max=tickets_max,
+        s_pets_min=s_pets_min, ss_pets_min=ss_pets_min,
+        gamepass_min=gamepass_min, gamepass_max=gamepass_max,
+        search_mode=search_mode
+    )
+    try:
+        sync_token = encode_sync_token(await settled_sequence(db_client))
+        total_count = await db_client.latest.count_documents(match_filter)
+    except Exception as e:
+        logger.error(f"Error in export_latest_stats: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    
+    stat_batches = db_client.latest.find_batches(
+        match_filter,
+        LATEST_PROJECTION,
+        sort=[("PlayerName", ASCENDING)],
+        batch_size=EXPORT_BATCH_SIZE
+    )
+    
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    headers = {
+        "X-Total-Count": str(total_count),
+        "X-Sync-Token": sync_token,
+        "Content-Disposition": f'attachment; filename="latest_stats.{format}"',
+        "Cache-Control": "no-store"
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    
+    logger.info(f"Exporting {total_count} players as {format}{' (gzip)' if compress else ''} for {username}")
+    return StreamingResponse(export_chunks(stat_batches, format, compress), media_type=media_type, headers=headers)
+
+@app.get("/api/latest/changes")
+async def get_latest_changes(
+    since: str = Query(..., description="sync_token from /api/latest, /api/latest/export or a previous call"),
+    limit: int = Query(500, ge=1, le=5000),
+    shape: str = Query("full", pattern="^(full|summary)$", description="summary leaves out PetsList/ItemsList/PassesList"),
+    username: str = Depends(get_session_user),
+    db_client = Depends(get_db)
+):
+    """Players updated or deleted since a sync token, in change order.
+
+    Returns {"updated": [...], "deleted": [names], "sync_token", "has_more"}.
+    A token older than CHANGES_RETENTION may have missed deletions whose
+    tombstones expired, so the response is {"reset": true} and the client
+    should reload the full table. Changes newer than CHANGES_SETTLE_SECONDS
+    are held back so a write that reserved a lower seq but has not landed yet
+    is never skipped.
+    """
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    token = decode_cursor(since)
+    since_seq, issued_at = token.get("seq"), token.get("t")
+    if not isinstance(since_seq, int) or not isinstance(issued_at, int):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    
+    try:
+        if time.time() - issued_at > CHANGES_RETENTION:
+            return {"reset": True, "sync_token": encode_sync_token(await settled_sequence(db_client))}
+        
+        projection = {**build_latest_projection(None, shape), "seq": 1, "updated_at": 1}
+        updated, deleted = await asyncio.gather(
+            db_client.latest.find({"seq": {"$gt": since_seq}}, projection, sort=[("seq", ASCENDING)], limit=limit),
+            db_client.tombstones.find(
+                {"seq": {"$gt": since_seq}},
+                {"_id": 0, "PlayerName": 1, "seq": 1, "deleted_at": 1},
+                sort=[("seq", ASCENDING)],
+                limit=limit
+            )
+        )
+    except Exception as e:
+        logger.error(f"Error in get_latest_changes: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    
+    changes = sorted(
+        [(doc["seq"], doc.get("updated_at"), doc, False) for doc in updated] +
+        [(doc["seq"], doc.get("deleted_at"), doc, True) for doc in deleted],
+        key=lambda change: change[0]
+    )
+    settled_before = datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    
+    # Latest change per player wins (a player can be deleted and then report again)
+    latest_changes = {}
+    last_seq = since_seq
+    has_more = len(updated) == limit or len(deleted) == limit
+    pending = has_more
+    for seq, changed_at, doc, is_delete in changes:
+        if len(latest_changes) >= limit:
+            has_more = pending = True
+            break
+        if changed_at and changed_at > settled_before:
+            pending = True
+            break
+        latest_changes[doc["PlayerName"]] = (doc, is_delete)
+        last_seq = seq
+    
+    updated_players = []
+    deleted_players = []
+    for player_name, (doc, is_delete) in latest_changes.items():
+        if is_delete:
+            deleted_players.append(player_name)
+            continue
+        doc.pop("seq", None)
+        doc.pop("updated_at", None)
+        if "timestamp" in doc:
+            doc["timestamp"] = doc["timestamp"].isoformat()
+        updated_players.append(doc)
+    
+    return {
+        "updated": updated_players,
+        "deleted": deleted_players,
+        # Keep the old issue time while changes are left behind, so their tombstones count as retained
+        "sync_token": encode_sync_token(last_seq, issued_at if pending else None),
+        "has_more": has_more
+    }
+
+@app.get("/api/stream")
+async def stream_events(request: Request, username: str = Depends(get_session_user)):
+    """Server-Sent Events feed of player updates and deletions.
+
+    "update" and "delete" events carry JSON data; a "resync" event means this
+    client fell behind and lost events, so it should catch up through
+    /api/latest/changes. Comment lines are sent as keepalives.
+    """
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if len(event_hub.subscribers) >= STREAM_MAX_CLIENTS:
+        raise HTTPException(status_code=503, detail="Too many live connections")
+    
+    subscription = event_hub.subscribe()
+    
+    async def events():
+        try:
+            yield b"retry: 5000\n\n"
+            while not subscription.closed and not await request.is_disconnected():
+                batch = await subscription.get(STREAM_HEARTBEAT_INTERVAL)
+                if subscription.dropped:
+                    yield f"event: resync\ndata: {subscription.dropped}\n\n".encode("utf-8")
+                    subscription.dropped = 0
+                if not batch:
+                    yield b": keepalive\n\n"
+                    continue
+                yield b"".join(b"data: " + data + b"\n\n" for data in batch)
+        finally:
+            event_hub.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Stop reverse proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def delete_players(db_client, player_names):
+    """Delete players from player_stats and player_latest, DELETE_CHUNK_SIZE names at a time.
+
+    Each chunk costs one grouped count (the per-player breakdown) and one
+    delete_many per collection. Analytics, tombstones, the live feed, the
+    columnar snapshot and the cache are all updated once for the whole batch.
+    Returns {player_name: deleted player_stats documents} for the players found.
+    """
+    names = list(dict.fromkeys(player_names))
+    deleted = {}
+    try:
+        for start in range(0, len(names), DELETE_CHUNK_SIZE):
+            chunk = names[start:start + DELETE_CHUNK_SIZE]
+            grouped = await db_client.stats.aggregate([
+                {"$match": {"PlayerName": {"$in": chunk}}},
+                {"$group": {"_id": "$PlayerName", "count": {"$sum": 1}}}
+            ])
+            found = {group["_id"]: group["count"] for group in grouped}
+            if not found:
+                continue
+            
+            # player_latest first: if its delete is deferred, player_stats still finds the players on retry
+            await delete_latest(db_client, found)
+            await db_client.stats.delete_many({"PlayerName": {"$in": list(found)}})
+            deleted.update(found)
+    finally:
+        # Chunks deleted before a failure are still reported
+        if deleted:
+            deleted_names = list(deleted)
+            # A buffered heartbeat would otherwise bring the player straight back
+            ingest_buffer.discard(deleted_names)
+            await record_tombstones(db_client, deleted_names)
+            publish_player_deletes(deleted_names)
+            for player_name in deleted_names:
+                name_index.remove(player_name)
+                columnar_latest.remove(player_name)
+            await cache_invalidate_tags([f"player:{name}" for name in deleted_names] + ["latest", "roster"])
+    return deleted
+
 @app.delete("/api/player/{player_name}", status_code=status.HTTP_200_OK)
 async def delete_player(
     player_name: str,
@@ -838,46 +3724,26 @@ async def delete_player(
     try:
         logger.info(f"DELETE request received for player: {player_name}")
         
-        # Check if player exists
-        player_count = db_client.stats_collection.count_documents({"PlayerName": player_name})
-        logger.info(f"Found {player_count} records for player {player_name}")
-        
-        if player_count == 0:
+        deleted = await delete_players(db_client, [player_name])
+        if player_name not in deleted:
             logger.warning(f"Player {player_name} not found in database")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Player '{player_name}' not found"
             )
         
-        # Delete all records for this player
-        result = db_client.stats_collection.delete_many({"PlayerName": player_name})
-        
-        logger.info(f"Deleted {result.deleted_count} records for player {player_name}")
-        
-        # Verify the player was actually deleted
-        remaining = db_client.stats_collection.count_documents({"PlayerName": player_name})
-        if remaining > 0:
-            logger.warning(f"Still found {remaining} records for player {player_name} after deletion attempt")
-            # Try again with a forceful approach
-            result2 = db_client.stats_collection.delete_many({"PlayerName": player_name}, {"w": 1})
-            logger.info(f"Second deletion attempt result: {result2.deleted_count} records deleted")
-            remaining = db_client.stats_collection.count_documents({"PlayerName": player_name})
-        
-        success = (remaining == 0)
-        
-        # Invalidate cache
-        cache_invalidate(f"player_{player_name}")
-        cache_invalidate("latest_stats")
-        cache_invalidate("player_list")
+        logger.info(f"Deleted {deleted[player_name]} records for player {player_name}")
         
         return {
-            "success": success, 
+            "success": True, 
             "player": player_name, 
-            "deleted_count": result.deleted_count,
-            "remaining_count": remaining
+            "deleted_count": deleted[player_name],
+            "remaining_count": 0
         }
     except HTTPException:
         raise  # Re-raise HTTP exceptions
+    except WriteDeferred as e:
+        raise write_deferred(e)
     except Exception as e:
         logger.error(f"Error deleting player {player_name}: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -898,70 +3764,35 @@ async def delete_multiple_players(
     try:
         logger.info(f"BATCH DELETE request received for {len(player_names)} players")
         
-        results = {
-            "success": True,
-            "total_deleted": 0,
-            "player_results": []
-        }
+        deleted = await delete_players(db_client, player_names)
         
-        for player_name in player_names:
-            try:
-                # Check if player exists
-                player_count = db_client.stats_collection.count_documents({"PlayerName": player_name})
-                
-                if player_count == 0:
-                    # Skip non-existent players
-                    results["player_results"].append({
-                        "player": player_name,
-                        "success": False,
-                        "deleted_count": 0,
-                        "error": "Player not found"
-                    })
-                    continue
-                
-                # Delete records for this player
-                delete_result = db_client.stats_collection.delete_many({"PlayerName": player_name})
-                
-                # Check if deletion was successful
-                remaining = db_client.stats_collection.count_documents({"PlayerName": player_name})
-                
-                if remaining > 0:
-                    # Try one more time with write concern
-                    retry_result = db_client.stats_collection.delete_many({"PlayerName": player_name}, {"w": 1})
-                    delete_result.deleted_count += retry_result.deleted_count
-                    remaining = db_client.stats_collection.count_documents({"PlayerName": player_name})
-                
-                player_success = remaining == 0
-                results["total_deleted"] += delete_result.deleted_count
-                
-                results["player_results"].append({
+        player_results = []
+        for player_name in dict.fromkeys(player_names):
+            if player_name in deleted:
+                player_results.append({
                     "player": player_name,
-                    "success": player_success,
-                    "deleted_count": delete_result.deleted_count,
-                    "remaining_count": remaining
+                    "success": True,
+                    "deleted_count": deleted[player_name],
+                    "remaining_count": 0
                 })
-                
-                if not player_success:
-                    results["success"] = False
-                
-                # Invalidate cache for this player
-                cache_invalidate(f"player_{player_name}")
-                
-            except Exception as e:
-                logger.error(f"Error deleting player {player_name}: {str(e)}")
-                results["player_results"].append({
+            else:
+                # Skip non-existent players
+                player_results.append({
                     "player": player_name,
                     "success": False,
-                    "error": str(e)
+                    "deleted_count": 0,
+                    "error": "Player not found"
                 })
-                results["success"] = False
-        
-        # Invalidate general caches
-        cache_invalidate("latest_stats")
-        cache_invalidate("player_list")
         
-        return results
+        logger.info(f"Batch delete removed {len(deleted)} of {len(player_results)} players")
+        return {
+            "success": True,
+            "total_deleted": sum(deleted.values()),
+            "player_results": player_results
+        }
         
+    except WriteDeferred as e:
+        raise write_deferred(e)
     except Exception as e:
         logger.error(f"Error in batch delete: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -976,7 +3807,7 @@ async def clear_cache(username: str = Depends(get_session_user), key_prefix: str
     if not username:
         raise HTTPException(status_code=401, detail="Not authenticated")
         
-    cache_invalidate(key_prefix)
+    await cache_invalidate(key_prefix)
     return {"success": True, "message": "Cache cleared"}
 
 # Endpoint to get cache status
@@ -986,43 +3817,45 @@ async def cache_status(username: str = Depends(get_session_user)):
     if not username:
         raise HTTPException(status_code=401, detail="Not authenticated")
         
-    cache_info = {
-        "entries": len(cache),
-        "keys": list(cache.keys()),
-        "expires": {k: v["expires"].isoformat() for k, v in cache.items()},
-        "size_estimate": sum(len(str(v["data"])) for v in cache.values())
-    }
+    # Sizes are tracked when entries are stored, nothing is re-serialized here
+    cache_info = await run_cache(cache.stats)
+    cache_info["size_estimate"] = cache_info["size_bytes"]
+    cache_info["keys"] = await run_cache(cache.keys)
     
     return cache_info
 
 @app.get("/api/latest/count")
-async def get_player_count(username: str = Depends(get_session_user), db_client = Depends(get_db)):
+async def get_player_count(
+    request: Request,
+    response: Response,
+    username: str = Depends(get_session_user),
+    db_client = Depends(get_db)
+):
     """Get total number of unique players"""
     if not username:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    not_modified = await conditional_get(request, response, ("roster",))
+    if not_modified:
+        return not_modified
         
     # Check cache
     cache_key = "player_count"
-    cached_data = cache_get(cache_key)
+    cached_data = await cache_get(cache_key)
     if cached_data:
         return cached_data
+    generations = await cache_generations(("roster",))
         
     try:
-        # Count unique players
-        pipeline = [
-            {"$group": {"_id": "$PlayerName"}},
-            {"$count": "count"}
-        ]
+        # player_latest holds one document per player, so its size is the player count
+        count = await db_client.latest.estimated_document_count()
         
-        result = list(db_client.stats_collection.aggregate(pipeline))
-        count = result[0]["count"] if result else 0
-        
-        response = {"count": count}
+        count_data = {"count": count}
         
         # Cache the result
-        cache_set(cache_key, response)
+        await cache_set(cache_key, count_data, tags=generations)
         
-        return response
+        return count_data
     except Exception as e:
         logger.error(f"Error getting player count: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -1030,6 +3863,132 @@ async def get_player_count(username: str = Depends(get_session_user), db_client
             detail=f"Database error: {str(e)}"
         )
 
+def histogram_buckets(counts):
+    """magnitude_bucket counts as sorted [{"min", "max", "count"}] ranges (max exclusive)"""
+    buckets = []
+    for digits in sorted(int(key) for key, count in counts.items() if count):
+        buckets.append({
+            "min": 0 if digits == 0 else 10 ** (digits - 1),
+            "max": 1 if digits == 0 else 10 ** digits,
+            "count": counts[str(digits)]
+        })
+    return buckets
+
+@app.get("/api/analytics/summary")
+async def get_analytics_summary(
+    request: Request,
+    response: Response,
+    histogram: bool = Query(False, description="Include Cash/Gems/TicketCount histograms (powers of ten)"),
+    username: str = Depends(get_session_user),
+    db_client = Depends(get_db)
+):
+    """Fleet-wide totals, averages and pet rank distribution.
+
+    Served from the running analytics document that persist_stats and the
+    delete endpoints keep current, so no player documents are scanned.
+    """
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    not_modified = await conditional_get(request, response, ("latest",))
+    if not_modified:
+        return not_modified
+    
+    try:
+        analytics = await db_client.analytics.find_one({"_id": "latest_totals"})
+        if not analytics or "rebuilt_at" not in analytics:
+            analytics = await rebuild_analytics(db_client)
+    except Exception as e:
+        logger.error(f"Error in get_analytics_summary: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if analytics is None:
+        # First build still running in another worker
+        raise HTTPException(status_code=503, detail="Analytics are being built", headers={"Retry-After": "5"})
+    
+    players = analytics.get("players", 0)
+    sums = analytics.get("sums", {})
+    ranks = {rank: count for rank, count in analytics.get("ranks", {}).items() if count}
+    rank_order = {name: number for number, name in RANK_NAMES.items()}
+    
+    summary = {
+        "players": players,
+        # Kept as doubles like the stored sums: a fleet-wide Cash total can exceed int64, which JSON encoding rejects
+        "totals": {field: round(float(sums.get(field, 0)), 0) for field in ANALYTICS_SUM_FIELDS},
+        "averages": {
+            field: round(sums.get(field, 0) / players, 2) if players else 0
+            for field in ANALYTICS_SUM_FIELDS
+        },
+        "rank_distribution": dict(sorted(ranks.items(), key=lambda item: rank_order.get(item[0], 0))),
+        "rebuilt_at": analytics["rebuilt_at"].isoformat()
+    }
+    if histogram:
+        summary["histograms"] = {
+            field: histogram_buckets(analytics.get("histograms", {}).get(field, {}))
+            for field in ANALYTICS_HISTOGRAM_FIELDS
+        }
+    return summary
+
+@app.post("/api/analytics/rebuild")
+async def post_analytics_rebuild(username: str = Depends(get_session_user), db_client = Depends(get_db)):
+    """Recompute the running totals from player_latest (e.g. after manual database edits)"""
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    analytics = await rebuild_analytics(db_client)
+    if analytics is None:
+        raise HTTPException(status_code=409, detail="An analytics rebuild is already running")
+    await cache_invalidate_tag("latest")
+    return {"success": True, "players": analytics["players"], "rebuilt_at": analytics["rebuilt_at"].isoformat()}
+
+@app.get("/api/analytics/top")
+async def get_analytics_top(
+    request: Request,
+    response: Response,
+    field: str = Query("Gems", description=f"One of: {', '.join(FILTER_FIELDS + ['PetCount'])}"),
+    limit: int = Query(50, ge=1, le=500),
+    username: str = Depends(get_session_user),
+    db_client = Depends(get_db)
+):
+    """Top players by a numeric field, read in order from its (field, PlayerName) index"""
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if field not in FILTER_FIELDS + ["PetCount"]:
+        raise HTTPException(status_code=400, detail=f"Invalid field, expected one of: {', '.join(FILTER_FIELDS + ['PetCount'])}")
+    
+    not_modified = await conditional_get(request, response, ("latest",))
+    if not_modified:
+        return not_modified
+    
+    cache_key = f"analytics_top_{field}_{limit}"
+    cached_data = await cache_get(cache_key)
+    if cached_data:
+        return cached_data
+    generations = await cache_generations(("latest",))
+    
+    projection = build_latest_projection(None, "summary", field)
+    try:
+        if COLUMNAR_ENABLED and columnar_latest.loaded:
+            _, players = columnar_latest.query({}, sort_field=field, direction=DESCENDING, limit=limit, projection=projection)
+        else:
+            players = await db_client.latest.find(
+                {},
+                projection,
+                sort=list(latest_sort_spec(field, DESCENDING).items()),
+                limit=limit
+            )
+    except Exception as e:
+        logger.error(f"Error in get_analytics_top: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    
+    for rank, player in enumerate(players, start=1):
+        player["rank"] = rank
+        if "timestamp" in player:
+            player["timestamp"] = player["timestamp"].isoformat()
+    
+    top = {"field": field, "limit": limit, "players": players}
+    await cache_set(cache_key, top, tags=generations)
+    return top
+
 class RobloxAccount(BaseModel):
     """Model for Roblox account import data"""
     accounts: str = ""  # Format: username:password:cookie
@@ -1079,11 +4038,7 @@ async def import_accounts(
         logger.info(f"Processing {account_count} account entries")
         results = []
         
-        # Initialize bulk operations
-        if not hasattr(db_client.db, 'roblox_accounts'):
-            db_client.db.create_collection('roblox_accounts')
-        
-        accounts_collection = db_client.db.roblox_accounts
+        accounts_collection = db_client.accounts
         
         # Create batches of 50 accounts for bulk operations
         batch_size = 50
@@ -1146,10 +4101,10 @@ async def import_accounts(
             logger.info(f"Processing batch {current_batch} of {total_batches} ({len(batch)} accounts)")
             
             # Check which accounts already exist
-            existing_accounts = list(accounts_collection.find(
+            existing_accounts = await accounts_collection.find(
                 {"username": {"$in": batch}}, 
                 {"_id": 0, "username": 1}
-            ))
+            )
             
             existing_usernames = [account["username"] for account in existing_accounts]
             
@@ -1191,7 +4146,7 @@ async def import_accounts(
             # Execute bulk operations
             if bulk_updates:
                 try:
-                    update_result = accounts_collection.bulk_write(bulk_updates)
+                    update_result = await accounts_collection.bulk_write(bulk_updates)
                     logger.info(f"Bulk updated {update_result.modified_count} accounts")
                 except Exception as e:
                     logger.error(f"Error in bulk update: {str(e)}")
@@ -1208,7 +4163,7 @@ async def import_accounts(
             
             if bulk_inserts:
                 try:
-                    insert_result = accounts_collection.insert_many(bulk_inserts, ordered=False)
+                    insert_result = await accounts_collection.insert_many(bulk_inserts, ordered=False)
                     logger.info(f"Bulk inserted {len(insert_result.inserted_ids)} accounts")
                 except pymongo.errors.BulkWriteError as e:
                     # Some inserts might have succeeded
@@ -1257,6 +4212,7 @@ async def get_accounts(
     username: str = Depends(get_session_user),
     page: int = Query(1, ge=1, description="Page number"),
     page_size: int = Query(500, ge=10, le=1000, description="Items per page"), 
+    cursor: str = Query(None, description="Opaque next_cursor from the previous page; overrides page"),
     db_client = Depends(get_db)
 ):
     """Get all Roblox accounts with pagination and has_cookie indicator"""
@@ -1264,22 +4220,33 @@ async def get_accounts(
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     try:
-        if not hasattr(db_client.db, 'roblox_accounts'):
-            return {"data": [], "pagination": {"total_items": 0, "total_pages": 0, "page": page, "page_size": page_size}}
-        
-        accounts_collection = db_client.db.roblox_accounts
+        accounts_collection = db_client.accounts
         
         # Tính tổng số tài khoản
-        total_count = accounts_collection.count_documents({})
+        total_count = await accounts_collection.count_documents({})
         
-        # Tính skip cho phân trang
-        skip = (page - 1) * page_size
+        # Keyset: tiếp tục sau username cuối cùng của trang trước, dùng index username
+        if cursor:
+            last_username = decode_cursor(cursor).get("username")
+            if not isinstance(last_username, str):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            account_filter = {"username": {"$gt": last_username}}
+            skip = 0
+        else:
+            # Tính skip cho phân trang
+            account_filter = {}
+            skip = (page - 1) * page_size
         
         # Lấy tài khoản với phân trang và các trường cần thiết
-        cursor = accounts_collection.find({}).skip(skip).limit(page_size)
+        account_docs = await accounts_collection.find(
+            account_filter,
+            sort=[("username", ASCENDING)],
+            skip=skip,
+            limit=page_size
+        )
         
         accounts = []
-        for account in cursor:
+        for account in account_docs:
             # Kiểm tra cookie tồn tại không mà không trả về giá trị thực
             has_cookie = bool(account.get("cookie") and account.get("cookie").strip() != '')
             
@@ -1294,15 +4261,23 @@ async def get_accounts(
         # Tính tổng số trang
         total_pages = (total_count + page_size - 1) // page_size
         
+        next_cursor = None
+        if len(accounts) == page_size:
+            next_cursor = encode_cursor({"username": accounts[-1]["username"]})
+        
         return {
             "data": accounts,
             "pagination": {
                 "total_items": total_count,
                 "total_pages": total_pages,
                 "page": page,
-                "page_size": page_size
+                "page_size": page_size,
+                "cursor": cursor,
+                "next_cursor": next_cursor
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting Roblox accounts: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -1318,11 +4293,7 @@ async def get_account_cookie(
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     try:
-        if not hasattr(db_client.db, 'roblox_accounts'):
-            raise HTTPException(status_code=404, detail="Account not found")
-        
-        accounts_collection = db_client.db.roblox_accounts
-        account = accounts_collection.find_one({"username": username})
+        account = await db_client.accounts.find_one({"username": username})
         
         if not account:
             raise HTTPException(status_code=404, detail="Account not found")
@@ -1334,6 +4305,14 @@ async def get_account_cookie(
         logger.error(f"Error getting account cookie: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+@app.on_event("shutdown")
+async def close_db():
+    """Close the MongoDB client and release the database thread pool"""
+    db_client = MongoDBClient._instance
+    if db_client is not None and db_client.client is not None:
+        db_client.client.close()
+    db_executor.shutdown(wait=False)
+
 if __name__ == "__main__":
     # Check MongoDB connection
     try:
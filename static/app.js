@@ -342,6 +342,7 @@ let filteredData = []; // Thêm biến lưu dữ liệu đã lọc
 let isLoadingData = false;
 let loadingErrorOccurred = false;
 let accountData = {}; // Lưu trữ dữ liệu tài khoản (username, password, cookie)
+let syncToken = null; // Token từ /api/latest, auto-refresh chỉ tải phần thay đổi qua /api/latest/changes
 
 // Biến lưu trạng thái filter
 const filterState = {
@@ -375,6 +376,18 @@ const sortState = {
     direction: 'asc'
 };
 
+// Cột trên bảng -> trường sort của /api/latest (server sort theo index)
+const SERVER_SORT_FIELDS = {
+    PlayerName: 'PlayerName',
+    Cash: 'Cash',
+    Gems: 'Gems',
+    Ticket: 'TicketCount',
+    PetS: 'SRankPets',
+    PetSS: 'SSRankPets',
+    Gamepass: 'PassCount',
+    timestamp: 'timestamp'
+};
+
 /**
  * Định dạng số với dấu phẩy ngăn cách hàng nghìn
  * @param {number} num - Số cần định dạng
@@ -820,7 +833,8 @@ async function fetchLatestStats(forceRefresh = false) {
             + `_gamepass_${filterState.gamepassMin}_${filterState.gamepassMax}`;
     }
 
-    const CACHE_KEY = `latest_stats_page_${pagination.currentPage}_size_${pagination.itemsPerPage}_search_${searchTerm || 'none'}${cacheKeyFilters}`;
+    const serverSort = SERVER_SORT_FIELDS[sortState.field] || 'PlayerName';
+    const CACHE_KEY = `latest_stats_page_${pagination.currentPage}_size_${pagination.itemsPerPage}_search_${searchTerm || 'none'}${cacheKeyFilters}_sort_${serverSort}_${sortState.direction}`;
 
     // Tránh tải đồng thời nhiều lần
     if (isLoadingData) {
@@ -894,6 +908,7 @@ async function fetchLatestStats(forceRefresh = false) {
         // Tạo URL API với thông tin phân trang
         let apiUrl = getUrl('/api/latest');
         apiUrl += `?page=${pagination.currentPage}&page_size=${pagination.itemsPerPage}`;
+        apiUrl += `&sort=${serverSort}&order=${sortState.direction}`;
 
         // Thêm tham số tìm kiếm nếu có
         if (searchTerm) {
@@ -967,6 +982,10 @@ async function fetchLatestStats(forceRefresh = false) {
         const responseData = await response.json();
         console.log('API response received:', responseData);
 
+        if (responseData.sync_token) {
+            syncToken = responseData.sync_token;
+        }
+
         let data, paginationInfo;
 
         // Check if the response is already structured with data and pagination
@@ -1122,6 +1141,153 @@ async function fetchLatestStats(forceRefresh = false) {
     }
 }
 
+/**
+ * Đồng bộ thay đổi từ /api/latest/changes vào bảng đang hiển thị thay vì tải lại toàn bộ
+ */
+async function syncLatestChanges() {
+    if (!syncToken || isLoadingData) {
+        await fetchLatestStats();
+        return;
+    }
+
+    try {
+        let changed = false;
+        let changes;
+        do {
+            const response = await fetch(getUrl(`/api/latest/changes?since=${encodeURIComponent(syncToken)}`), {
+                method: 'GET',
+                credentials: 'include',
+                headers: { 'Accept': 'application/json' }
+            });
+
+            if (!response.ok) {
+                throw new Error(`HTTP error: ${response.status} - ${response.statusText}`);
+            }
+
+            changes = await response.json();
+            if (changes.reset) {
+                // Token quá cũ, server không còn đủ dữ liệu xóa -> tải lại toàn bộ
+                syncToken = null;
+                await fetchLatestStats(true);
+                return;
+            }
+
+            changed = applyLatestChanges(changes) || changed;
+            syncToken = changes.sync_token;
+        } while (changes.has_more);
+
+        console.log(`Đồng bộ thay đổi xong${changed ? '' : ' (không có thay đổi)'}`);
+        if (changed) {
+            await createPlayersTable(filteredData);
+        }
+    } catch (error) {
+        console.warn('Không thể đồng bộ thay đổi, tải lại dữ liệu:', error);
+        await fetchLatestStats(true);
+    }
+}
+
+/**
+ * Kết nối /api/stream (Server-Sent Events) để cập nhật bảng mà không cần polling
+ */
+function startLiveUpdates() {
+    if (typeof EventSource === 'undefined') {
+        console.warn('Trình duyệt không hỗ trợ EventSource, dùng auto-refresh');
+        return;
+    }
+
+    let renderTimer = null;
+    let syncTimer = null;
+
+    // Gộp nhiều sự kiện liên tiếp thành một lần vẽ lại bảng
+    const scheduleRender = () => {
+        if (renderTimer) return;
+        renderTimer = setTimeout(async () => {
+            renderTimer = null;
+            if (!isLoadingData) {
+                await createPlayersTable(filteredData);
+            }
+        }, 1000);
+    };
+
+    // Sự kiện chỉ có các trường số; danh sách pet/item/pass lấy sau qua /api/latest/changes
+    const scheduleSync = () => {
+        if (syncTimer) return;
+        syncTimer = setTimeout(async () => {
+            syncTimer = null;
+            await syncLatestChanges();
+        }, 10000);
+    };
+
+    const source = new EventSource(getUrl('/api/stream'), { withCredentials: true });
+
+    source.onmessage = (message) => {
+        const event = JSON.parse(message.data);
+        if (event.type === 'delete') {
+            applyLatestChanges({ updated: [], deleted: [event.PlayerName] });
+            scheduleRender();
+        } else if (event.type === 'update') {
+            const rows = [currentData, filteredData];
+            let shown = false;
+            rows.forEach(data => {
+                const row = data.find(player => player.PlayerName === event.PlayerName);
+                if (row) {
+                    const { type, ...fields } = event;
+                    Object.assign(row, fields);
+                    shown = true;
+                }
+            });
+            if (shown) {
+                scheduleRender();
+            }
+            scheduleSync();
+        }
+    };
+
+    // Client bị rớt sự kiện (hàng đợi đầy) -> đồng bộ lại qua changes
+    source.addEventListener('resync', () => {
+        console.warn('Live feed bị rớt sự kiện, đồng bộ lại');
+        syncLatestChanges();
+    });
+
+    source.onerror = () => {
+        // EventSource tự kết nối lại (retry do server gửi); bù các sự kiện bị lỡ khi mất kết nối
+        console.warn('Mất kết nối live feed, đang kết nối lại...');
+        scheduleSync();
+    };
+}
+
+/**
+ * Áp dụng một trang thay đổi vào dữ liệu trong bộ nhớ
+ * @param {{updated: Array, deleted: Array<string>}} changes - Kết quả từ /api/latest/changes
+ * @returns {boolean} true nếu dữ liệu đang hiển thị thay đổi
+ */
+function applyLatestChanges(changes) {
+    if (changes.updated.length === 0 && changes.deleted.length === 0) {
+        return false;
+    }
+
+    const deleted = new Set(changes.deleted);
+    const updated = new Map(changes.updated.map(player => [player.PlayerName, player]));
+    const patch = rows => rows
+        .filter(player => !deleted.has(player.PlayerName))
+        .map(player => updated.get(player.PlayerName) || player);
+
+    const known = new Set(currentData.map(player => player.PlayerName));
+    currentData = patch(currentData);
+    filteredData = patch(filteredData);
+
+    // Người chơi mới chỉ thêm vào khi client đang giữ toàn bộ bảng (không phân trang/lọc phía server)
+    if (!pagination.serverSidePagination && !filterState.isActive) {
+        const added = changes.updated.filter(player => !known.has(player.PlayerName));
+        currentData = currentData.concat(added);
+        filteredData = filteredData.concat(added);
+        pagination.totalItems = filteredData.length;
+        pagination.totalPages = Math.ceil(filteredData.length / pagination.itemsPerPage);
+    }
+
+    return true;
+}
+
 /**
  * Fetch all data from the server across multiple pages
  * @returns {Promise<Array>} All player data from the server
@@ -1129,23 +1295,9 @@ async function fetchLatestStats(forceRefresh = false) {
 async function fetchAllData() {
     console.log('Fetching all data for complete filtering...');
 
-    // Lưu cài đặt phân trang ban đầu
-    const originalPage = pagination.currentPage;
-    const originalPageSize = pagination.itemsPerPage;
-    const originalServerSide = pagination.serverSidePagination;
-
-    // Cài đặt để tải tất cả dữ liệu
-    pagination.currentPage = 1;
-    pagination.itemsPerPage = 200; // Giới hạn server là 200
-    pagination.serverSidePagination = true;
-
     // Khởi tạo mảng lưu tất cả dữ liệu
     let allData = [];
-    let hasMoreData = true;
-    let currentPage = 1;
-    let totalPages = 1;
     let totalRecords = 0;
-    let maxRetries = 5;
 
     // Hiển thị modal loading
     const container = document.getElementById('playersContainer');
@@ -1163,115 +1315,55 @@ async function fetchAllData() {
                 </div>
             </div>
             <p class="mt-2 text-light">
-                <span id="pageCount">0</span>/<span id="totalPages">?</span> trang
-            </p>
-            <p class="mt-2 text-light">
-                <span id="recordCount">0</span> bản ghi đã tải
+                <span id="recordCount">0</span>/<span id="totalRecords">?</span> bản ghi đã tải
             </p>
             <div id="statusMessage" class="mt-2 small text-light"></div>
         </div>
     `;
 
     try {
-        // Tải dữ liệu trang đầu tiên để lấy thông tin tổng số trang
-        let firstPageUrl = getUrl('/api/latest');
-        firstPageUrl += `?page=1&page_size=${pagination.itemsPerPage}`;
-
-        console.log(`Tải trang đầu tiên để lấy thông tin pagination...`);
-        const firstResponse = await fetch(firstPageUrl, {
+        // Một request duy nhất: server stream NDJSON (mỗi dòng một người chơi) từ cursor
+        const response = await fetch(getUrl('/api/latest/export?format=ndjson'), {
             method: 'GET',
             credentials: 'include',
             headers: {
-                'Accept': 'application/json',
+                'Accept': 'application/x-ndjson',
                 'Cache-Control': 'no-cache, no-store, must-revalidate'
             }
         });
 
-        if (!firstResponse.ok) {
-            throw new Error(`HTTP error khi tải trang đầu: ${firstResponse.status} - ${firstResponse.statusText}`);
-        }
-
-        const firstData = await firstResponse.json();
-        if (firstData.pagination) {
-            totalPages = firstData.pagination.total_pages;
-            totalRecords = firstData.pagination.total_items;
-            console.log(`✅ Thông tin pagination: ${totalPages} trang, ${totalRecords} bản ghi`);
-
-            // Cập nhật UI với thông tin tổng số trang
-            const statusMessage = document.getElementById('statusMessage');
-            const totalPagesEl = document.getElementById('totalPages');
-            if (statusMessage) statusMessage.textContent = `Tổng cộng ${totalRecords} bản ghi cần tải`;
-            if (totalPagesEl) totalPagesEl.textContent = totalPages;
-
-            // Thêm dữ liệu trang đầu tiên
-            if (firstData.data && Array.isArray(firstData.data)) {
-                allData = allData.concat(firstData.data);
-                console.log(`✅ Đã tải trang 1/${totalPages}: ${firstData.data.length} bản ghi`);
-                currentPage = 2; // Bắt đầu từ trang 2
-            }
+        if (!response.ok) {
+            throw new Error(`HTTP error khi tải dữ liệu: ${response.status} - ${response.statusText}`);
         }
 
-        // QUAN TRỌNG: Tách thành nhiều batch nhỏ để tải hiệu quả
-        const BATCH_SIZE = 5; // Tải 5 trang một lần
-
-        while (currentPage <= totalPages) {
-            // Tạo batch các promises để tải dữ liệu đồng thời
-            const batchPromises = [];
-            const batchStart = currentPage;
-            const batchEnd = Math.min(currentPage + BATCH_SIZE - 1, totalPages);
-
-            console.log(`🔄 Tải batch từ trang ${batchStart} đến ${batchEnd}...`);
-
-            for (let page = batchStart; page <= batchEnd; page++) {
-                batchPromises.push(fetchPage(page));
-            }
-
-            // Đợi tất cả promises trong batch hoàn thành
-            const batchResults = await Promise.allSettled(batchPromises);
-
-            // Xử lý kết quả của mỗi trang
-            let successCount = 0;
-            for (let i = 0; i < batchResults.length; i++) {
-                const result = batchResults[i];
-                const pageIndex = batchStart + i;
-
-                if (result.status === 'fulfilled' && result.value && Array.isArray(result.value)) {
-                    // Lọc để tránh trùng lặp dữ liệu
-                    const newRecords = result.value.filter(record =>
-                        !allData.some(existing => existing.PlayerName === record.PlayerName)
-                    );
-
-                    allData = allData.concat(newRecords);
-                    console.log(`✅ Trang ${pageIndex}/${totalPages}: Thêm ${newRecords.length} bản ghi mới (tổng: ${allData.length})`);
-                    successCount++;
-                } else {
-                    console.error(`❌ Lỗi khi tải trang ${pageIndex}:`, result.reason || 'Unknown error');
+        totalRecords = parseInt(response.headers.get('X-Total-Count') || '0', 10);
+        syncToken = response.headers.get('X-Sync-Token') || syncToken;
+        const statusMessage = document.getElementById('statusMessage');
+        const totalRecordsEl = document.getElementById('totalRecords');
+        if (statusMessage) statusMessage.textContent = `Tổng cộng ${totalRecords} bản ghi cần tải`;
+        if (totalRecordsEl) totalRecordsEl.textContent = totalRecords;
+
+        // Đọc stream theo từng chunk, tách dòng và parse ngay để không giữ toàn bộ body dạng text
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let pending = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            pending += decoder.decode(value || new Uint8Array(), { stream: !done });
+
+            const lines = pending.split('\n');
+            pending = done ? '' : lines.pop();
+            for (const line of lines) {
+                if (line.trim()) {
+                    allData.push(JSON.parse(line));
                 }
             }
 
-            // Cập nhật tiến trình
-            updateLoadingProgress(batchEnd, totalPages, allData.length);
-
-            // Di chuyển đến batch tiếp theo
-            currentPage = batchEnd + 1;
-
-            // Nếu không có trang nào thành công, thử lại hoặc thoát
-            if (successCount === 0) {
-                maxRetries--;
-                if (maxRetries <= 0) {
-                    console.error(`❌ Đã đạt giới hạn số lần thử lại, dừng tải ở trang ${currentPage - 1}/${totalPages}`);
-                    break;
-                }
-                console.warn(`⚠️ Batch từ ${batchStart}-${batchEnd} thất bại, thử lại (còn ${maxRetries} lần)`);
-                currentPage = batchStart; // Thử lại batch này
-                await new Promise(resolve => setTimeout(resolve, 1000)); // Đợi 1s trước khi thử lại
-            } else {
-                // Thêm độ trễ nhỏ giữa các batch để tránh rate limit
-                await new Promise(resolve => setTimeout(resolve, 100));
-            }
+            updateLoadingProgress(allData.length, totalRecords);
+            if (done) break;
         }
 
-        console.log(`✅ Đã tải xong tổng cộng ${allData.length}/${totalRecords} bản ghi từ ${currentPage - 1}/${totalPages} trang`);
+        console.log(`✅ Đã tải xong tổng cộng ${allData.length}/${totalRecords} bản ghi`);
 
         // Hiển thị thông báo hoàn tất
         document.getElementById('statusMessage').innerHTML = `<span class="text-success">✅ Đã tải xong ${allData.length}/${totalRecords} bản ghi</span>`;
@@ -1318,71 +1410,22 @@ async function fetchAllData() {
                 continueWithPartialData(allData);
             });
         }
-    } finally {
-        // Khôi phục cài đặt phân trang ban đầu
-        pagination.currentPage = originalPage;
-        pagination.itemsPerPage = originalPageSize;
-        pagination.serverSidePagination = originalServerSide;
     }
 
     return allData;
 
-    // Hàm tải một trang dữ liệu
-    async function fetchPage(page) {
-        let retries = 3;
-        while (retries > 0) {
-            try {
-                let apiUrl = getUrl('/api/latest');
-                apiUrl += `?page=${page}&page_size=${pagination.itemsPerPage}`;
-
-                const response = await fetch(apiUrl, {
-                    method: 'GET',
-                    credentials: 'include',
-                    headers: {
-                        'Accept': 'application/json',
-                        'Cache-Control': 'no-cache, no-store, must-revalidate'
-                    },
-                    // Thêm timeout để tránh request treo quá lâu
-                    signal: AbortSignal.timeout(30000) // 30 giây timeout
-                });
-
-                if (!response.ok) {
-                    throw new Error(`HTTP error: ${response.status} - ${response.statusText}`);
-                }
-
-                const responseData = await response.json();
-
-                // Trả về mảng dữ liệu
-                if (responseData.data && Array.isArray(responseData.data)) {
-                    return responseData.data;
-                } else if (Array.isArray(responseData)) {
-                    return responseData;
-                }
-
-                throw new Error('Invalid data format');
-            } catch (error) {
-                retries--;
-                if (retries <= 0) throw error;
-                console.warn(`⚠️ Lỗi khi tải trang ${page}, còn ${retries} lần thử lại:`, error);
-                await new Promise(resolve => setTimeout(resolve, 1000)); // Đợi 1s trước khi thử lại
-            }
-        }
-    }
-
     // Hàm cập nhật tiến trình tải
-    function updateLoadingProgress(currentPage, totalPages, recordCount) {
+    function updateLoadingProgress(recordCount, totalRecords) {
         const progressBar = document.getElementById('fetchProgress');
-        const pageCountEl = document.getElementById('pageCount');
         const recordCountEl = document.getElementById('recordCount');
 
-        if (progressBar) {
-            const percent = Math.round((currentPage / totalPages) * 100);
+        if (progressBar && totalRecords > 0) {
+            const percent = Math.min(100, Math.round((recordCount / totalRecords) * 100));
             progressBar.style.width = `${percent}%`;
             progressBar.setAttribute('aria-valuenow', percent);
             progressBar.textContent = `${percent}%`;
         }
 
-        if (pageCountEl) pageCountEl.textContent = currentPage;
         if (recordCountEl) recordCountEl.textContent = recordCount;
     }
 
@@ -1474,12 +1517,15 @@ document.addEventListener('DOMContentLoaded', async function () {
         // Initial data fetch
         await fetchLatestStats();
 
+        // Nhận cập nhật trực tiếp qua SSE, interval bên dưới chỉ còn là dự phòng
+        startLiveUpdates();
+
         // Setup interval to refresh data
         setInterval(async () => {
             if (document.hidden || !document.hasFocus()) {
                 // Refresh data if tab is in background or not focused
                 console.log("Auto-refreshing data due to inactivity...");
-                await fetchLatestStats();
+                await syncLatestChanges();
             }
         }, 5 * 60 * 1000); // 5 minutes
 
@@ -3259,6 +3305,14 @@ async function sortData(field) {
         sortState.direction = 'asc';
     }
 
+    // Phân trang phía server: để server sắp xếp toàn bộ dữ liệu thay vì chỉ trang hiện tại
+    if (pagination.serverSidePagination && (!filterState.isActive || filterState.serverSideFiltering) && SERVER_SORT_FIELDS[field]) {
+        pagination.currentPage = 1;
+        await fetchLatestStats();
+        updateSortingIcons();
+        return;
+    }
+
     // Sử dụng requestAnimationFrame để làm mượt việc sort
     await new Promise(resolve => {
         requestAnimationFrame(async () => {
@@ -0,0 +1,58 @@
+"""Fixtures: the FastAPI app against a fresh in-memory mongomock database per test"""
+import os
+import sys
+
+# Before server is imported: the default URI is an SRV one, writes go straight to MongoDB
+os.environ["MONGO_URI"] = "mongodb://localhost:27017"
+os.environ["INGEST_BUFFER_ENABLED"] = "false"
+os.environ["CACHE_BACKEND"] = "memory"
+os.environ["HISTORY_ENABLED"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mongomock
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(server, "MongoClient", mongomock.MongoClient)
+    monkeypatch.setattr(server.MongoDBClient, "_instance", None)
+    # Module-level state shared by the handlers
+    monkeypatch.setattr(server, "cache", server.ResponseCache(server.CACHE_MAX_ENTRIES, server.CACHE_MAX_BYTES, server.CACHE_EXPIRY))
+    monkeypatch.setattr(server, "sessions", {})
+    monkeypatch.setattr(server, "name_index", server.NameIndex())
+    monkeypatch.setattr(server, "ingest_load", server.IngestLoad())
+    # Analytics rebuilds wait out the settle window
+    monkeypatch.setattr(server, "CHANGES_SETTLE_SECONDS", 0.2)
+    return server.MongoDBClient.get_instance()
+
+@pytest.fixture
+def client(db):
+    """Logged-in client; startup hooks (background tasks) are not run"""
+    client = TestClient(server.app)
+    server.sessions["test-session"] = {"username": "hopeo"}
+    client.cookies.set("session", "test-session")
+    return client
+
+def player(name, cash=0, gems=0, pets=(), **fields):
+    """A plain /ac_stats payload; pets are (name, level, rank_num) tuples"""
+    return {
+        "PlayerName": name,
+        "Cash": cash,
+        "Gems": gems,
+        "PetCount": len(pets),
+        "PetsList": [
+            {"Name": pet_name, "Level": level, "Rank": server.RANK_NAMES[rank_num], "RankNum": rank_num, "FolderName": pet_name}
+            for pet_name, level, rank_num in pets
+        ],
+        "ItemsList": [],
+        **fields
+    }
+
+def post_players(client, *payloads):
+    for payload in payloads:
+        response = client.post("/ac_stats", json=payload)
+        assert response.status_code == 200, response.text
+        assert response.json()["success"], response.text
@@ -0,0 +1,87 @@
+"""Running analytics totals kept by persist_stats and the delete endpoints"""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import server
+from conftest import player, post_players
+
+def test_totals_follow_updates_and_deletes(client):
+    post_players(
+        client,
+        player("Alice", cash=100, gems=5, pets=[("Igris", 40, 6), ("Beru", 10, 7)]),
+        player("Bob", cash=50, gems=1, pets=[("Tank", 3, 1)])
+    )
+    # The first summary builds the totals
+    summary = client.get("/api/analytics/summary").json()
+    assert summary["players"] == 2
+    assert summary["totals"]["Cash"] == 150
+    
+    # An update replaces Alice's share instead of adding to it
+    post_players(client, player("Alice", cash=300, gems=5, pets=[("Igris", 40, 6)]))
+    summary = client.get("/api/analytics/summary").json()
+    assert summary["players"] == 2
+    assert summary["totals"]["Cash"] == 350
+    assert summary["totals"]["PetCount"] == 2
+    assert summary["averages"]["Cash"] == 175
+    assert summary["rank_distribution"] == {"E": 1, "S": 1}
+    
+    assert client.delete("/api/player/Bob").status_code == 200
+    summary = client.get("/api/analytics/summary").json()
+    assert summary["players"] == 1
+    assert summary["totals"]["Cash"] == 300
+
+def test_rebuild_matches_running_totals(client, db):
+    asyncio.run(server.rebuild_analytics(db))
+    post_players(client, player("Alice", cash=7, gems=2), player("Bob", cash=11, pets=[("Beru", 10, 7)]))
+    client.delete("/api/player/Alice")
+    post_players(client, player("Carol", cash=5))
+    
+    running = db.analytics.collection.find_one({"_id": "latest_totals"})
+    rebuilt = asyncio.run(server.rebuild_analytics(db))
+    # $inc leaves emptied ranks and buckets behind at 0
+    assert rebuilt["players"] == running["players"]
+    assert rebuilt["sums"] == running["sums"]
+    assert rebuilt["ranks"] == {rank: count for rank, count in running["ranks"].items() if count}
+    for field, buckets in running["histograms"].items():
+        assert rebuilt["histograms"][field] == {bucket: count for bucket, count in buckets.items() if count}
+    assert rebuilt["sums"]["Cash"] == 16
+    assert rebuilt["ranks"] == {"SS": 1}
+
+def test_deltas_counted_by_a_rebuild_are_dropped(client, db):
+    post_players(client, player("Alice", cash=7))
+    rebuilt = asyncio.run(server.rebuild_analytics(db))
+    
+    # A write that reserved its seqs before the rebuild was counted by the scan
+    asyncio.run(server.apply_analytics_incs(db, {rebuilt["rebuilt_seq"]: {"sums.Cash": 100.0}}))
+    assert db.analytics.collection.find_one()["sums"]["Cash"] == 7
+    asyncio.run(server.apply_analytics_incs(db, {rebuilt["rebuilt_seq"] + 1: {"sums.Cash": 100.0}}))
+    assert db.analytics.collection.find_one()["sums"]["Cash"] == 107
+
+def test_writes_pause_while_rebuilding(client, db):
+    post_players(client, player("Alice", cash=7))
+    db.counters.collection.update_one(
+        {"_id": "latest_seq"}, {"$set": {"rebuild": {"id": "other", "started_at": datetime.utcnow()}}}
+    )
+    
+    response = client.post("/ac_stats", json=player("Alice", cash=8)).json()
+    assert response["success"] is False
+    response = client.delete("/api/player/Alice")
+    assert response.status_code == 503
+    # Only one rebuild at a time
+    assert asyncio.run(server.rebuild_analytics(db)) is None
+    assert db.latest_collection.find_one({"PlayerName": "Alice"})["Cash"] == 7
+    
+    db.counters.collection.update_one({"_id": "latest_seq"}, {"$unset": {"rebuild": ""}})
+    post_players(client, player("Alice", cash=8))
+    assert client.delete("/api/player/Alice").status_code == 200
+
+def test_totals_beyond_int64(client):
+    # Each Cash fits a BSON int64, their sum does not
+    post_players(client, *(player(f"Whale{i}", cash=2 ** 63 - 1 - i) for i in range(3)))
+    response = client.get("/api/analytics/summary", params={"histogram": True})
+    assert response.status_code == 200, response.text
+    summary = response.json()
+    assert summary["totals"]["Cash"] == pytest.approx(3 * 2 ** 63)
+    assert summary["averages"]["Cash"] == pytest.approx(2 ** 63)
@@ -0,0 +1,68 @@
+"""/ac_stats payload decoding: compact v2 and the compressed body limits"""
+import gzip
+import zlib
+
+import server
+from conftest import player, post_players
+
+COMPACT = {
+    "v": 2,
+    "n": "Compact",
+    "c": 1234.9,
+    "g": 56,
+    "p": [["Igris", 40, 6, "IgrisFolder"], ["Beru", 12, 7]],
+    "i": [["Ticket", 3]],
+    "s": ["VIP"]
+}
+
+def test_decode_compact_stats():
+    stats = server.decode_compact_stats(COMPACT)
+    assert stats["PlayerName"] == "Compact"
+    assert stats["PetCount"] == 2
+    assert stats["PetsList"][0] == {"Name": "Igris", "Level": 40, "Rank": "S", "RankNum": 6, "FolderName": "IgrisFolder"}
+    # FolderName defaults to the pet name
+    assert stats["PetsList"][1]["FolderName"] == "Beru"
+    assert stats["PetsList"][1]["Rank"] == "SS"
+    assert stats["ItemsList"] == [{"Name": "Ticket", "Amount": 3}]
+    assert stats["PassesList"] == [{"Name": "VIP", "Owned": True}]
+
+def test_compact_payload_is_stored_like_a_plain_one(client, db):
+    response = client.post("/ac_stats", content=gzip.compress(server.orjson.dumps(COMPACT)),
+                           headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+    assert response.status_code == 200, response.text
+    
+    stored = db.latest_collection.find_one({"PlayerName": "Compact"})
+    assert stored["Cash"] == 1234
+    assert stored["FormattedCash"] == "1,234"
+    assert stored["SSRankPets"] == 1
+    assert stored["SRankPets"] == 1
+
+def test_malformed_compact_payload_is_rejected(client):
+    response = client.post("/ac_stats", json={"v": 2, "c": 1})
+    assert response.status_code == 400
+    assert "compact" in response.json()["detail"]
+
+def test_oversized_body_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(server, "INGEST_MAX_BODY_BYTES", 1024)
+    response = client.post("/ac_stats", json=player("Big", PassesList=[{"Name": "x" * 2000, "Owned": True}]))
+    assert response.status_code == 413
+
+def test_decompression_bomb_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(server, "INGEST_MAX_BODY_BYTES", 64 * 1024)
+    # 64 KB of compressed zeros inflate to far more than the limit
+    bomb = gzip.compress(b"0" * (64 * 1024 * 1024))
+    assert len(bomb) < 64 * 1024
+    response = client.post("/ac_stats", content=bomb, headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 413
+
+def test_raw_deflate_body(client, db):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    body = compressor.compress(server.orjson.dumps(player("Raw", cash=5))) + compressor.flush()
+    response = client.post("/ac_stats", content=body, headers={"Content-Encoding": "deflate"})
+    assert response.status_code == 200, response.text
+    assert db.latest_collection.find_one({"PlayerName": "Raw"})["Cash"] == 5
+
+def test_truncated_gzip_body(client):
+    response = client.post("/ac_stats", content=gzip.compress(b'{"PlayerName": "T"}')[:-8],
+                           headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 400
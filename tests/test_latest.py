@@ -0,0 +1,57 @@
+"""/api/latest keyset pagination and the /api/latest/changes feed"""
+import time
+
+import server
+from conftest import player, post_players
+
+def test_cursor_pagination_walks_every_player_once(client):
+    # Repeated Cash values: the cursor has to break ties on PlayerName
+    post_players(client, *(player(f"P{i:02d}", cash=(i % 4) * 100) for i in range(25)))
+    
+    seen = []
+    cursor = None
+    while True:
+        params = {"sort": "Cash", "order": "desc", "page_size": 10, "fields": "Cash"}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/api/latest", params=params).json()
+        assert page["pagination"]["total_items"] == 25
+        seen.extend(page["data"])
+        cursor = page["pagination"]["next_cursor"]
+        if not cursor:
+            break
+    
+    assert sorted(stat["PlayerName"] for stat in seen) == [f"P{i:02d}" for i in range(25)]
+    # Ties on Cash are broken by PlayerName in the same direction
+    keys = [(stat["Cash"], stat["PlayerName"]) for stat in seen]
+    assert keys == sorted(keys, reverse=True)
+
+def test_invalid_cursor(client):
+    response = client.get("/api/latest", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+def test_changes_feed_reports_updates_and_deletes(client, monkeypatch):
+    monkeypatch.setattr(server, "CHANGES_SETTLE_SECONDS", 0.2)
+    post_players(client, player("Alice", cash=1), player("Bob", cash=2))
+    time.sleep(0.3)
+    token = client.get("/api/latest").json()["sync_token"]
+    
+    post_players(client, player("Alice", cash=10), player("Carol", cash=3))
+    assert client.delete("/api/player/Bob").status_code == 200
+    
+    # Not settled yet: held back, and the token stays where it was
+    changes = client.get("/api/latest/changes", params={"since": token}).json()
+    assert changes["updated"] == [] and changes["deleted"] == []
+    
+    time.sleep(0.3)
+    changes = client.get("/api/latest/changes", params={"since": changes["sync_token"]}).json()
+    assert {stat["PlayerName"]: stat["Cash"] for stat in changes["updated"]} == {"Alice": 10, "Carol": 3}
+    assert changes["deleted"] == ["Bob"]
+    assert changes["has_more"] is False
+    
+    # Nothing new after the returned token
+    changes = client.get("/api/latest/changes", params={"since": changes["sync_token"]}).json()
+    assert changes["updated"] == [] and changes["deleted"] == []
+
+def test_changes_feed_requires_a_valid_token(client):
+    assert client.get("/api/latest/changes", params={"since": "garbage"}).status_code == 400